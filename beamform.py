@@ -0,0 +1,131 @@
+'''
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+
+Description
+-----------
+    This script forms beams from the raw voltages of a snapshot with the weights calculated by
+    calculate_weights.py (weights.npz). All weight sets are applied together by one matrix product
+    per block of frames (see inc/beamformer.py). The complex beam voltages or the detected power
+    of every numa node are written into an HDF5 file. The detected power can also be written into
+    SIGPROC filterbank files (one per node and beam) for pulsar and transient search tools.
+    Instead of weight files single elements can be selected (--rows), e.g. to write the power
+    of elements as filterbank files.
+
+Preliminaries
+-------------
+    The script expects the folder structure of convert.py, sub-folders have the name 'numa' + ID.
+    The rows of the weights must match the recorded elements (2 * nelements rows).
+Program flow
+------------
+    0. Parse user arguments
+    1. Collect the files of all numa nodes, one CodifHandler handles all nodes (one stream per node)
+    2. Load the weights (or select rows)
+    3. Read every node once, form the beams and append them to the HDF5 file or the filterbank files
+'''
+import argparse
+import os
+import numpy as np
+from argparse import RawTextHelpFormatter
+
+from inc.codif import *
+from inc.utils import *
+from inc.beamformer import Beamformer, BeamWriter, BeamFilterbank, load_weights, unit_weights, MODES
+from inc.profiling import StageProfiler, report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='options', formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--fname', '-f', action = "store", default = "*", dest = "fname", help = "Input filename expression. If not passed all files within a subfolder are read")
+    parser.add_argument('--dir', '-d', action = "store", default = "/beegfsEDD/NESSER/PAF-12-2020/2020-12-09/2020-12-09-15:57:51/", dest = "dir", help = "Path to root folder")
+    parser.add_argument('--weights', '-w', action = "store", default = "weights.npz", dest = "weights", help = "Comma separated list of weight files of calculate_weights.py, every file forms its own beam(s)")
+    parser.add_argument('--rows', '-r', action = "store", default = "", dest = "rows", help = "Comma separated rows (x-pol of element e: e, y-pol: e + nelements) written as beams instead of weights")
+    parser.add_argument('--kinds', '-k', action = "store", default = "xy", dest = "kinds", help = "Comma separated weight sets of every file: 'x', 'y' and/or 'xy'")
+    parser.add_argument('--mode', '-m', action = "store", default = "power", dest = "mode", help = "'power' writes the detected power, 'voltage' the complex beam voltages")
+    parser.add_argument('--integrate', '-ni', action = "store", default = 128, dest = "integrate", help = "Mode 'power': samples per power value, a divisor or multiple of " + str(CODIF_BLOCKS_IN_PACKET))
+    parser.add_argument('--format', '-fmt', action = "store", default = "hdf5", dest = "format", help = "'hdf5' or 'fil' (SIGPROC filterbank, mode 'power' only)")
+    parser.add_argument('--nbits', '-nb', action = "store", default = 32, dest = "nbits", help = "Filterbank: 32 (float) or 8 bits (scaled by the first block)")
+    parser.add_argument('--source', '-s', action = "store", default = "unknown", dest = "source", help = "Filterbank: source name")
+    parser.add_argument('--output_dir', '-o', action = "store", default="results/", dest="odir", help = "Directory of all outputs")
+    parser.add_argument('--output', '-of', action = "store", default="beams.hdf5", dest="ofile", help = "Name of the HDF5 file within the output directory, the filterbank files are named '<name without extension>_<node>_beam<index>.fil'")
+    parser.add_argument('--nnodes', '-nn', action = "store", default=16, dest="nnodes", help="Number of nodes. All folders between numa0 and numaN are read")
+    parser.add_argument('--nelements', '-n', action = "store", default="", dest="nelements", help="Number of dual-polarized antenna elements. By default it is read from the DADA header (NBEAM), or set to 36")
+    parser.add_argument('--block', '-b', action = "store", default=256, dest="block", help="Frames per matrix product")
+    parser.add_argument('--chunk', '-ch', action = "store", default=1024, dest="chunk", help="Number of rows (time) per HDF5 chunk")
+    parser.add_argument('--compression', '-cz', action = "store", default="", dest="compression", help="HDF5 compression filter, e.g. 'gzip' or 'lzf' (default uncompressed)")
+    parser.add_argument('--prefetch', '-pf', action = "store", default=128, dest="prefetch", help="Size of the prefetch buffers in MB")
+    parser.add_argument('--max_open', '-mo', action = "store", default=64, dest="max_open", help="Maximum number of files which are open at the same time")
+    parser.add_argument('--direct', '-di', action = "store_true", dest="direct", help="Read files with O_DIRECT, bypassing the page cache. Falls back to buffered reads if the filesystem does not support it")
+    parser.add_argument('--profile', '-pr', action = "store", default="", dest="profile", help="Record time per processing stage. Pass 'summary' to print a table or a '.json' file to also store a Chrome trace")
+    parser.add_argument('--progress_rate', '-pg', action = "store", default=2.0, dest="progress_rate", help="Maximum number of progress updates per second (0 disables the progress output)")
+    fname = parser.parse_args().fname
+    idir = parser.parse_args().dir
+    weight_files = [w for w in parser.parse_args().weights.split(",") if w]
+    rows = [int(r) for r in parser.parse_args().rows.split(",") if r]
+    kinds = [k for k in parser.parse_args().kinds.split(",") if k]
+    mode = parser.parse_args().mode
+    integrate = int(parser.parse_args().integrate)
+    fmt = parser.parse_args().format
+    nbits = int(parser.parse_args().nbits)
+    source = parser.parse_args().source
+    odir = check_slash(parser.parse_args().odir)
+    ofile = parser.parse_args().ofile
+    nnodes = int(parser.parse_args().nnodes)
+    nelements = int(parser.parse_args().nelements) if parser.parse_args().nelements else None
+    block = int(parser.parse_args().block)
+    chunk = int(parser.parse_args().chunk)
+    compression = parser.parse_args().compression or None
+    prefetch = int(parser.parse_args().prefetch)
+    max_open = int(parser.parse_args().max_open)
+    direct = parser.parse_args().direct
+    profile = parser.parse_args().profile
+    progress_rate = float(parser.parse_args().progress_rate)
+    profiler = StageProfiler() if profile else None
+    if mode not in MODES:
+        raise ValueError("Unknown mode '" + mode + "', use one of " + ", ".join(MODES))
+    if fmt not in ("hdf5", "fil"):
+        raise ValueError("Unknown format '" + fmt + "', use 'hdf5' or 'fil'")
+    if not os.path.isdir(odir):
+        os.makedirs(odir)
+
+    # 1. Files of all nodes
+    file_list = []
+    for id in range(nnodes):
+        file_list += get_file_list(check_slash(idir) + "numa" + str(id) + "/", fname + "*")
+    handler = CodifHandler(file_list, direct=direct, max_open=max_open)
+    nelements, freq = handler.configure(nelements)
+
+    # 2. Weights of all beams
+    if rows:
+        headers = [stream.files[0].metadata() for stream in handler.streams]
+        if any([header is None or header.channel_frequencies() is None for header in headers]):
+            raise ValueError("Selecting rows requires the channel frequencies of the DADA headers")
+        sky_freq = np.concatenate([header.channel_frequencies() for header in headers])
+        weights, weight_freq, names = unit_weights(rows, nelements * CODIF_POLARIZATION, sky_freq)
+    else:
+        weights, weight_freq, names = load_weights(weight_files, kinds)
+    print("Loaded " + str(len(names)) + " beams of " + str(weights.shape[2]) + " rows and " + str(len(weight_freq)) + " channels")
+    if nelements * CODIF_POLARIZATION != weights.shape[2]:
+        raise ValueError("Weights of " + str(weights.shape[2]) + " rows do not match " + str(nelements) + " elements")
+    beamformer = Beamformer(weights, weight_freq, mode, integrate, block)
+
+    # 3. One pass over all nodes
+    if fmt == "fil":
+        writer = BeamFilterbank(odir + os.path.splitext(ofile)[0], beamformer, nelements, nbits, source, names=names)
+    else:
+        writer = BeamWriter(odir + ofile, beamformer, nelements, chunk, compression, names)
+    handler.process([writer], nelements, profiler=profiler, progress_rate=progress_rate, prefetch=prefetch)
+    for node, stream in zip(handler.numa_list, handler.streams):
+        if stream in writer.freqs:
+            if fmt == "hdf5":
+                writer.groups[stream].attrs["node"] = node
+            beamformer.select(writer.freqs[stream])
+            if beamformer.missing:
+                print("Node " + str(node) + ": no weights for " + ", ".join([str(f) for f in beamformer.missing]) + " MHz")
+    writer.close()
+    if fmt == "fil":
+        print("Saved beams to " + ", ".join(writer.files()) + ", skipped frames of isolated groups (corrupt headers): " + str(writer.outlier_cnt))
+    else:
+        print("Saved beams to " + odir + ofile)
+    if profiler is not None:
+        report(profiler, profile)
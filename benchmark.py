@@ -0,0 +1,266 @@
+'''
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+
+Description
+-----------
+    This script benchmarks the stages of the CODIF processing chain on synthetic data.
+    The data are generated by inc/synthetic.py (valid DADA headers and CODIF packets) in the
+    folder structure of a real snapshot. Each stage runs in its own process, thus the reported
+    peak memory (RSS) belongs to the stage only.
+    The results (packets/s, MB/s, frames/s and peak RSS per stage) are stored as JSON file
+    together with the current git commit, so that runs of different commits can be compared.
+
+Program flow
+------------
+    0. Parse user arguments
+    1. Generate a synthetic snapshot (or use an existing one passed by '--dir')
+    2. Run all selected stages, each in a separate process
+    3. Print and store results, optionally compare them to a previous run
+
+Example
+-------
+    python benchmark.py -o bench_master.json
+    python benchmark.py -o bench_feature.json -c bench_master.json
+'''
+# Included modules
+from __future__ import division
+import argparse
+import io
+import json
+import os
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import multiprocessing
+from collections import OrderedDict
+from argparse import RawTextHelpFormatter
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+
+# Custom modules
+from inc.codif import *
+from inc.utils import *
+from inc.synthetic import SyntheticSnapshot
+from inc.packed import PackedACM
+
+
+def load_packets(fname, npackets, type="dada"):
+    # CODIF packets (header and payload) of a 'dada' or 'pcap' file
+    with open(fname, "rb") as f:
+        if type == "dada":
+            f.seek(DADA_HEADER_SIZE)
+            data = f.read(npackets*CODIF_PACKET_SIZE)
+            return [data[i:i+CODIF_PACKET_SIZE] for i in range(0, len(data) - CODIF_PACKET_SIZE + 1, CODIF_PACKET_SIZE)]
+        # Global header of 24 bytes, every record has a header of 16 bytes and the network layers
+        f.seek(24)
+        packets = []
+        while len(packets) < npackets:
+            record = f.read(16)
+            if len(record) < 16:
+                break
+            length = struct.unpack("<IIII", record)[2]
+            data = f.read(length)
+            if len(data) == length and length >= CODIF_TOTAL_SIZE:
+                packets.append(data[ETHII_HEADER + IPV4_HEADER + UDP_HEADER:][:CODIF_PACKET_SIZE])
+        return packets
+
+def bench_header(files, nelements, npackets, type):
+    packets = load_packets(files[0], npackets, type)
+    for packet in packets:
+        CodifHeader(io.BytesIO(packet))
+    return {"packets" : len(packets), "bytes" : len(packets)*CODIF_PACKET_SIZE}
+
+def bench_payload(files, nelements, npackets, type):
+    packets = load_packets(files[0], npackets, type)
+    payload = CodifPayload(io.BytesIO(packets[0]))
+    for packet in packets:
+        payload.update(io.BytesIO(packet))
+    return {"packets" : len(packets), "bytes" : len(packets)*CODIF_PACKET_SIZE}
+
+def bench_next_frame(files, nelements, npackets, type):
+    result = {"packets" : 0, "bytes" : 0, "frames" : 0}
+    for fname in files:
+        file = CodifFile(fname, type)
+        while not file.empty():
+            if file.next_frame(nelements) is None:
+                break
+        result["packets"] += file.packet_cnt - 1
+        result["frames"] += file.frame_cnt
+    result["bytes"] = result["packets"]*CODIF_PACKET_SIZE
+    return result
+
+def bench_compute_acm(files, nelements, npackets, type):
+    handler = CodifHandler(files, type)
+    acm, freq, frames = handler.compute_acm(nelements)
+    return {"packets" : handler.total_packets, "bytes" : handler.total_packets*CODIF_PACKET_SIZE, "frames" : frames}
+
+def bench_compute_acm_prefetched(files, nelements, npackets, type):
+    handler = CodifHandler(files, type)
+    acm, freq, frames = handler.compute_acm(nelements, prefetch=64)
+    return {"packets" : handler.total_packets, "bytes" : handler.total_packets*CODIF_PACKET_SIZE, "frames" : frames}
+
+def bench_compute_acm_complex64(files, nelements, npackets, type):
+    handler = CodifHandler(files, type)
+    acm, freq, frames = handler.compute_acm(nelements, prefetch=64, correlator="complex64")
+    return {"packets" : handler.total_packets, "bytes" : handler.total_packets*CODIF_PACKET_SIZE, "frames" : frames}
+
+def bench_fillup_acm(files, nelements, npackets, type):
+    acm = np.ones((CODIF_CHANNELS_IN_BLOCK, len(ELEMENT_LIST), len(ELEMENT_LIST)), dtype=np.complex64)
+    freq = np.arange(1340, 1340 + CODIF_CHANNELS_IN_BLOCK)
+    fillup_acm(acm, ELEMENT_LIST, freq, out=PackedACM(N_ELEMENTS, (1+CODIF_CHANNELS_IN_BLOCK, PAF_N_FREQ_GROUP)))
+    return {"frames" : 1}
+
+# Benchmarked stages in order of the processing chain
+STAGES = OrderedDict([
+    ("header", bench_header),
+    ("payload", bench_payload),
+    ("next_frame", bench_next_frame),
+    ("compute_acm", bench_compute_acm),
+    ("compute_acm_prefetched", bench_compute_acm_prefetched),
+    ("compute_acm_complex64", bench_compute_acm_complex64),
+    ("fillup_acm", bench_fillup_acm)])
+# Stages reading the files in batches, which supports only 'dada' files
+DADA_STAGES = ["compute_acm_prefetched", "compute_acm_complex64"]
+
+
+def run_stage(name, files, nelements, npackets, type, queue):
+    # Progress messages of the stages would distort the timing
+    sys.stdout = open(os.devnull, "w")
+    try:
+        start = time.time()
+        result = STAGES[name](files, nelements, npackets, type)
+        result["seconds"] = time.time() - start
+        result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except Exception:
+        # The parent raises the error of the stage
+        result = {"error" : traceback.format_exc()}
+    queue.put(result)
+
+def measure(name, files, nelements, npackets, type="dada", poll=1.0):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_stage, args=(name, files, nelements, npackets, type, queue))
+    process.start()
+    result = None
+    while result is None:
+        try:
+            result = queue.get(timeout=poll)
+        except Empty:
+            # A stage which was killed (e.g. out of memory) never sends a result
+            if not process.is_alive() and queue.empty():
+                raise RuntimeError("Stage " + name + " terminated with exit code " + str(process.exitcode))
+    process.join()
+    if "error" in result:
+        raise RuntimeError("Stage " + name + " failed:\n" + result["error"])
+    seconds = max(result["seconds"], 1e-9)
+    result["packets_per_s"] = result.get("packets", 0) / seconds
+    result["mb_per_s"] = result.get("bytes", 0) / seconds / 1e6
+    result["frames_per_s"] = result.get("frames", 0) / seconds
+    return result
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def throughput(result):
+    # Compare runs of different size by their throughput, stages without data by their time
+    if result.get("bytes"):
+        return result["mb_per_s"]
+    if result.get("frames"):
+        return result["frames_per_s"]
+    return 1 / max(result["seconds"], 1e-9)
+
+def print_results(results, reference=None):
+    print("{:<24}{:>10}{:>14}{:>10}{:>12}{:>12}{:>10}".format("Stage", "Time [s]", "Packets/s", "MB/s", "Frames/s", "Peak RSS", "Speedup"))
+    for name, r in results.items():
+        speedup = ""
+        if reference and name in reference:
+            speedup = "{:.2f}x".format(throughput(r) / throughput(reference[name]))
+        print("{:<24}{:>10.3f}{:>14.1f}{:>10.2f}{:>12.1f}{:>10.1f}MB{:>10}".format(name,
+            r["seconds"], r["packets_per_s"], r["mb_per_s"], r["frames_per_s"], r["peak_rss_mb"], speedup))
+
+
+if __name__ == '__main__':
+    ##############################
+    # Start of arguments parsing #
+    ##############################
+    parser = argparse.ArgumentParser(description='options', formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--dir', '-d', action = "store", default = "", dest = "dir", help = "Root folder of a snapshot. If not passed, synthetic data are generated in a temporary folder")
+    parser.add_argument('--keep', '-k', action = "store_true", dest = "keep", help = "Keep the generated data")
+    parser.add_argument('--type', '-ty', action = "store", default="dada", dest = "type", help = "Generate and read 'dada' or 'pcap' files. The stages " + ", ".join(DADA_STAGES) + " support only 'dada' files")
+    parser.add_argument('--nelements', '-n', action = "store", default=36, dest="nelements", help="Number of beams (elements)")
+    parser.add_argument('--nnodes', '-nn', action = "store", default=1, dest="nnodes", help="Number of numa nodes / freq groups")
+    parser.add_argument('--duration', '-t', action = "store", default=0.1, dest="duration", help="Duration of the synthetic snapshot in seconds")
+    parser.add_argument('--file_size', '-fs', action = "store", default=10000, dest="file_size", help="Packets per file")
+    parser.add_argument('--loss', '-l', action = "store", default=0.0, dest="loss", help="Fraction of lost packets")
+    parser.add_argument('--zeroed', '-z', action = "store", default=0.0, dest="zeroed", help="Fraction of zeroed packets")
+    parser.add_argument('--reorder', '-r', action = "store", default=0.0, dest="reorder", help="Fraction of reordered packets")
+    parser.add_argument('--packets', '-p', action = "store", default=20000, dest="packets", help="Packets used for the header and payload stages")
+    parser.add_argument('--stages', '-s', action = "store", default=",".join(STAGES.keys()), dest="stages", help="Comma separated list of stages: " + ", ".join(STAGES.keys()))
+    parser.add_argument('--output', '-o', action = "store", default="", dest="output", help="Store results in this JSON file")
+    parser.add_argument('--compare', '-c', action = "store", default="", dest="compare", help="JSON file of a previous run to compare with")
+    # Assign arguments to variables for readability
+    args = parser.parse_args()
+    nelements = int(args.nelements)
+    npackets = int(args.packets)
+    stages = args.stages.split(',')
+    type = args.type
+    if type not in ("dada", "pcap"):
+        parser.error("Unknown file type " + type + ", use 'dada' or 'pcap'")
+    ##############################
+    #  End of arguments parsing  #
+    ##############################
+
+    # 1. Generate synthetic data
+    config = {"nelements" : nelements, "nnodes" : int(args.nnodes), "duration" : float(args.duration),
+        "file_size" : int(args.file_size), "loss" : float(args.loss), "zeroed" : float(args.zeroed),
+        "reorder" : float(args.reorder), "packets" : npackets, "type" : type}
+    root = args.dir
+    if root == "":
+        root = tempfile.mkdtemp(prefix="codif_bench_")
+        snapshot = SyntheticSnapshot(root, nbeams=nelements,
+            freq_groups=[1148 + CODIF_CHANNELS_IN_BLOCK*i for i in range(config["nnodes"])],
+            duration=config["duration"], file_size=config["file_size"], loss=config["loss"],
+            zeroed=config["zeroed"], reorder=config["reorder"])
+        print("Generating synthetic snapshot in " + root)
+        snapshot.write(type)
+    files = get_file_list(check_slash(root) + "numa0/", "*." + type)
+
+    # 2. Run stages
+    results = OrderedDict()
+    try:
+        for name in stages:
+            if name not in STAGES:
+                raise ValueError("Unknown stage " + name)
+            if type != "dada" and name in DADA_STAGES:
+                print("Skipping stage " + name + ", it supports only 'dada' files")
+                continue
+            print("Running stage " + name)
+            results[name] = measure(name, files, nelements, npackets, type)
+    finally:
+        if args.dir == "" and not args.keep:
+            shutil.rmtree(root)
+
+    # 3. Print, compare and store
+    reference = None
+    if args.compare:
+        with open(args.compare) as f:
+            compared = json.load(f)
+        reference = compared["stages"]
+        print("Compared to commit " + compared["commit"])
+    print_results(results, reference)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"commit" : git_commit(), "time" : time.strftime("%Y-%m-%d %H:%M:%S"),
+                "config" : config, "stages" : results}, f, indent=4)
+        print("Saved results to " + args.output)
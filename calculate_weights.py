@@ -195,6 +195,9 @@ if __name__ == '__main__':
     weights_xy = normalize(weights_xy)
     y_factor_xy = calc_y_factor(weights_xy, acm_source, acm_noise)
     t_sys_xy = calc_t_sys(y_factor_xy, flux)
+    # Weights are applied to raw voltages by beamform.py
+    np.savez(odir + "weights.npz", freq=freq, x=weights_x, y=weights_y, xy=weights_xy, element_list=ELEMENT_LIST)
+    print("Saved weights to " + odir + "weights.npz")
 
     #############
     # Plots     #
@@ -40,16 +40,27 @@ Program flow
 ------------
     0. Parse user arguments
     1. Setup necessary numpy arrays
-    2. Get and read all files of a numa node or a subfrequency group (7MHz), respectivly, by using CodifHandler object
-    3. Compute ACM data from frequency group and assign the data to array (8,48,192,192) as expected from the HDF5 structure
+    2. Get and read all files of a numa node or a subfrequency group (7MHz), respectivly, by using CodifHandler object.
+       Number of elements, channel frequencies and the optional time range are derived from the DADA headers
+    3. Compute ACM data from frequency group and assign the data to array (8,48,192,192) as expected from the HDF5 structure.
+       Only the upper triangles of the Hermitian ACMs of the recorded ports (ELEMENT_LIST) are kept (SparseACM, PackedACM)
+       The state of every node is saved to a checkpoint at intervals and after every file (--checkpoint). With --resume
+       finished nodes are not read again and interrupted nodes continue at the saved position. Checkpoints saved with other
+       files, elements, correlator, time range or spectral kurtosis settings are discarded.
+       With --cache the partial ACM of every file is cached, files with cached partial ACMs are not read again
+       With --sk_frames the spectral kurtosis of every element and channel is tested per block of frames, flagged
+       blocks are excluded from the ACM with --sk_exclude. The flagged fractions are stored in ACMflagFraction
     4. Jump back to 2. and iterate over all desired frequency groups / numa nodes
     5. Create a frequency list
     6. Create a dictionary containg all computed and passed data, which has the structure of the HDF5 file
-    7. Create HDF5 file, write information of dictionary to HDF5 file and close it
+    7. Create HDF5 file, write information of dictionary to HDF5 file and close it. The ACMs are expanded to
+       the full form slice by slice while writing, or only the recorded ports are stored (--sparse). Checkpoints are removed
 '''
 # Included modules
 import argparse
 import glob
+import os
+import shutil
 import numpy as np
 from argparse import RawTextHelpFormatter
 
@@ -57,6 +68,10 @@ from argparse import RawTextHelpFormatter
 from inc.codif import *
 from inc.utils import *
 from inc.acm_hdf5 import *
+from inc.packed import PackedACM, SparseACM
+from inc.checkpoint import Checkpoint
+from inc.cache import ACMCache
+from inc.profiling import StageProfiler, clock, report
 
 
 if __name__ == '__main__':
@@ -68,7 +83,7 @@ if __name__ == '__main__':
     parser.add_argument('--dir', '-d', action = "store", default = "/beegfsEDD/NESSER/PAF-12-2020/2020-12-09/2020-12-09-15:57:51/", dest = "dir", help = "Path to root folder")
     parser.add_argument('--output_dir', '-o', action = "store", default="", dest="odir", help = "Directory + filename for storage of the generated ACM file .")
     parser.add_argument('--sbid', '-i', action = "store", default=9999, dest="sbid", help="Observation ID ")
-    parser.add_argument('--nelements', '-n', action = "store", default=36, dest="nelements", help="Number of dual-polarized antenna elements. By default it is set to 36 which is the maximum .")
+    parser.add_argument('--nelements', '-n', action = "store", default="", dest="nelements", help="Number of dual-polarized antenna elements. By default it is read from the DADA header (NBEAM), or set to 36 which is the maximum .")
     parser.add_argument('--nnodes', '-nn', action = "store", default=16, dest="nnodes", help="Number of nodes. If set to N all folders between numa0 and numaN are read. If not set all subfolders are read")
     parser.add_argument('--antenna', '-at', action = "store", default=1, dest="antenna", help="Antenna ID. Always set to 1")
     parser.add_argument('--site', '-st', action = "store", default='pk ', dest="site", help="Name of ")
@@ -83,11 +98,29 @@ if __name__ == '__main__':
     parser.add_argument('--raJ2000', '-rj', action = "store", default=316.757, dest="raj2000", help="Center frequency")
     parser.add_argument('--rollAngle', '-ra', action = "store", default=90.0, dest="roll_angle", help="Roll angle ")
     parser.add_argument('--on_source', '-on', action = "store", default=1, dest="on_source", help="0: off-source observation, 1: on-source observation")
+    parser.add_argument('--profile', '-pr', action = "store", default="", dest="profile", help="Record time per processing stage. Pass 'summary' to print a table or a '.json' file to also store a Chrome trace")
+    parser.add_argument('--prefetch', '-pf', action = "store", default=128, dest="prefetch", help="Size of the prefetch buffers in MB. Files are read on a background thread while the previous buffer is correlated. 0 reads packet by packet")
+    parser.add_argument('--start_time', '-ts', action = "store", default="", dest="start_time", help="Seconds after UTC_START of the first integrated packet. The position is computed from the DADA header")
+    parser.add_argument('--stop_time', '-te', action = "store", default="", dest="stop_time", help="Seconds after UTC_START of the last integrated packet. The position is computed from the DADA header")
+    parser.add_argument('--correlator', '-co', action = "store", default="integer", dest="correlator", help="Correlator of the prefetch path: 'integer' accumulates exactly in int64, 'complex64' in single precision")
+    parser.add_argument('--max_open', '-mo', action = "store", default=64, dest="max_open", help="Maximum number of files which are open at the same time")
+    parser.add_argument('--checkpoint', '-ck', action = "store", default=60.0, dest="checkpoint", help="Seconds between two checkpoints of the partial ACM of a node (stored in <output>.checkpoint/). 0 disables checkpoints")
+    parser.add_argument('--resume', '-re', action = "store_true", dest="resume", help="Continue an interrupted conversion from its checkpoints. Finished nodes are not read again")
+    parser.add_argument('--cache', '-ca', action = "store", default="", dest="cache", help="Directory of a cache of per-file partial ACMs. Repeated conversions of the same files with the same settings only merge cached ACMs")
+    parser.add_argument('--cache_size', '-cs', action = "store", default=10.0, dest="cache_size", help="Maximum size of the cache in GB. The least recently used partial ACMs are removed")
+    parser.add_argument('--sparse', '-sp', action = "store_true", dest="sparse", help="Store only the ACMs of the recorded ports (ELEMENT_LIST) and their port numbers (dataset ACMports) instead of N_ELEMENTS x N_ELEMENTS")
+    parser.add_argument('--sk_frames', '-sk', action = "store", default=0, dest="sk_frames", help="Frames per block of the spectral kurtosis RFI test. 0 disables the test")
+    parser.add_argument('--sk_threshold', '-skt', action = "store", default=3.0, dest="sk_threshold", help="A block fails the spectral kurtosis test if |SK - 1| exceeds the passed number of standard deviations")
+    parser.add_argument('--sk_fraction', '-skf', action = "store", default=0.1, dest="sk_fraction", help="A block is flagged if more than the passed fraction of the elements and polarizations of a channel fail the test")
+    parser.add_argument('--sk_exclude', '-skx', action = "store_true", dest="sk_exclude", help="Exclude flagged blocks from the ACM of the affected channel. Otherwise blocks are only counted")
+    parser.add_argument('--max_flagged', '-mf', action = "store", default=0.5, dest="max_flagged", help="Frequencies with a larger fraction of flagged frames get ACMstatus 2 (RFI)")
+    parser.add_argument('--direct', '-di', action = "store_true", dest="direct", help="Read files with O_DIRECT, bypassing the page cache. Falls back to buffered reads if the filesystem does not support it")
+    parser.add_argument('--progress_rate', '-pg', action = "store", default=2.0, dest="progress_rate", help="Maximum number of progress updates per second (0 disables the progress output)")
     # Assign arguments to variables for readability
     fname = parser.parse_args().fname
     idir = parser.parse_args().dir
     odir = parser.parse_args().odir
-    nelements = int(parser.parse_args().nelements)
+    nelements = int(parser.parse_args().nelements) if parser.parse_args().nelements else None
     nnodes = int(parser.parse_args().nnodes)
     antenna = parser.parse_args().antenna
     site = parser.parse_args().site
@@ -103,53 +136,92 @@ if __name__ == '__main__':
     raj2000 = parser.parse_args().raj2000
     roll_angle = parser.parse_args().roll_angle
     on_source = parser.parse_args().on_source
+    profile = parser.parse_args().profile
+    progress_rate = float(parser.parse_args().progress_rate)
+    prefetch = int(parser.parse_args().prefetch)
+    direct = parser.parse_args().direct
+    sparse = parser.parse_args().sparse
+    checkpoint_interval = float(parser.parse_args().checkpoint)
+    resume = parser.parse_args().resume
+    cache = ACMCache(parser.parse_args().cache, int(float(parser.parse_args().cache_size)*1024**3)) if parser.parse_args().cache else None
+    max_open = int(parser.parse_args().max_open)
+    sk_frames = int(parser.parse_args().sk_frames)
+    sk = {"frames" : sk_frames, "threshold" : float(parser.parse_args().sk_threshold), "fraction" : float(parser.parse_args().sk_fraction),
+        "exclude" : parser.parse_args().sk_exclude} if sk_frames > 0 else None
+    max_flagged = float(parser.parse_args().max_flagged)
+    correlator = parser.parse_args().correlator
+    start_time = float(parser.parse_args().start_time) if parser.parse_args().start_time else None
+    stop_time = float(parser.parse_args().stop_time) if parser.parse_args().stop_time else None
+    profiler = StageProfiler() if profile else None
     # Parse lowest frequency
     freq_low = fc - PAF_BANDWIDTH/2
     # Auto set output dir + filename if argument was not passed
     if odir == "":
         odir = "SB0" +str(sbid)+ ".pk01.acm.hdf5"
     check_dir(odir.rsplit('/',1)[0])
+    checkpoint_dir = odir + ".checkpoint/"
     ##############################
     #  End of arguments parsing  #
     ##############################
 
     # 1. Generate numpy array to store data
     freq_dict = {}
+    flag_dict = {}
     bandwidth = np.arange(freq_low, freq_low + PAF_BANDWIDTH)
-    flagged = np.ones((1+CODIF_CHANNELS_IN_BLOCK, PAF_N_FREQ_GROUP))
-    frames = np.zeros((1+CODIF_CHANNELS_IN_BLOCK, PAF_N_FREQ_GROUP), dtype="float") # Frames per cycle and frequency group
-    sky_frequency = np.zeros((1+CODIF_CHANNELS_IN_BLOCK, PAF_N_FREQ_GROUP), dtype="float") # All occuring frequencies with 1MHz bandwidth
-    acm = np.zeros((1+CODIF_CHANNELS_IN_BLOCK, PAF_N_FREQ_GROUP, N_ELEMENTS, N_ELEMENTS), dtype=np.complex64)  # Array to store ACM data
+    acm = SparseACM(ELEMENT_LIST, N_ELEMENTS, PackedACM(len(ELEMENT_LIST), (1+CODIF_CHANNELS_IN_BLOCK, PAF_N_FREQ_GROUP)))  # Array to store ACM data (upper triangles of the recorded ports)
     # 2. - 4. Iterate over each numa node / subfolder
     for id in range(0,nnodes):
         # 2. Get and read files
         dir = check_slash(idir) + "numa" + str(id) + "/"
         print("Working on subdirectory: " + dir)
         files = get_file_list(dir, fname + "*")
-        handler = CodifHandler(files)
-        # 3. Compute and fill up
-        acm_data, freq, frame_cnt = handler.compute_acm(nelements)
+        checkpoint = None
+        if checkpoint_interval > 0 or resume:
+            settings = {"files" : files, "nelements" : nelements, "correlator" : correlator, "start_time" : start_time, "stop_time" : stop_time, "sk" : sk}
+            checkpoint = Checkpoint(checkpoint_dir + "numa" + str(id) + ".npz", checkpoint_interval, resume, settings)
+        result = checkpoint.result() if checkpoint is not None else None
+        if result is not None:
+            print("Node already finished, using checkpoint " + checkpoint.fname)
+            acm_data, freq, frame_cnt = result
+            rfi = checkpoint.extra()
+        else:
+            handler = CodifHandler(files, direct=direct, max_open=max_open)
+            # 3. Compute and fill up
+            acm_data, freq, frame_cnt = handler.compute_acm(nelements, profiler=profiler, progress_rate=progress_rate, prefetch=prefetch,
+                start_time=start_time, stop_time=stop_time, correlator=correlator, checkpoint=checkpoint, cache=cache, sk=sk)
+            rfi = {}
+            if handler.sk is not None:
+                channel_frames = frame_cnt - handler.sk.flagged_frames if handler.sk.exclude else np.full(len(freq), frame_cnt)
+                rfi = {"flag_fraction" : handler.sk.flag_fraction(), "channel_frames" : channel_frames}
+                print("Flagged frames per channel: " + ", ".join("{:.1f}%".format(100*value) for value in rfi["flag_fraction"]))
+            if checkpoint is not None:
+                checkpoint.finish(acm_data, freq, frame_cnt, rfi)
         if frame_cnt > 10:
-            for f in freq:
-                freq_dict[str(f)] = frame_cnt
-            acm += fillup_acm(acm_data, ELEMENT_LIST, freq)
+            for idx, f in enumerate(freq):
+                # Excluded blocks are not counted as integrated frames
+                freq_dict[str(f)] = int(rfi["channel_frames"][idx]) if "channel_frames" in rfi else frame_cnt
+                if "flag_fraction" in rfi:
+                    flag_dict[str(f)] = float(rfi["flag_fraction"][idx])
+            fillup_acm(acm_data, ELEMENT_LIST, freq, out=acm)
 
 
-    # 5. Create a frequency list
-    for idx in range(1+CODIF_CHANNELS_IN_BLOCK):
-        sky_frequency[idx, :] = np.arange(freq_low + idx, freq_low + PAF_BANDWIDTH, 8)
-    for key, value in freq_dict.items():
-        pos = np.argwhere(sky_frequency==float(key))
-        frames[pos[0,0], pos[0,1]] = value
-        flagged[pos[0,0], pos[0,1]] = 0
-        # print(sky_frequency[pos[0,0], pos[0,1]])
+    # 5. Create a frequency list, frames per cycle and frequency group and flags of not computed frequencies
+    sky_frequency, frames, flagged = frequency_table(freq_dict, freq_low)
+    flag_fraction = flag_table(flag_dict, sky_frequency, flagged, max_flagged) if sk is not None else None
 
+    if profiler is not None:
+        tstamp = clock()
     # 6. Generate the dictionary depending on all user arguments and computete results
     dictionary = data_to_dict(acm, sky_frequency, frames, flagged=flagged, odir=odir, antenna=antenna, \
         sbid=sbid, site=site, schedulingblock=schedulingblock, band=band, fc=fc, \
         comment=comment, azimuth=azimuth, elevation=elevation, bat=bat, \
-        decj2000=decj2000, raj2000=raj2000, roll_angle=roll_angle, on_source=on_source)
+        decj2000=decj2000, raj2000=raj2000, roll_angle=roll_angle, on_source=on_source, sparse=sparse, flag_fraction=flag_fraction)
     # 7. Create, write and close
     acm_file = ACMFile(odir, 'w')
     acm_file.create_from_dict(dictionary)
     acm_file.close()
+    if os.path.isdir(checkpoint_dir):
+        shutil.rmtree(checkpoint_dir)
+    if profiler is not None:
+        profiler.add("output", tstamp)
+        report(profiler, profile)
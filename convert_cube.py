@@ -0,0 +1,92 @@
+'''
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+
+Description
+-----------
+    Converts the packets of a snapshot into a chunked and compressed voltage cube
+    (time x element x channel x pol) in HDF5 (see inc/cube.py). Per-element and per-channel
+    analyses of the cube read only a fraction of the raw data, e.g.
+
+        from inc.cube import CubeReader
+        with CubeReader("results/cube.hdf5") as cube:
+            acm, freq, frames = cube.compute_acm(0, channels=[3])
+            voltage = cube.samples("numa1", 0, 1024**2, elements=[5])
+
+Preliminaries
+-------------
+    The script expects the folder structure of convert.py, sub-folders have the name 'numa' + ID
+Program flow
+------------
+    0. Parse user arguments
+    1. Collect the files of all numa nodes, one CodifHandler handles all nodes (one stream per node)
+    2. Read every node once, assemble frames and append them transposed to the cube
+    3. Write the frequencies of every node
+'''
+import argparse
+import os
+from argparse import RawTextHelpFormatter
+
+from inc.codif import *
+from inc.utils import *
+from inc.cube import VoltageCube
+from inc.profiling import StageProfiler, report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='options', formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--fname', '-f', action = "store", default = "*", dest = "fname", help = "Input filename expression. If not passed all files within a subfolder are read")
+    parser.add_argument('--dir', '-d', action = "store", default = "/beegfsEDD/NESSER/PAF-12-2020/2020-12-09/2020-12-09-15:57:51/", dest = "dir", help = "Path to root folder")
+    parser.add_argument('--output_dir', '-o', action = "store", default="results/", dest="odir", help = "Directory of all outputs")
+    parser.add_argument('--output', '-of', action = "store", default="cube.hdf5", dest="ofile", help = "Name of the HDF5 file within the output directory")
+    parser.add_argument('--nnodes', '-nn', action = "store", default=16, dest="nnodes", help="Number of nodes. All folders between numa0 and numaN are read")
+    parser.add_argument('--nelements', '-n', action = "store", default="", dest="nelements", help="Number of dual-polarized antenna elements. By default it is read from the DADA header (NBEAM), or set to 36")
+    parser.add_argument('--chunk', '-ch', action = "store", default=16384, dest="chunk", help="Number of samples per HDF5 chunk (rounded to complete frames of 128 samples)")
+    parser.add_argument('--compression', '-cz', action = "store", default="gzip", dest="compression", help="HDF5 compression filter, e.g. 'gzip', 'lzf' or 'none'")
+    parser.add_argument('--start_time', '-t0', action = "store", default="", dest="start_time", help="Seconds since UTC_START of the first converted packet (default beginning of the snapshot)")
+    parser.add_argument('--stop_time', '-t1', action = "store", default="", dest="stop_time", help="Seconds since UTC_START of the last converted packet (default end of the snapshot)")
+    parser.add_argument('--prefetch', '-pf', action = "store", default=128, dest="prefetch", help="Size of the prefetch buffers in MB")
+    parser.add_argument('--max_open', '-mo', action = "store", default=64, dest="max_open", help="Maximum number of files which are open at the same time")
+    parser.add_argument('--direct', '-di', action = "store_true", dest="direct", help="Read files with O_DIRECT, bypassing the page cache. Falls back to buffered reads if the filesystem does not support it")
+    parser.add_argument('--profile', '-pr', action = "store", default="", dest="profile", help="Record time per processing stage. Pass 'summary' to print a table or a '.json' file to also store a Chrome trace")
+    parser.add_argument('--progress_rate', '-pg', action = "store", default=2.0, dest="progress_rate", help="Maximum number of progress updates per second (0 disables the progress output)")
+    fname = parser.parse_args().fname
+    idir = parser.parse_args().dir
+    odir = check_slash(parser.parse_args().odir)
+    ofile = parser.parse_args().ofile
+    nnodes = int(parser.parse_args().nnodes)
+    nelements = int(parser.parse_args().nelements) if parser.parse_args().nelements else None
+    chunk = int(parser.parse_args().chunk)
+    compression = parser.parse_args().compression
+    compression = None if compression in ("", "none") else compression
+    start_time = float(parser.parse_args().start_time) if parser.parse_args().start_time else None
+    stop_time = float(parser.parse_args().stop_time) if parser.parse_args().stop_time else None
+    prefetch = int(parser.parse_args().prefetch)
+    max_open = int(parser.parse_args().max_open)
+    direct = parser.parse_args().direct
+    profile = parser.parse_args().profile
+    progress_rate = float(parser.parse_args().progress_rate)
+    profiler = StageProfiler() if profile else None
+    if not os.path.isdir(odir):
+        os.makedirs(odir)
+
+    # 1. Files of all nodes
+    file_list = []
+    for id in range(nnodes):
+        file_list += get_file_list(check_slash(idir) + "numa" + str(id) + "/", fname + "*")
+    handler = CodifHandler(file_list, direct=direct, max_open=max_open)
+    nelements, freq = handler.configure(nelements)
+
+    # 2. One pass over all nodes
+    cube = VoltageCube(odir + ofile, nelements, chunk, compression)
+    handler.process([cube], nelements, profiler=profiler, progress_rate=progress_rate, prefetch=prefetch, start_time=start_time, stop_time=stop_time)
+
+    # 3. Outputs
+    headers = [stream.files[0].metadata() for stream in handler.streams]
+    freqs = [header.channel_frequencies() if header is not None else None for header in headers]
+    frames = sum([assembler.frame_cnt for assembler in cube.assemblers.values()])
+    dropped = sum([assembler.uncomplete_cnt for assembler in cube.assemblers.values()])
+    cube.save(handler.streams, freqs, handler.numa_list)
+    print("Saved " + str(frames) + " frames to " + odir + ofile + ", dropped incomplete frames: " + str(dropped))
+    if profiler is not None:
+        report(profiler, profile)
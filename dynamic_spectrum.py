@@ -0,0 +1,133 @@
+'''
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+
+Description
+-----------
+    Fast health check of a snapshot. Only the power |x|^2 of every element, channel and
+    polarization is computed (no ACM), averaged in time bins and written as dynamic spectrum
+    (waterfall) into a chunked HDF5 file (see inc/dynamic_spectrum.py). All numa nodes are read
+    once. Optionally quicklook plots of the bandpasses and the waterfall of the mean power of all
+    elements are stored.
+
+Preliminaries
+-------------
+    The script expects the folder structure of convert.py, sub-folders have the name 'numa' + ID
+Program flow
+------------
+    0. Parse user arguments
+    1. Collect the files of all numa nodes, one CodifHandler handles all nodes (one stream per node)
+    2. Read every node once and append the time bins to the HDF5 file
+    3. Write frequencies and bandpasses, plot quicklooks
+'''
+import argparse
+import os
+import numpy as np
+import h5py
+import matplotlib.pyplot as plt
+from argparse import RawTextHelpFormatter
+
+from inc.codif import *
+from inc.utils import *
+from inc.dynamic_spectrum import DynamicSpectrum
+from inc.profiling import StageProfiler, report
+
+
+def quicklook(fname, odir):
+    """
+    Description:
+    ------------
+        Plots the bandpass of every element (x- and y-pol) over all nodes and the waterfall
+        of the mean power of all elements
+    """
+    with h5py.File(fname, "r") as f:
+        groups = sorted([f[name] for name in f], key=lambda group: group["freq"][0])
+        freq = np.concatenate([group["freq"][:] for group in groups])
+        bandpass = np.concatenate([group["bandpass"][:] for group in groups])
+        start = min([group["time"][0] for group in groups if len(group["time"])])
+        stop = max([group["time"][-1] for group in groups if len(group["time"])])
+        resolution = f.attrs["resolution"]
+        nbins = int(round((stop - start) / resolution)) + 1
+        waterfall = np.full((nbins, len(freq)), np.nan)
+        col = 0
+        for group in groups:
+            nchan = len(group["freq"])
+            rows = np.round((group["time"][:] - start) / resolution).astype(int)
+            waterfall[rows, col:col+nchan] = group["power"][:].mean(axis=(2, 3))
+            col += nchan
+    fig, sub = plt.subplots(1, 2, figsize=(14, 6))
+    for pol in range(bandpass.shape[-1]):
+        sub[pol].plot(freq, 10*np.log10(np.maximum(bandpass[:, :, pol], 1e-12)), ".-", linewidth=0.5)
+        sub[pol].set_title("Bandpass pol " + str(pol))
+        sub[pol].set_xlabel("Frequency [MHz]")
+        sub[pol].set_ylabel("Power [dB]")
+    plt.savefig(odir + "bandpass.png")
+    plt.close(fig)
+    fig = plt.figure(figsize=(10, 6))
+    plt.imshow(10*np.log10(np.maximum(waterfall, 1e-12)), aspect="auto", origin="lower", interpolation="nearest",
+        extent=[freq[0], freq[-1], 0, nbins * resolution])
+    plt.colorbar(label="Power [dB]")
+    plt.xlabel("Frequency [MHz]")
+    plt.ylabel("Time [s]")
+    plt.savefig(odir + "waterfall.png")
+    plt.close(fig)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='options', formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--fname', '-f', action = "store", default = "*", dest = "fname", help = "Input filename expression. If not passed all files within a subfolder are read")
+    parser.add_argument('--dir', '-d', action = "store", default = "/beegfsEDD/NESSER/PAF-12-2020/2020-12-09/2020-12-09-15:57:51/", dest = "dir", help = "Path to root folder")
+    parser.add_argument('--output_dir', '-o', action = "store", default="results/", dest="odir", help = "Directory of all outputs")
+    parser.add_argument('--output', '-of', action = "store", default="dynamic_spectrum.hdf5", dest="ofile", help = "Name of the HDF5 file within the output directory")
+    parser.add_argument('--nnodes', '-nn', action = "store", default=16, dest="nnodes", help="Number of nodes. All folders between numa0 and numaN are read")
+    parser.add_argument('--nelements', '-n', action = "store", default="", dest="nelements", help="Number of dual-polarized antenna elements. By default it is read from the DADA header (NBEAM), or set to 36")
+    parser.add_argument('--resolution', '-r', action = "store", default=1.0, dest="resolution", help="Time resolution of the dynamic spectrum in seconds")
+    parser.add_argument('--chunk', '-ch', action = "store", default=64, dest="chunk", help="Number of time bins per HDF5 chunk")
+    parser.add_argument('--compression', '-cz', action = "store", default="", dest="compression", help="HDF5 compression filter, e.g. 'gzip' or 'lzf' (default uncompressed)")
+    parser.add_argument('--plot', '-pl', action = "store_true", dest="plot", help="Store quicklook plots (bandpass.png, waterfall.png) in the output directory")
+    parser.add_argument('--prefetch', '-pf', action = "store", default=128, dest="prefetch", help="Size of the prefetch buffers in MB")
+    parser.add_argument('--max_open', '-mo', action = "store", default=64, dest="max_open", help="Maximum number of files which are open at the same time")
+    parser.add_argument('--direct', '-di', action = "store_true", dest="direct", help="Read files with O_DIRECT, bypassing the page cache. Falls back to buffered reads if the filesystem does not support it")
+    parser.add_argument('--profile', '-pr', action = "store", default="", dest="profile", help="Record time per processing stage. Pass 'summary' to print a table or a '.json' file to also store a Chrome trace")
+    parser.add_argument('--progress_rate', '-pg', action = "store", default=2.0, dest="progress_rate", help="Maximum number of progress updates per second (0 disables the progress output)")
+    fname = parser.parse_args().fname
+    idir = parser.parse_args().dir
+    odir = check_slash(parser.parse_args().odir)
+    ofile = parser.parse_args().ofile
+    nnodes = int(parser.parse_args().nnodes)
+    nelements = int(parser.parse_args().nelements) if parser.parse_args().nelements else None
+    resolution = float(parser.parse_args().resolution)
+    chunk = int(parser.parse_args().chunk)
+    compression = parser.parse_args().compression or None
+    plot = parser.parse_args().plot
+    prefetch = int(parser.parse_args().prefetch)
+    max_open = int(parser.parse_args().max_open)
+    direct = parser.parse_args().direct
+    profile = parser.parse_args().profile
+    progress_rate = float(parser.parse_args().progress_rate)
+    profiler = StageProfiler() if profile else None
+    if not os.path.isdir(odir):
+        os.makedirs(odir)
+
+    # 1. Files of all nodes
+    file_list = []
+    for id in range(nnodes):
+        file_list += get_file_list(check_slash(idir) + "numa" + str(id) + "/", fname + "*")
+    handler = CodifHandler(file_list, direct=direct, max_open=max_open)
+    nelements, freq = handler.configure(nelements)
+
+    # 2. One pass over all nodes
+    spectrum = DynamicSpectrum(odir + ofile, nelements, resolution, chunk, compression)
+    handler.process([spectrum], nelements, profiler=profiler, progress_rate=progress_rate, prefetch=prefetch)
+
+    # 3. Outputs
+    headers = [stream.files[0].metadata() for stream in handler.streams]
+    freqs = [header.channel_frequencies() if header is not None else None for header in headers]
+    spectrum.save(handler.streams, freqs, handler.numa_list)
+    print("Saved dynamic spectrum to " + odir + ofile + ", packets of already written bins: " + str(spectrum.late_cnt)
+        + ", packets of isolated groups (corrupt headers): " + str(spectrum.outlier_cnt))
+    if plot:
+        quicklook(odir + ofile, odir)
+        print("Saved quicklooks to " + odir + "bandpass.png and " + odir + "waterfall.png")
+    if profiler is not None:
+        report(profiler, profile)
@@ -0,0 +1,89 @@
+'''
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+
+Description
+-----------
+    This script cuts a part out of a snapshot, e.g. to share or debug a few seconds of data.
+    Packets are selected by a time range (seconds since UTC_START), a set of beam_ids and the
+    freq_group and written into new '.dada' files (original DADA header with updated FILE_SIZE,
+    OBS_OFFSET, NBEAM) or '.pcap' files (see CodifFile.write()). Contiguous runs of packets are
+    copied within the kernel, thus extracts are created at disk speed.
+
+Preliminaries
+-------------
+    The script expects the folder structure of convert.py, sub-folders have the name 'numa' + ID.
+    The extract has the same structure below the output directory.
+Program flow
+------------
+    0. Parse user arguments
+    1. Collect the files of the selected numa nodes, files outside of the time range are skipped
+    2. Write the selected packets of every file
+'''
+import argparse
+import os
+from argparse import RawTextHelpFormatter
+
+from inc.codif import *
+from inc.utils import *
+
+
+def parse_ranges(value):
+    # "0-3,8" -> [0, 1, 2, 3, 8]
+    items = []
+    for part in value.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            items += range(int(first), int(last) + 1)
+        elif part:
+            items.append(int(part))
+    return items
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='options', formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--fname', '-f', action = "store", default = "*", dest = "fname", help = "Input filename expression. If not passed all files within a subfolder are read")
+    parser.add_argument('--dir', '-d', action = "store", default = "/beegfsEDD/NESSER/PAF-12-2020/2020-12-09/2020-12-09-15:57:51/", dest = "dir", help = "Path to root folder")
+    parser.add_argument('--output_dir', '-o', action = "store", default="extract/", dest="odir", help = "Root folder of the extract")
+    parser.add_argument('--nodes', '-nd', action = "store", default="0-15", dest="nodes", help="numa IDs to extract, e.g. '0-3,8'")
+    parser.add_argument('--start', '-t0', action = "store", default="", dest="start", help="Start of the time range in seconds since UTC_START")
+    parser.add_argument('--stop', '-t1', action = "store", default="", dest="stop", help="End of the time range in seconds since UTC_START")
+    parser.add_argument('--beams', '-b', action = "store", default="", dest="beams", help="beam_ids to keep, e.g. '0-3,8' (default all)")
+    parser.add_argument('--freq_group', '-g', action = "store", default="", dest="freq_group", help="freq_group to keep (default all)")
+    parser.add_argument('--type', '-t', action = "store", default="dada", dest="type", help="Output format 'dada' or 'pcap'")
+    fname = parser.parse_args().fname
+    idir = check_slash(parser.parse_args().dir)
+    odir = check_slash(parser.parse_args().odir)
+    nodes = parse_ranges(parser.parse_args().nodes)
+    start = float(parser.parse_args().start) if parser.parse_args().start else None
+    stop = float(parser.parse_args().stop) if parser.parse_args().stop else None
+    beams = parse_ranges(parser.parse_args().beams) if parser.parse_args().beams else None
+    freq_group = int(parser.parse_args().freq_group) if parser.parse_args().freq_group else None
+    type = parser.parse_args().type
+
+    total = 0
+    for node in nodes:
+        # 1. Files of a node, files which do not overlap the time range are skipped by their DADA header
+        files = get_file_list(idir + "numa" + str(node) + "/", fname + "*")
+        if not files:
+            continue
+        if not os.path.isdir(odir + "numa" + str(node)):
+            os.makedirs(odir + "numa" + str(node))
+        for f in files:
+            file = CodifFile(f, lazy=True)
+            header = file.metadata()
+            if header is not None and header.bytes_per_second:
+                # One second of margin, the header times assume a lossless recording
+                if start is not None and header.time_of(file.npackets) < start - 1:
+                    continue
+                if stop is not None and header.time_of(0) > stop + 1:
+                    continue
+            # 2. Selected packets of the file
+            out = odir + "numa" + str(node) + "/" + os.path.splitext(os.path.basename(f))[0] + "." + type
+            npackets = file.write(out, start, stop, beams, freq_group, type)
+            if not npackets:
+                os.remove(out)
+                continue
+            total += npackets
+            print("Extracted " + str(npackets) + " packets of " + f + " to " + out)
+    print("Extracted " + str(total) + " packets")
@@ -29,10 +29,15 @@ from collections import OrderedDict
 
 from inc.constants import *
 from inc.utils import *
+from inc.packed import PackedACM, SparseACM, pack
 
+# Dataset listing the port of every row / column of ACMdata in files of sparse layout
+PORTS_DATASET = 'ACMports'
+# Fraction of frames flagged by the spectral kurtosis test (optional)
+FLAG_DATASET = 'ACMflagFraction'
 
 class ACMFile(h5py.File):
-    def __init__(self, name, mode='r', count_scale=True, acm_stats=True, **kwds):
+    def __init__(self, name, mode='r', count_scale=True, acm_stats=True, packed=False, **kwds):
         """
         Create a new read only acm.hdf5 File object inheriting from h5py.  See :meth:`h5py.File.__init__` for further
         options and the `h5py user guide`_ for a detailed explanation of the options.
@@ -58,6 +63,10 @@ class ACMFile(h5py.File):
                          =======  ================================================
 
         :param bool acm_stats: will calculate acm stats if True and write them to acmstats.hdf5 file
+        :param bool packed: keep only the upper triangles of the ACMs in memory (acm is a PackedACM), the
+                            file is read one measurement time at a time
+        Files of sparse layout (dataset ACMports) are loaded as SparseACM, indexing expands the selected
+        ACMs to N_ELEMENTS x N_ELEMENTS.
         .. _h5py User Guide: http://docs.h5py.org/en/latest/index.html
         """
         # write_modes = ['r+', 'w', 'w-', 'x', 'a']
@@ -88,7 +97,13 @@ class ACMFile(h5py.File):
         # if acm_stats:
         #    self.acmcheck = ACMcheck(self)
 
-        self.acm = acm = np.asarray(self[self.prefix + 'data'][...], dtype=np.complex64)
+        if packed:
+            acm = self.read_packed()
+        else:
+            acm = np.asarray(self[self.prefix + 'data'][...], dtype=np.complex64)
+        if PORTS_DATASET in self:
+            acm = SparseACM(self[PORTS_DATASET][...], N_ELEMENTS, acm)
+        self.acm = acm
         if self.count_scale:
             self.load_scale_acm()
 
@@ -106,7 +121,13 @@ class ACMFile(h5py.File):
             if val['kind'] == 'attribute':
                 self[group].attrs.create(name=key, data=val['value'], shape=val['space'], dtype=val['dtype'])
             elif val['kind'] == 'dataset':
-                self.create_dataset(key, shape=val['space'], dtype=val['dtype'], data=val['value'])
+                if isinstance(val['value'], (PackedACM, SparseACM)):
+                    # Expand packed / sparse ACMs one measurement time at a time instead of the whole array
+                    dset = self.create_dataset(key, shape=val['space'], dtype=val['dtype'])
+                    for idx in range(val['space'][0]):
+                        dset[idx] = val['value'].unpack(idx)
+                else:
+                    self.create_dataset(key, shape=val['space'], dtype=val['dtype'], data=val['value'])
 
                 if 'attributes' in val.keys():
                     self.create_from_dict(val['attributes'], key)
@@ -182,12 +203,28 @@ class ACMFile(h5py.File):
 
         return freq_dict
 
+    def read_packed(self):
+        """
+        Reads the ACM data one measurement time at a time and keeps only the upper triangles.
+
+        :return: ACMs of all measurement times and frequencies
+        :rtype: PackedACM
+        """
+        dset = self[self.prefix + 'data']
+        acm = PackedACM(dset.shape[-1], dset.shape[:-2], dtype=np.complex64)
+        for idx in range(dset.shape[0]):
+            acm.data[idx] = pack(np.asarray(dset[idx], dtype=np.complex64)).data
+        return acm
+
     def reshape_to_3d(self, element_list=ELEMENT_LIST, flagged=True):
         freq_dict = self.make_freq_ind_dict(flagged)
         freq = []
         data = [0 for __ in range(len(freq_dict))]
         for idx, (key, value) in enumerate(freq_dict.items()):
-            data[idx] = select_from_list(self.acm[value[0], value[1]], element_list)[0]
+            if isinstance(self.acm, (PackedACM, SparseACM)):
+                data[idx] = select_from_list(self.acm, element_list, (value[0], value[1]))[0]
+            else:
+                data[idx] = select_from_list(self.acm[value[0], value[1]], element_list)[0]
             freq.append(float(key))
 
         return np.asarray(data, dtype=np.complex64), np.asarray(freq)
@@ -463,7 +500,16 @@ class ACMFile(h5py.File):
         return odc_working, port_working, paf2odc_ratio_db_per_port
 
 # Added by Niclas Esser
-def data_to_dict(acm, sky_frequency, frames, flagged, odir="", antenna=1, sbid=9999, site='pk', schedulingblock=0, band='FILTER_1450', fc=1340, comment='No comment', azimuth=90.0, elevation=90.0, bat=5103284240024128, decj2000=42.2361, raj2000=316, roll_angle=90.0, on_source=1):
+def data_to_dict(acm, sky_frequency, frames, flagged, odir="", antenna=1, sbid=9999, site='pk', schedulingblock=0, band='FILTER_1450', fc=1340, comment='No comment', azimuth=90.0, elevation=90.0, bat=5103284240024128, decj2000=42.2361, raj2000=316, roll_angle=90.0, on_source=1, sparse=False, flag_fraction=None):
+    """
+    Builds the dictionary describing the HDF5 structure (see ACMFile.create_from_dict).
+    If sparse is True and acm is a SparseACM, ACMdata only contains the rows and columns of the active
+    ports and the dataset ACMports lists the port of every row.
+    If flag_fraction is passed, the dataset ACMflagFraction contains the fraction of frames flagged as RFI
+    per cycle and frequency (see inc/rfi.py).
+    """
+    sparse = sparse and isinstance(acm, SparseACM)
+    nports = len(acm.ports) if sparse else N_ELEMENTS
     acm_dict = {
         'antenna' : {
             'kind' : 'attribute',
@@ -501,8 +547,8 @@ def data_to_dict(acm, sky_frequency, frames, flagged, odir="", antenna=1, sbid=9
                 'names' : ['r', 'i'],
                 'formats' : ['<f4', '<f4']
              },
-            'space' : (1+CODIF_CHANNELS_IN_BLOCK, PAF_N_FREQ_GROUP, N_ELEMENTS, N_ELEMENTS),
-            'value' : acm,
+            'space' : (1+CODIF_CHANNELS_IN_BLOCK, PAF_N_FREQ_GROUP, nports, nports),
+            'value' : acm.data if sparse else acm,
             'attributes' : {
                 'DIMENSION_LABELS' : {
                     'kind' : 'attribute',
@@ -611,4 +657,18 @@ def data_to_dict(acm, sky_frequency, frames, flagged, odir="", antenna=1, sbid=9
         #     'value' : flagged,
         # }
     }
+    if flag_fraction is not None:
+        acm_dict[FLAG_DATASET] = {
+            'kind' : 'dataset',
+            'dtype' : 'float32',
+            'space' : (1+CODIF_CHANNELS_IN_BLOCK, PAF_N_FREQ_GROUP),
+            'value' : flag_fraction,
+        }
+    if sparse:
+        acm_dict[PORTS_DATASET] = {
+            'kind' : 'dataset',
+            'dtype' : 'int32',
+            'space' : (nports,),
+            'value' : acm.ports,
+        }
     return acm_dict
@@ -0,0 +1,328 @@
+"""
+ Description:
+ ------------
+    Vectorized decoding of CODIF packets.
+    Instead of parsing one packet after the other (see CodifPacket), a batch of packets is
+    passed as 2D numpy array of shape (packets, CODIF_PACKET_SIZE). Header words and payload
+    are exposed as views of the batch, thus no data are copied until complete frames are
+    gathered by the FrameAssembler.
+
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+"""
+
+from __future__ import division
+import numpy as np
+
+from inc.constants import *
+
+# Layout of a CODIF packet without network layers (see CodifHeader.parse())
+PACKET_DTYPE = np.dtype([
+    ("header", ">u8", (8,)),
+    ("payload", ">i2", (CODIF_BLOCKS_IN_PACKET, CODIF_CHANNELS_IN_BLOCK, CODIF_POLARIZATION, 2))])
+# Seconds of one epoch period of PAF_EPOCH_PERIOD frames (27 s)
+EPOCH_SECONDS = int(round(PAF_EPOCH_PERIOD * CODIF_BLOCKS_IN_PACKET / PAF_SAMPLE_PERIOD))
+
+
+def as_packets(buf, size=CODIF_PACKET_SIZE):
+    """
+    Description:
+    ------------
+        Interprets a buffer as batch of packets. Trailing bytes of an incomplete packet are ignored.
+    Parameters
+    ----------
+        buf : numpy array, bytes, bytearray or memoryview
+            Buffer containing consecutive CODIF packets
+    Returns:
+    --------
+        uint8 array of shape (packets, size)
+    """
+    data = np.frombuffer(buf, dtype=np.uint8) if not isinstance(buf, np.ndarray) else buf.reshape(-1)
+    n = data.size // size
+    return data[:n*size].reshape(n, size)
+
+def records(packets):
+    """
+    Description:
+    ------------
+        Returns a structured view (PACKET_DTYPE) of a batch of packets
+    """
+    return packets.view(PACKET_DTYPE)[:, 0]
+
+class Headers:
+    """
+    Description:
+    ------------
+        Vectorized counterpart of CodifHeader.update(). Every attribute is an array
+        containing the value of the respective header field for every packet of a batch.
+
+    Attributes
+    ----------
+        epoch : array of uint64
+        frame_id : array of uint64
+        freq_group : array of uint64
+        beam_id : array of uint64
+        period : array of uint64
+        key : array of int64
+            Unique and ordered index of the frame a packet belongs to
+        zeroed : array of bool
+            True for packets which contain only zeros
+    """
+    def __init__(self, packets):
+        words = records(packets)["header"]
+        word0 = words[:, 0]
+        word2 = words[:, 2]
+        self.epoch = word0 >> np.uint64(32)
+        self.frame_id = word0 & np.uint64(0xFFFFFFFF)
+        self.freq_group = (word2 >> np.uint64(16)) & np.uint64(0xFFFF)
+        self.beam_id = word2 & np.uint64(0xFFFF)
+        self.period = (words[:, 3] >> np.uint64(32)) & np.uint64(0xFFFF)
+        self.key = frame_key(self.epoch, self.frame_id)
+        self.zeroed = (self.epoch == 0) & (self.frame_id == 0) & (self.beam_id == 0)
+
+    def __len__(self):
+        return len(self.key)
+
+def frame_key(epoch, frame_id):
+    """
+    Description:
+    ------------
+        Combines epoch and frame_id to one ordered integer per frame
+    """
+    return epoch.astype(np.int64) * PAF_EPOCH_PERIOD + frame_id.astype(np.int64)
+
+def frame_index(epoch, frame_id):
+    """
+    Description:
+    ------------
+        Contiguous number of a frame. The epoch advances by EPOCH_SECONDS every PAF_EPOCH_PERIOD
+        frames, thus frame keys jump at every epoch period, while consecutive frames always have
+        consecutive indices. Differences of indices are numbers of frames.
+    """
+    return np.asarray(epoch, dtype=np.int64) * PAF_EPOCH_PERIOD // EPOCH_SECONDS + np.asarray(frame_id, dtype=np.int64)
+
+def key_index(key):
+    """
+    Description:
+    ------------
+        frame_index() of frame keys
+    """
+    key = np.asarray(key, dtype=np.int64)
+    return frame_index(key // PAF_EPOCH_PERIOD, key % PAF_EPOCH_PERIOD)
+
+def frame_time(epoch, frame_id):
+    """
+    Description:
+    ------------
+        Time of a frame in seconds since the reference epoch (see CodifHandler.compute_acm())
+    """
+    return epoch + frame_id * CODIF_BLOCKS_IN_PACKET / PAF_SAMPLE_PERIOD
+
+def isolated(values, gap, min_count, reference=None):
+    """
+    Description:
+    ------------
+        Finds the members of small isolated groups, e.g. time bins of packets with corrupt headers.
+        The values are split into groups at gaps larger than gap. Groups with less than min_count
+        members are isolated unless they are the largest group (the bulk of the values) or within
+        gap of the reference (e.g. the newest accepted value).
+    Parameters
+    ----------
+        values : numpy array
+            Integer values, e.g. time bins or frame indices
+        gap : float
+            Largest difference of values within a group
+        min_count : int
+            Minimum number of members of a group
+        reference : int
+            Latest accepted value (optional)
+    Returns:
+    --------
+        bool array, True for the members of isolated groups
+    """
+    used = np.unique(values)
+    starts = used[1:][np.diff(used) > gap]
+    group = np.searchsorted(starts, values, side="right")
+    count = np.bincount(group)
+    keep = count >= min_count
+    keep[np.argmax(count)] = True
+    if reference is not None:
+        keep |= np.bincount(group, weights=np.abs(values - reference) <= gap, minlength=len(count)) > 0
+    return ~keep[group]
+
+
+class FrameAssembler:
+    """
+    Description:
+    ------------
+        Assembles complete frames (all beam_ids of one epoch and frame_id) from batches of packets.
+        Packets of frames which are still incomplete at the end of a batch are kept and combined
+        with the next batch, thus frames are not lost at buffer or file boundaries.
+
+    Attributes
+    ----------
+        nelements : int
+            Number of beams per frame
+        window : int
+            Incomplete frames within window frames of the newest frame of a batch are kept as well. Used if
+            packets of a frame arrive out of order, e.g. from several sockets (optional, default 0)
+        pending : numpy array
+            Copy of the packets of incomplete frames at the end of the last batch
+        frame_cnt : int
+            Number of assembled frames
+        uncomplete_cnt : int
+            Number of dropped incomplete frames
+        zeroed_cnt : int
+            Number of zeroed packets
+        first : tuple
+            (epoch, frame_id, freq_group) of the first assembled frame
+        last : tuple
+            (epoch, frame_id, freq_group) of the last assembled frame
+    Methods
+    -------
+        add(packets)
+            Returns the payload of all frames completed by this batch
+        flush()
+            Drops pending packets, returns the number of dropped frames
+        state()
+            Returns pending packets and counters as dictionary of arrays (e.g. for checkpoints)
+        restore(state)
+            Continues with a state returned by state()
+        merge(state)
+            Adds the counters of a partial state (e.g. of one file) and continues with its pending packets
+    """
+    def __init__(self, nelements, window=0):
+        self.nelements = nelements
+        self.window = window
+        self.pending = np.empty((0, CODIF_PACKET_SIZE), dtype=np.uint8)
+        self.frame_cnt = 0
+        self.uncomplete_cnt = 0
+        self.zeroed_cnt = 0
+        self.first = None
+        self.last = None
+
+    def add(self, packets, final=False):
+        """
+        Description:
+        ------------
+            Assembles frames from a batch of packets and the pending packets of the previous batch
+        Parameters
+        ----------
+            packets : numpy array
+                uint8 array of shape (packets, CODIF_PACKET_SIZE)
+            final : bool
+                If True, frames that are incomplete at the end of the batch are dropped instead of kept
+        Returns:
+        --------
+            Tuple of (payload, keys). payload is an int16 array of shape
+            (frames, elements, blocks, channels, pol, 2) ordered by beam_id, keys contains the
+            frame_key of every frame
+        """
+        # Packets of the previous batch, self.pending is replaced by the packets kept for the next batch
+        previous = self.pending
+        npending = len(previous)
+        headers = Headers(packets)
+        if npending:
+            pending = Headers(self.pending)
+            key = np.concatenate((pending.key, headers.key))
+            beam = np.concatenate((pending.beam_id, headers.beam_id))
+            zeroed = np.concatenate((pending.zeroed, headers.zeroed))
+        else:
+            key, beam, zeroed = headers.key, headers.beam_id, headers.zeroed
+        self.zeroed_cnt += int(np.count_nonzero(zeroed[npending:]))
+        valid = np.flatnonzero(~zeroed & (beam < self.nelements))
+        if valid.size == 0:
+            self.pending = self.pending[:0]
+            return self.empty(), np.empty(0, dtype=np.int64)
+
+        # Table of packet indices per frame and beam, -1 marks missing packets
+        keys, inverse = np.unique(key[valid], return_inverse=True)
+        table = np.full((len(keys), self.nelements), -1, dtype=np.int64)
+        table[inverse, beam[valid].astype(np.intp)] = valid
+        complete = (table >= 0).all(axis=1)
+
+        # Incomplete frames with packets at the end of the batch may be completed by the next batch
+        if final:
+            keep = np.zeros(len(keys), dtype=bool)
+        else:
+            tail = valid[-self.nelements:]
+            keep = np.isin(keys, key[tail])
+            if self.window:
+                # The window is counted in contiguous frames, frame_keys jump at every epoch boundary
+                index = key_index(keys)
+                keep |= index >= index[-1] - self.window
+            keep &= ~complete
+        self.uncomplete_cnt += int(np.count_nonzero(~complete & ~keep))
+        rows = table[keep]
+        rows = np.sort(rows[rows >= 0])
+        new_pending = np.concatenate((self.pending[rows[rows < npending]], packets[rows[rows >= npending] - npending]))
+
+        # Gather the payload of complete frames
+        table = table[complete]
+        keys = keys[complete]
+        payload = records(packets)["payload"]
+        data = payload[np.clip(table - npending, 0, None)]
+        from_pending = table < npending
+        if from_pending.any():
+            data[from_pending] = records(self.pending)["payload"][table[from_pending]]
+
+        if len(keys):
+            first = table[0, 0]
+            last = table[-1, 0]
+            if self.first is None:
+                self.first = self.frame_info(previous, packets, first)
+            self.last = self.frame_info(previous, packets, last)
+            self.frame_cnt += len(keys)
+        self.pending = new_pending
+        return data, keys
+
+    def frame_info(self, pending, packets, idx):
+        # Header of packet idx of the packets of the previous batch followed by the current batch
+        if idx < len(pending):
+            headers = Headers(pending[idx:idx+1])
+        else:
+            headers = Headers(packets[idx-len(pending):idx-len(pending)+1])
+        return (int(headers.epoch[0]), int(headers.frame_id[0]), int(headers.freq_group[0]))
+
+    def flush(self):
+        """
+        Description:
+        ------------
+            Drops all pending packets (end of stream)
+        Returns:
+        --------
+            Number of dropped incomplete frames
+        """
+        dropped = 0
+        if len(self.pending):
+            headers = Headers(self.pending)
+            dropped = len(np.unique(headers.key))
+            self.uncomplete_cnt += dropped
+            self.pending = self.pending[:0]
+        return dropped
+
+    def state(self):
+        missing = (-1, -1, -1)
+        return {
+            "pending" : self.pending,
+            "counters" : np.array([self.frame_cnt, self.uncomplete_cnt, self.zeroed_cnt], dtype=np.int64),
+            "first" : np.array(self.first if self.first is not None else missing, dtype=np.int64),
+            "last" : np.array(self.last if self.last is not None else missing, dtype=np.int64)}
+
+    def restore(self, state):
+        self.pending = np.array(state["pending"], dtype=np.uint8).reshape(-1, CODIF_PACKET_SIZE)
+        self.frame_cnt, self.uncomplete_cnt, self.zeroed_cnt = [int(value) for value in state["counters"]]
+        self.first = tuple(int(value) for value in state["first"]) if state["first"][0] >= 0 else None
+        self.last = tuple(int(value) for value in state["last"]) if state["last"][0] >= 0 else None
+
+    def merge(self, state):
+        self.pending = np.array(state["pending"], dtype=np.uint8).reshape(-1, CODIF_PACKET_SIZE)
+        self.frame_cnt, self.uncomplete_cnt, self.zeroed_cnt = [int(a) + int(b) for a, b in
+            zip((self.frame_cnt, self.uncomplete_cnt, self.zeroed_cnt), state["counters"])]
+        if self.first is None and state["first"][0] >= 0:
+            self.first = tuple(int(value) for value in state["first"])
+        if state["last"][0] >= 0:
+            self.last = tuple(int(value) for value in state["last"])
+
+    def empty(self):
+        return np.empty((0, self.nelements) + PACKET_DTYPE["payload"].shape, dtype=PACKET_DTYPE["payload"].base)
@@ -0,0 +1,476 @@
+"""
+ Description:
+ ------------
+    Beamforming of raw CODIF voltages with the weights of calculate_weights.py.
+    The voltage y of a beam is the weighted sum of the element voltages x
+        y = w^H x
+    thus the beam power w^H R w equals the response calculated from the ACM. The weights of all
+    beams of a channel form the matrix W (rows x beams), the beams of a block of frames are computed
+    by one batched GEMM W^H X over all channels, where X are the voltages of shape (channels, rows,
+    samples). Dozens of beams therefore cost little more than one.
+
+    The rows of the weights are ordered like the rows of the correlator (x-pol of all elements, then
+    y-pol, see ELEMENT_LIST), which is the order of the ACMs of ACMFile.reshape_to_3d().
+
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+"""
+
+from __future__ import division
+import numpy as np
+import h5py
+
+from inc.constants import *
+from inc.batch import FrameAssembler, frame_time, key_index, isolated
+from inc.filterbank import FilterbankWriter, unix_to_mjd
+from inc.correlator import to_voltages
+
+MODES = ["voltage", "power"]
+
+
+def load_weights(fnames, kinds=("xy",)):
+    """
+    Description:
+    ------------
+        Loads weight sets stored by calculate_weights.py ('.npz' with the arrays x, y, xy and freq).
+        Every file and kind results in one beam. The weights of single polarization kinds are placed
+        into the rows of their polarization, the other rows are zero.
+    Parameters
+    ----------
+        fnames : list
+            Names of the weight files
+        kinds : list
+            Weight sets per file: 'x', 'y' and/or 'xy'
+    Returns:
+    --------
+        Tuple of (weights, freq, names). weights is a complex64 array of shape (beams, frequencies, rows),
+        freq the sky frequencies in MHz and names the name of every beam
+    """
+    weights = []
+    names = []
+    freq = None
+    for fname in fnames:
+        data = np.load(fname)
+        if freq is None:
+            freq = data["freq"]
+        elif not np.array_equal(freq, data["freq"]):
+            raise ValueError("Weights of " + fname + " are calculated for other frequencies")
+        nrows = data["xy"].shape[1]
+        for kind in kinds:
+            if kind not in ("x", "y", "xy"):
+                raise ValueError("Unknown weight set '" + str(kind) + "', use 'x', 'y' or 'xy'")
+            beam = np.zeros((len(freq), nrows), dtype=np.complex64)
+            if kind == "x":
+                beam[:, :nrows//2] = data["x"]
+            elif kind == "y":
+                beam[:, nrows//2:] = data["y"]
+            else:
+                beam[:] = data["xy"]
+            weights.append(beam)
+            names.append(fname + ":" + kind)
+    return np.array(weights), np.asarray(freq, dtype=np.float64), names
+
+
+def unit_weights(rows, nrows, freq):
+    """
+    Description:
+    ------------
+        Weights which select single rows (element and polarization), e.g. to write the power of
+        elements like beams
+    Parameters
+    ----------
+        rows : list
+            Selected rows (x-pol of element e is row e, y-pol row e + nrows/2)
+        nrows : int
+            Number of rows (2*elements)
+        freq : list
+            Sky frequencies of the weights
+    Returns:
+    --------
+        Tuple of (weights, freq, names) like load_weights()
+    """
+    weights = np.zeros((len(rows), len(freq), nrows), dtype=np.complex64)
+    for beam, row in enumerate(rows):
+        weights[beam, :, row] = 1
+    return weights, np.asarray(freq, dtype=np.float64), ["row" + str(row) for row in rows]
+
+
+class Beamformer:
+    """
+    Description:
+    ------------
+        Computes the voltages or the detected power of a stack of beams
+
+    Attributes
+    ----------
+        weights : numpy array
+            Weights of shape (beams, frequencies, rows)
+        freq : numpy array
+            Sky frequency of every weight set
+        mode : string
+            'voltage' returns complex beam voltages, 'power' the detected power |y|^2
+        integrate : int
+            Number of samples per power value. Divisor of CODIF_BLOCKS_IN_PACKET or a multiple of it
+        block : int
+            Maximum number of frames converted at once, limits the size of temporary arrays
+        conj_weights : numpy array
+            W^H of the selected channels of shape (channels, beams, rows)
+        missing : list
+            Channel frequencies without weights, their beams are zero
+    Methods
+    -------
+        select(freq)
+            Selects the weights of the channel frequencies of a stream
+        process(frames)
+            Returns the beams of a block of frames
+    """
+    def __init__(self, weights, freq, mode="power", integrate=1, block=256):
+        if mode not in MODES:
+            raise ValueError("Unknown mode '" + str(mode) + "', use one of " + ", ".join(MODES))
+        integrate = int(integrate)
+        if integrate < 1 or (CODIF_BLOCKS_IN_PACKET % integrate and integrate % CODIF_BLOCKS_IN_PACKET):
+            raise ValueError("Integration of " + str(integrate) + " samples, use a divisor or a multiple of " + str(CODIF_BLOCKS_IN_PACKET))
+        self.weights = np.asarray(weights, dtype=np.complex64)
+        self.freq = np.asarray(freq, dtype=np.float64)
+        self.mode = mode
+        self.integrate = integrate
+        self.block = block
+        self.nbeams = self.weights.shape[0]
+        self.nrows = self.weights.shape[2]
+        self.conj_weights = None
+        self.missing = []
+
+    def select(self, freq):
+        """
+        Description:
+        ------------
+            Selects the weights of the channel frequencies of a stream (frequency group)
+        Parameters
+        ----------
+            freq : list
+                Sky frequency of every channel in MHz
+        """
+        conj_weights = np.zeros((len(freq), self.nbeams, self.nrows), dtype=np.complex64)
+        self.missing = []
+        for idx, f in enumerate(freq):
+            pos = np.flatnonzero(np.isclose(self.freq, float(f)))
+            if len(pos):
+                conj_weights[idx] = self.weights[:, pos[0]].conj()
+            else:
+                self.missing.append(f)
+        self.conj_weights = conj_weights
+
+    def process(self, frames):
+        """
+        Description:
+        ------------
+            Computes the beams of a block of frames by one batched GEMM per block
+        Parameters
+        ----------
+            frames : numpy array
+                int16 array of shape (frames, elements, blocks, channels, pol, 2)
+        Returns:
+        --------
+            'voltage': complex64 array of shape (frames*CODIF_BLOCKS_IN_PACKET, beams, channels)
+            'power': float32 array of shape (frames*rows, beams, channels) with rows = CODIF_BLOCKS_IN_PACKET // integrate
+            per frame, or the power summed over every frame (rows = 1) if integrate >= CODIF_BLOCKS_IN_PACKET
+        """
+        if self.conj_weights is None:
+            raise ValueError("No weights selected, call select() first")
+        if frames.shape[1] * CODIF_POLARIZATION != self.nrows:
+            raise ValueError("Weights of " + str(self.nrows) + " rows, frames contain " + str(frames.shape[1]) + " elements")
+        result = []
+        for start in range(0, len(frames), self.block):
+            data = to_voltages(frames[start:start+self.block])
+            beams = np.matmul(self.conj_weights, data)
+            if self.mode == "voltage":
+                result.append(beams.transpose(2, 1, 0))
+                continue
+            power = (beams.real**2 + beams.imag**2).astype(np.float32)
+            nframes = power.shape[-1] // CODIF_BLOCKS_IN_PACKET
+            step = min(self.integrate, CODIF_BLOCKS_IN_PACKET)
+            power = power.reshape(power.shape[:2] + (nframes * CODIF_BLOCKS_IN_PACKET // step, step)).sum(axis=-1)
+            result.append(power.transpose(2, 1, 0))
+        if not result:
+            dtype = np.complex64 if self.mode == "voltage" else np.float32
+            return np.zeros((0, self.nbeams, len(self.conj_weights)), dtype=dtype)
+        return np.ascontiguousarray(np.concatenate(result))
+
+
+class BeamWriter:
+    """
+    Description:
+    ------------
+        Product of the single-pass pipeline (see CodifHandler.process() and inc/pipeline.py). Assembles
+        the frames of every stream, forms the beams and appends them to chunked HDF5 datasets, thus
+        the memory does not grow with the duration of the snapshot. Every stream is stored in its own
+        group 'stream<index>':
+            voltage     complex64 (samples, beams, channels), mode 'voltage'
+            power       float32 (time, beams, channels), mean power per sample, mode 'power'
+            key         int64, frame_key of every frame ('voltage') or of the first frame of every time bin ('power')
+            frames      int64, number of frames of every time bin ('power')
+            freq        float64 (channels,), channel frequencies in MHz
+        Frames of bins which were already written (e.g. late frames) are skipped.
+    """
+    def __init__(self, fname, beamformer, nelements=36, chunk=1024, compression=None, names=None):
+        self.fname = fname
+        self.beamformer = beamformer
+        self.nelements = nelements
+        self.chunk = int(chunk)
+        self.compression = compression
+        self.names = names
+        self.groups = {}
+        self.assemblers = {}
+        self.freqs = {}
+        self.pending = {}
+        self.late_cnt = 0
+        self.init_output()
+
+    def init_output(self):
+        self.file = h5py.File(self.fname, "w")
+        self.file.attrs["mode"] = self.beamformer.mode
+        self.file.attrs["integrate"] = self.beamformer.integrate
+        if self.names is not None:
+            self.file.attrs["beams"] = np.array([name.encode() for name in self.names])
+
+    def create(self, stream, headers):
+        header = stream.files[0].metadata()
+        freq = header.channel_frequencies() if header is not None else None
+        if freq is None:
+            freq = int(headers.freq_group[0]) + np.arange(CODIF_CHANNELS_IN_BLOCK)
+        self.freqs[stream] = freq
+        self.assemblers[stream] = FrameAssembler(self.nelements)
+        self.pending[stream] = None
+        self.open(stream, freq, headers)
+
+    def open(self, stream, freq, headers):
+        # Output of a new stream
+        group = self.file.create_group("stream" + str(len(self.groups)))
+        group.attrs["file"] = stream.files[0].fname
+        group.create_dataset("freq", data=np.asarray(freq, dtype=np.float64))
+        shape = (self.beamformer.nbeams, len(freq))
+        if self.beamformer.mode == "voltage":
+            group.create_dataset("voltage", shape=(0,) + shape, maxshape=(None,) + shape, chunks=(self.chunk,) + shape, dtype=np.complex64, compression=self.compression)
+        else:
+            group.create_dataset("power", shape=(0,) + shape, maxshape=(None,) + shape, chunks=(self.chunk,) + shape, dtype=np.float32, compression=self.compression)
+            group.create_dataset("frames", shape=(0,), maxshape=(None,), chunks=(self.chunk,), dtype=np.int64)
+        group.create_dataset("key", shape=(0,), maxshape=(None,), chunks=(self.chunk,), dtype=np.int64)
+        self.groups[stream] = group
+
+    def append(self, stream, arrays):
+        # Appends the rows of a block to the output of a stream
+        group = self.groups[stream]
+        for name, value in arrays.items():
+            dset = group[name]
+            rows = dset.shape[0]
+            dset.resize(rows + len(value), axis=0)
+            dset[rows:] = value
+
+    def add(self, stream, file, packets, headers):
+        if not len(headers):
+            return
+        if stream not in self.assemblers:
+            self.create(stream, headers)
+        frames, keys = self.assemblers[stream].add(packets)
+        self.write(stream, frames, keys)
+        file.frame_cnt += len(frames)
+
+    def write(self, stream, frames, keys):
+        if not len(frames):
+            return
+        beamformer = self.beamformer
+        beamformer.select(self.freqs[stream])
+        beams = beamformer.process(frames)
+        if beamformer.mode == "voltage":
+            self.append(stream, {"voltage" : beams, "key" : keys})
+            return
+        if beamformer.integrate <= CODIF_BLOCKS_IN_PACKET:
+            self.append(stream, {"power" : beams / beamformer.integrate, "key" : keys, "frames" : np.ones(len(keys), dtype=np.int64)})
+            return
+        # Frames are summed in bins of nframes consecutive frames (see frame_index()), the last bin may be continued by the next batch
+        nframes = beamformer.integrate // CODIF_BLOCKS_IN_PACKET
+        bins = key_index(keys) // nframes
+        counts = np.ones(len(keys), dtype=np.int64)
+        pending = self.pending[stream]
+        if pending is not None:
+            late = bins < pending[0]
+            if late.any():
+                self.late_cnt += int(np.count_nonzero(late))
+                beams, bins, counts, keys = beams[~late], bins[~late], counts[~late], keys[~late]
+            beams = np.concatenate((pending[1], beams))
+            bins = np.concatenate(([pending[0]], bins))
+            counts = np.concatenate(([pending[2]], counts))
+            keys = np.concatenate(([pending[3]], keys))
+        starts = np.flatnonzero(np.concatenate(([True], bins[1:] != bins[:-1])))
+        sums = np.add.reduceat(beams, starts, axis=0)
+        counts = np.add.reduceat(counts, starts)
+        self.pending[stream] = (bins[starts[-1]], sums[-1:], counts[-1], keys[starts[-1]])
+        self.flush(stream, keys[starts[:-1]], sums[:-1], counts[:-1])
+
+    def flush(self, stream, keys, sums, counts):
+        # Writes complete bins of summed power, keys are the frame_keys of the first frame of the bins
+        if not len(keys):
+            return
+        power = sums / (counts * CODIF_BLOCKS_IN_PACKET)[:, None, None]
+        self.append(stream, {"power" : power.astype(np.float32), "key" : keys, "frames" : counts})
+
+    def end(self, stream):
+        if stream not in self.assemblers:
+            return
+        self.assemblers[stream].flush()
+        pending = self.pending[stream]
+        if pending is not None:
+            self.flush(stream, np.array([pending[3]]), pending[1], np.array([pending[2]]))
+        self.pending[stream] = None
+
+    def close(self):
+        self.file.attrs["late_frames"] = self.late_cnt
+        self.file.close()
+
+
+class BeamFilterbank(BeamWriter):
+    """
+    Description:
+    ------------
+        Writes the detected power of every beam and stream into its own SIGPROC filterbank file
+        '<prefix>_<node>_beam<index>.fil' (see inc/filterbank.py). The start time is taken from
+        UTC_START of the DADA header, the channels from its frequencies. Missing frames (or time bins)
+        are filled with zeros, thus the time axis of the files is continuous. After a gap longer than
+        max_gap the stream continues in new files '<prefix>_<node>_beam<index>_<part>.fil'.
+
+    Attributes
+    ----------
+        prefix : string
+            Prefix of the file names
+        nbits : int
+            32 writes float32, 8 writes scaled uint8
+        writers : dict
+            FilterbankWriters of every stream
+        max_gap : float
+            Frames further apart than max_gap seconds (at least one time bin) are separated by a gap
+        min_frames : int
+            Groups of less than min_frames frames of a batch which are separated by gaps from all
+            other frames and the newest accepted frame are skipped (corrupt headers, see isolated())
+        newest : dict
+            Contiguous frame index of the newest accepted frame of every stream
+        outlier_cnt : int
+            Number of skipped frames of isolated groups
+    """
+    def __init__(self, prefix, beamformer, nelements=36, nbits=32, source_name="unknown", buffer_size=4*1024**2, names=None, max_gap=60.0, min_frames=16):
+        if beamformer.mode != "power":
+            raise ValueError("Filterbank files require the mode 'power'")
+        self.prefix = prefix
+        self.max_gap = float(max_gap)
+        self.min_frames = int(min_frames)
+        self.nbits = nbits
+        self.source_name = source_name
+        self.buffer_size = buffer_size
+        BeamWriter.__init__(self, prefix, beamformer, nelements, names=names)
+
+    def init_output(self):
+        self.writers = {}
+        self.reference = {}
+        self.first_bin = {}
+        self.written = {}
+        self.parts = {}
+        self.closed = []
+        self.newest = {}
+        self.outlier_cnt = 0
+
+    def open(self, stream, freq, headers):
+        # Files are created by the first block, the header needs the time of its first sample
+        file = stream.files[0]
+        header = file.metadata()
+        unix = None
+        if header is not None and header.start_time() is not None and header.bytes_per_second:
+            unix = header.start_time() + header.time_of((stream.span(file)[0] - header.hdr_size) // header.pkt_size)
+        self.reference[stream] = (unix, frame_time(int(headers.epoch[0]), int(headers.frame_id[0])))
+        self.groups[stream] = file.node_name
+
+    def start(self, stream, key):
+        freq = np.asarray(self.freqs[stream], dtype=np.float64)
+        unix, reference = self.reference[stream]
+        step = max(self.beamformer.integrate // CODIF_BLOCKS_IN_PACKET, 1)
+        # Rows are aligned to bins of step frames, the file starts with the bin of the first frame
+        first = int(key_index(key)) // step
+        seconds = frame_time(key // PAF_EPOCH_PERIOD, key % PAF_EPOCH_PERIOD) - (int(key_index(key)) - first * step) * CODIF_BLOCKS_IN_PACKET / PAF_SAMPLE_PERIOD
+        tstart = unix_to_mjd(unix + seconds - reference) if unix is not None else 0.0
+        tsamp = self.beamformer.integrate / PAF_SAMPLE_PERIOD
+        foff = freq[1] - freq[0] if len(freq) > 1 else 1.0
+        # Files after gaps get the number of the part
+        part = self.parts.get(stream, 0)
+        self.parts[stream] = part + 1
+        suffix = "_" + str(part) if part else ""
+        self.writers[stream] = [FilterbankWriter(self.prefix + "_" + str(self.groups[stream]) + "_beam" + str(beam) + suffix + ".fil",
+            freq[0], foff, len(freq), tsamp, tstart, self.nbits, source_name=self.source_name, buffer_size=self.buffer_size, ibeam=beam,
+            nbeams=self.beamformer.nbeams) for beam in range(self.beamformer.nbeams)]
+        self.first_bin[stream] = first
+        self.written[stream] = 0
+
+    def write(self, stream, frames, keys):
+        if not len(keys):
+            return
+        step = max(self.beamformer.integrate // CODIF_BLOCKS_IN_PACKET, 1)
+        # Frames are compared by contiguous frame indices since keys jump at every epoch period
+        index = key_index(keys)
+        gap = max(self.max_gap * PAF_SAMPLE_PERIOD / CODIF_BLOCKS_IN_PACKET, step)
+        # Frames with corrupt headers would fill the files up to their time with zeros, they are skipped before the integration
+        outlier = isolated(index, gap, self.min_frames, self.newest.get(stream))
+        if outlier.any():
+            self.outlier_cnt += int(np.count_nonzero(outlier))
+            frames, keys, index = frames[~outlier], keys[~outlier], index[~outlier]
+            if not len(keys):
+                return
+        self.newest[stream] = max(self.newest.get(stream, 0), int(index.max()))
+        BeamWriter.write(self, stream, frames, keys)
+
+    def append(self, stream, arrays):
+        keys = np.asarray(arrays["key"], dtype=np.int64)
+        power = arrays["power"]
+        if not len(keys):
+            return
+        step = max(self.beamformer.integrate // CODIF_BLOCKS_IN_PACKET, 1)
+        rows = len(power) // len(keys)
+        power = power.reshape((len(keys), rows) + power.shape[1:])
+        # Bins of step frames, computed from contiguous frame indices since keys jump at every epoch period
+        bins = key_index(keys) // step
+        gap = max(self.max_gap * PAF_SAMPLE_PERIOD / (step * CODIF_BLOCKS_IN_PACKET), 1)
+        # Segments between gaps are written one after another
+        used = np.unique(bins)
+        bounds = list(used[1:][np.diff(used) > gap]) + [used[-1] + 1]
+        first = used[0]
+        for last in bounds:
+            segment = (bins >= first) & (bins < last)
+            self.write_rows(stream, keys[segment], bins[segment], power[segment], gap)
+            first = last
+
+    def write_rows(self, stream, keys, bins, power, gap):
+        if stream not in self.writers:
+            self.start(stream, int(keys[np.argmin(bins)]))
+        elif bins.min() - (self.first_bin[stream] + self.written[stream]) > gap:
+            # Real gap, the stream continues in new files instead of filling the gap with zeros
+            for writer in self.writers[stream]:
+                writer.close()
+            self.closed += self.writers[stream]
+            self.start(stream, int(keys[np.argmin(bins)]))
+        index = bins - self.first_bin[stream] - self.written[stream]
+        keep = index >= 0
+        self.late_cnt += int(np.count_nonzero(~keep))
+        if not keep.any():
+            return
+        index = index[keep]
+        power = power[keep]
+        block = np.zeros((int(index.max()) + 1,) + power.shape[1:], dtype=np.float32)
+        block[index] = power
+        block = block.reshape((-1,) + power.shape[2:])
+        for beam, writer in enumerate(self.writers[stream]):
+            writer.write(block[:, beam])
+        self.written[stream] += int(index.max()) + 1
+
+    def close(self):
+        for writers in self.writers.values():
+            for writer in writers:
+                writer.close()
+
+    def files(self):
+        return [writer.fname for writer in self.closed] + [writer.fname for writers in self.writers.values() for writer in writers]
@@ -0,0 +1,237 @@
+"""
+ Description:
+ ------------
+    Content-addressed cache of per-file ACM partial sums.
+    Integrating the ACM of a file yields a partial sum (accumulated ACM, frame counters) which
+    only depends on the file content and the integration settings. The partial sum is stored
+    under a hash of (path, size, mtime, byte range, settings, key of the preceding file). The
+    key of the preceding file is included since frames which are split over two files are
+    completed by the packets at the end of the preceding file.
+    Repeated conversions of the same snapshot only merge cached sums instead of reading the
+    raw voltages again. The cache is limited in size, the least recently used entries are
+    removed first.
+
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+"""
+
+import os
+import glob
+import hashlib
+import numpy as np
+from collections import OrderedDict
+
+# Entries of other versions are never used (change if the content of an entry changes)
+CACHE_VERSION = 1
+
+
+class ACMCache:
+    """
+    Description:
+    ------------
+        Directory of '.npz' entries, one per file and integration settings
+
+    Attributes
+    ----------
+        dir : string
+            Cache directory
+        max_size : int
+            Maximum size of all entries in bytes
+        hits : int
+            Number of entries found by get()
+        misses : int
+            Number of entries not found by get()
+        pinned : set
+            Keys which are about to be used, they are not evicted
+    Methods
+    -------
+        key(fname, span, settings, previous)
+            Returns the key of the partial sum of a file
+        contains(key)
+            Returns True if the key is cached
+        get(key)
+            Returns the entry as dictionary of arrays or None
+        put(key, entry)
+            Stores an entry and evicts the least recently used entries
+        evict()
+            Removes the least recently used entries until the cache fits into max_size
+    """
+    def __init__(self, dir, max_size=10*1024**3):
+        self.dir = dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.pinned = set()
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+
+    def key(self, fname, span, settings, previous=""):
+        """
+        Description:
+        ------------
+            Computes the key of the partial sum of a file without reading it
+        Parameters
+        ----------
+            fname : string
+                File
+            span : tuple
+                Byte range (begin, end) of the integrated packets
+            settings : tuple
+                Integration settings (e.g. nelements, correlator)
+            previous : string
+                Key of the preceding file of the stream ("" for the first file)
+        Returns:
+        --------
+            Hex string
+        """
+        stat = os.stat(fname)
+        content = (CACHE_VERSION, os.path.abspath(fname), stat.st_size, stat.st_mtime, tuple(span), tuple(settings), previous)
+        return hashlib.sha1(repr(content).encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.dir, key + ".npz")
+
+    def contains(self, key):
+        return os.path.isfile(self.path(key))
+
+    def get(self, key):
+        """
+        Description:
+        ------------
+            Loads an entry and marks it as recently used
+        Returns:
+        --------
+            Dictionary of arrays or None if the key is not cached
+        """
+        fname = self.path(key)
+        try:
+            with np.load(fname) as data:
+                entry = dict((name, data[name]) for name in data.files)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        # The modification time is the time of the last use (atime is often disabled)
+        try:
+            os.utime(fname, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        """
+        Description:
+        ------------
+            Stores an entry atomically (temporary file and rename)
+        Parameters
+        ----------
+            key : string
+                Key returned by key()
+            entry : dict
+                Arrays to store
+        """
+        fname = self.path(key)
+        tmp = fname + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, **entry)
+        os.rename(tmp, fname)
+        self.evict()
+
+    def evict(self):
+        """
+        Description:
+        ------------
+            Removes the least recently used entries until all entries fit into max_size.
+            Pinned entries are kept.
+        Returns:
+        --------
+            Number of removed entries
+        """
+        entries = []
+        for fname in glob.glob(os.path.join(self.dir, "*.npz")):
+            try:
+                stat = os.stat(fname)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, fname))
+        entries.sort()
+        total = sum(entry[1] for entry in entries)
+        removed = 0
+        for mtime, size, fname in entries:
+            if total <= self.max_size:
+                break
+            if os.path.basename(fname)[:-len(".npz")] in self.pinned:
+                continue
+            try:
+                os.remove(fname)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+
+class StreamSums:
+    """
+    Description:
+    ------------
+        Keys and cached partial sums of the files of one CodifStream
+
+    Attributes
+    ----------
+        cache : ACMCache
+            Cache of the partial sums
+        keys : OrderedDict
+            Key of every file with packets to integrate, in stream order
+        cached : set
+            Files whose partial sum is cached (they do not need to be read)
+    Methods
+    -------
+        entries(until)
+            Yields the cached entries of the files preceding a file in stream order
+        store(file, entry)
+            Stores the partial sum of a file
+    """
+    def __init__(self, cache, files, spans, settings):
+        self.cache = cache
+        self.keys = OrderedDict()
+        self.cached = set()
+        self.position = 0
+        previous = ""
+        for file, span in zip(files, spans):
+            if span[0] >= span[1]:
+                continue
+            previous = self.keys[file] = cache.key(file.fname, span, settings, previous)
+            if cache.contains(previous):
+                self.cached.add(file)
+                # Entries of this stream must survive evictions until they are merged
+                cache.pinned.add(previous)
+        self.order = list(self.keys.keys())
+
+    def entries(self, until=None):
+        """
+        Description:
+        ------------
+            Yields the cached partial sums of all files preceding until which were not yielded before
+        Parameters
+        ----------
+            until : CodifFile
+                File which is read next (optional, default all remaining files)
+        Returns:
+        --------
+            Generator of (file, entry)
+        """
+        while self.position < len(self.order) and self.order[self.position] is not until:
+            file = self.order[self.position]
+            self.position += 1
+            if file in self.cached:
+                entry = self.cache.get(self.keys[file])
+                self.cache.pinned.discard(self.keys[file])
+                if entry is None:
+                    raise IOError("Cached partial sum of " + file.fname + " was removed while it was used")
+                yield file, entry
+        if until is not None and self.position < len(self.order):
+            self.position += 1
+
+    def store(self, file, entry):
+        self.cache.put(self.keys[file], entry)
@@ -0,0 +1,263 @@
+"""
+ Description:
+ ------------
+    Fine channelization of the CODIF coarse channels.
+    The samples of consecutive frames form a continuous time series per element, polarization
+    and coarse channel. Channelizer splits it into spectra of nfft samples and transforms all
+    rows and coarse channels by one batched FFT. With taps > 1 a polyphase filterbank (PFB) is
+    applied: taps*nfft samples are weighted by a windowed sinc and summed to nfft samples before
+    the FFT, which reduces the leakage between fine channels.
+
+    The fine channels of coarse channel c are ordered by frequency (fftshift), thus the fine
+    channels of all coarse channels form one increasing frequency axis. The coarse channels are
+    oversampled (sample rate PAF_SAMPLE_PERIOD = 32/27 MHz, spacing 1 MHz). With crop only the
+    fine channels within +-0.5 MHz of the coarse channel center are kept, thus the fine channels
+    of neighbouring coarse channels do not overlap.
+
+    FineCorrelator computes ACMs of the fine channels, FineSpectrometer only their power
+    (autocorrelations). The number of multiplications of the fine ACMs equals the coarse ones,
+    nfft fine channels have nfft times fewer samples.
+
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+"""
+
+from __future__ import division
+import numpy as np
+
+from inc.constants import *
+from inc.batch import key_index
+from inc.correlator import Correlator, to_voltages
+
+
+def pfb_coefficients(nfft, taps, window="hann"):
+    """
+    Description:
+    ------------
+        Coefficients of the prototype filter of a polyphase filterbank (windowed sinc). With
+        one tap the coefficients are the window itself (windowed FFT)
+    Returns:
+    --------
+        float32 array of shape (taps, nfft)
+    """
+    n = taps * nfft
+    if window == "hann":
+        coeff = np.hanning(n + 2)[1:-1] if taps > 1 else np.hanning(n)
+    elif window in ("none", "rect"):
+        coeff = np.ones(n)
+    else:
+        raise ValueError("Unknown window '" + str(window) + "', use 'hann' or 'none'")
+    if taps > 1:
+        coeff = coeff * np.sinc((np.arange(n) - (n - 1) / 2) / nfft)
+    return coeff.reshape(taps, nfft).astype(np.float32)
+
+
+class Channelizer:
+    """
+    Description:
+    ------------
+        Batched windowed FFT / polyphase filterbank of all rows and coarse channels
+
+    Attributes
+    ----------
+        nfft : int
+            Number of fine channels per coarse channel (before cropping)
+        taps : int
+            Number of taps of the polyphase filterbank (1: windowed FFT)
+        coeff : numpy array
+            Filter coefficients of shape (taps, nfft)
+        select : numpy array
+            Kept fine channels (positions after fftshift)
+        nfine : int
+            Number of kept fine channels per coarse channel
+        spectra_cnt : int
+            Number of computed spectra
+        reset_cnt : int
+            Number of discontinuities (missing frames) at which the time series was restarted
+    Methods
+    -------
+        process(data, keys)
+            Returns the fine channels of a block of voltages
+        frequencies(freq)
+            Returns the frequencies of the fine channels of coarse channels
+        reset()
+            Drops the buffered samples
+    """
+    def __init__(self, nfft=32, taps=1, window="hann", crop=False):
+        self.nfft = int(nfft)
+        self.taps = int(taps)
+        self.coeff = pfb_coefficients(self.nfft, self.taps, window)
+        offsets = (np.arange(self.nfft) - self.nfft // 2) * PAF_SAMPLE_PERIOD / 1e6 / self.nfft
+        self.select = np.flatnonzero(np.abs(offsets) <= 0.5) if crop else np.arange(self.nfft)
+        self.offsets = offsets[self.select]
+        self.nfine = len(self.select)
+        self.buffer = None
+        self.work = None
+        self.product = None
+        self.used = 0
+        self.last_index = None
+        self.spectra_cnt = 0
+        self.reset_cnt = 0
+
+    def reset(self):
+        self.used = 0
+        self.last_index = None
+
+    def frequencies(self, freq):
+        """
+        Description:
+        ------------
+            Frequencies of the fine channels in MHz
+        Parameters
+        ----------
+            freq : list
+                Center frequencies of the coarse channels in MHz
+        Returns:
+        --------
+            numpy array of length len(freq)*nfine
+        """
+        return (np.asarray(freq, dtype=np.float64)[:, None] + self.offsets[None, :]).reshape(-1)
+
+    def append(self, data):
+        # Appends samples to the preallocated buffer, it grows only if a larger block is passed
+        nsamples = data.shape[-1]
+        if self.buffer is None or self.buffer.shape[:2] != data.shape[:2] or self.buffer.shape[-1] < self.used + nsamples:
+            buffer = np.empty(data.shape[:2] + (self.used + nsamples + self.taps*self.nfft,), dtype=np.complex64)
+            if self.used:
+                buffer[..., :self.used] = self.buffer[..., :self.used]
+            self.buffer = buffer
+        self.buffer[..., self.used:self.used+nsamples] = data
+        self.used += nsamples
+
+    def transform(self):
+        # Computes all complete spectra of the buffer and keeps the samples needed by the next ones
+        nspectra = (self.used - (self.taps - 1)*self.nfft) // self.nfft
+        if nspectra <= 0:
+            return None
+        nchannel, nrows = self.buffer.shape[:2]
+        segments = self.buffer[..., :(nspectra + self.taps - 1)*self.nfft].reshape(nchannel, nrows, nspectra + self.taps - 1, self.nfft)
+        shape = (nchannel, nrows, nspectra, self.nfft)
+        if self.work is None or self.work.size < np.prod(shape):
+            self.work = np.empty(np.prod(shape), dtype=np.complex64)
+            self.product = np.empty_like(self.work)
+        weighted = self.work[:np.prod(shape)].reshape(shape)
+        np.multiply(segments[:, :, :nspectra], self.coeff[0], out=weighted)
+        for tap in range(1, self.taps):
+            product = self.product[:np.prod(shape)].reshape(shape)
+            weighted += np.multiply(segments[:, :, tap:tap+nspectra], self.coeff[tap], out=product)
+        spectra = np.fft.fftshift(np.fft.fft(weighted, axis=-1), axes=-1)[..., self.select]
+        consumed = nspectra*self.nfft
+        remaining = self.used - consumed
+        self.buffer[..., :remaining] = self.buffer[..., consumed:self.used]
+        self.used = remaining
+        self.spectra_cnt += nspectra
+        # (channels, rows, spectra, fine) -> (channels*fine, rows, spectra)
+        return spectra.transpose(0, 3, 1, 2).reshape(nchannel*self.nfine, nrows, nspectra).astype(np.complex64)
+
+    def process(self, data, keys=None):
+        """
+        Description:
+        ------------
+            Channelizes a block of voltages. Samples which do not fill a complete spectrum are kept
+            and continued by the next block. If keys are passed, the time series is restarted at
+            missing frames.
+        Parameters
+        ----------
+            data : numpy array
+                Complex voltages of shape (channels, rows, frames*CODIF_BLOCKS_IN_PACKET) (see to_voltages())
+            keys : numpy array
+                frame_key of every frame (optional)
+        Returns:
+        --------
+            List of complex64 arrays of shape (channels*nfine, rows, spectra)
+        """
+        bounds = [0, data.shape[-1] // CODIF_BLOCKS_IN_PACKET]
+        if keys is not None and len(keys):
+            # Contiguous frame numbers, frame_keys jump at every epoch boundary
+            index = key_index(keys)
+            if self.last_index is not None and index[0] != self.last_index + 1:
+                self.reset_cnt += 1
+                self.used = 0
+            bounds = [0] + list(np.flatnonzero(np.diff(index) != 1) + 1) + [len(index)]
+            self.last_index = int(index[-1])
+        result = []
+        for idx, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+            if idx:
+                self.reset_cnt += 1
+                self.used = 0
+            self.append(data[..., start*CODIF_BLOCKS_IN_PACKET:stop*CODIF_BLOCKS_IN_PACKET])
+            spectra = self.transform()
+            if spectra is not None:
+                result.append(spectra)
+        return result
+
+
+class FineCorrelator(Correlator):
+    """
+    Description:
+    ------------
+        Accumulates the ACMs of the fine channels in complex64
+
+    Attributes
+    ----------
+        channelizer : Channelizer
+            Fine channelization of the coarse channels
+        acm : numpy array
+            Accumulated ACM of shape (channels*nfine, elements*pol, elements*pol)
+    Methods
+    -------
+        integrate(frames, keys)
+            Channelizes a block of frames and adds the ACMs of the fine channels
+        spectrum()
+            Mean power of every fine channel and row (diagonal of the ACM per spectrum)
+    """
+    def __init__(self, nelements, nchannel=CODIF_CHANNELS_IN_BLOCK, pol=CODIF_POLARIZATION, block=256, nfft=32, taps=1, window="hann", crop=False):
+        self.channelizer = Channelizer(nfft, taps, window, crop)
+        Correlator.__init__(self, nelements, nchannel*self.channelizer.nfine, pol, block)
+        self.ncoarse = nchannel
+
+    def accumulate(self, spectra):
+        self.acm += np.matmul(spectra, spectra.conj().transpose(0, 2, 1))
+
+    def integrate(self, frames, keys=None):
+        """
+        Description:
+        ------------
+            Adds the ACMs of the fine channels of a block of frames
+        Parameters
+        ----------
+            frames : numpy array
+                int16 array of shape (frames, elements, blocks, channels, pol, 2)
+            keys : numpy array
+                frame_key of every frame, missing frames restart the time series (optional)
+        """
+        for start in range(0, len(frames), self.block):
+            data = to_voltages(frames[start:start+self.block])
+            for spectra in self.channelizer.process(data, keys[start:start+self.block] if keys is not None else None):
+                self.accumulate(spectra)
+        self.frame_cnt += len(frames)
+
+    def spectrum(self):
+        diag = np.diagonal(self.acm, axis1=1, axis2=2).real
+        return diag / max(self.channelizer.spectra_cnt, 1)
+
+    def frequencies(self, freq):
+        return self.channelizer.frequencies(freq)
+
+
+class FineSpectrometer(FineCorrelator):
+    """
+    Description:
+    ------------
+        Accumulates only the power (autocorrelations) of the fine channels, e.g. for spectral line
+        or RFI inspection of every element. result() returns the power of shape (channels*nfine, elements*pol)
+    """
+    def __init__(self, nelements, nchannel=CODIF_CHANNELS_IN_BLOCK, pol=CODIF_POLARIZATION, block=256, nfft=32, taps=1, window="hann", crop=False):
+        FineCorrelator.__init__(self, nelements, nchannel, pol, block, nfft, taps, window, crop)
+        self.acm = np.zeros((self.nchannel, nelements*pol), dtype=np.float64)
+
+    def accumulate(self, spectra):
+        self.acm += (spectra.real**2 + spectra.imag**2).sum(axis=-1)
+
+    def spectrum(self):
+        return self.acm / max(self.channelizer.spectra_cnt, 1)
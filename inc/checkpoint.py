@@ -0,0 +1,141 @@
+"""
+ Description:
+ ------------
+    Checkpoints of partially integrated ACMs.
+    A Checkpoint stores the state of a running computation (accumulated ACM, frame counters,
+    pending packets and the position within the files) as '.npz' file. The file is written to a
+    temporary name and renamed afterwards, thus a crash while saving never destroys the previous
+    checkpoint. A computation that is interrupted (OOM, preemption, a corrupt file) continues
+    from the latest checkpoint instead of starting over.
+
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+"""
+
+import os
+import json
+import time
+import numpy as np
+
+
+class Checkpoint:
+    """
+    Description:
+    ------------
+        Saves and loads the state of one computation (e.g. the ACM of one numa node)
+
+    Attributes
+    ----------
+        fname : string
+            Checkpoint file ('.npz')
+        interval : float
+            Minimum number of seconds between two saves by due()
+        resume : bool
+            If True, load() returns the saved state, otherwise the computation starts over
+        settings : dict
+            Settings of the computation (e.g. files, nelements, time range), stored with every
+            save. A checkpoint saved with other settings is not loaded
+    Methods
+    -------
+        load()
+            Returns the saved state as dictionary of arrays or None
+        due()
+            Returns True if the interval passed since the last save
+        save(state)
+            Writes a dictionary of arrays
+        finish(acm, freq, frame_cnt, extra)
+            Saves the final result of the computation
+        result()
+            Returns the saved final result or None
+        extra()
+            Returns the additional arrays of the final result
+        remove()
+            Deletes the checkpoint file
+    """
+    def __init__(self, fname, interval=60.0, resume=False, settings=None):
+        self.fname = fname
+        self.interval = interval
+        self.resume = resume
+        # Settings are compared as JSON strings, thus lists, None and numbers compare by value
+        self.settings = json.dumps(settings or {}, sort_keys=True)
+        self.saved = time.time()
+        dir = os.path.dirname(fname)
+        if dir and not os.path.isdir(dir):
+            os.makedirs(dir)
+
+    def load(self):
+        """
+        Description:
+        ------------
+            Loads the checkpoint file
+        Returns:
+        --------
+            Dictionary of arrays or None if not resuming, no checkpoint exists or it was saved with other settings
+        """
+        if not self.resume or not os.path.isfile(self.fname):
+            return None
+        with np.load(self.fname) as data:
+            state = dict((key, data[key]) for key in data.files)
+        if str(state.pop("settings", "{}")) != self.settings:
+            print("Warning: checkpoint " + self.fname + " was saved with other settings, starting over")
+            return None
+        return state
+
+    def due(self):
+        return self.interval > 0 and time.time() - self.saved >= self.interval
+
+    def save(self, state):
+        """
+        Description:
+        ------------
+            Writes the state atomically (temporary file and rename)
+        Parameters
+        ----------
+            state : dict
+                Arrays (or values convertible to arrays) to store
+        """
+        tmp = self.fname + ".tmp"
+        state = dict(state, settings=np.array(self.settings))
+        with open(tmp, "wb") as f:
+            np.savez(f, **state)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.fname)
+        self.saved = time.time()
+
+    def finish(self, acm, freq, frame_cnt, extra=None):
+        """
+        Description:
+        ------------
+            Replaces the state by the final result, a resumed run does not read any file again.
+            extra is a dictionary of additional arrays (e.g. RFI statistics) returned by extra()
+        """
+        state = {"done" : np.array(True), "acm" : acm, "freq" : np.asarray(freq), "frame_cnt" : np.array(frame_cnt)}
+        for key, value in (extra or {}).items():
+            state["extra_" + key] = value
+        self.save(state)
+
+    def result(self):
+        """
+        Description:
+        ------------
+            Returns the final result saved by finish()
+        Returns:
+        --------
+            Tuple of (acm, freq, frame_cnt) or None if the computation was not finished
+        """
+        state = self.load()
+        if state is None or "done" not in state:
+            return None
+        return state["acm"], state["freq"], int(state["frame_cnt"])
+
+    def extra(self):
+        state = self.load()
+        if state is None or "done" not in state:
+            return {}
+        return dict((key[6:], value) for key, value in state.items() if key.startswith("extra_"))
+
+    def remove(self):
+        for fname in (self.fname, self.fname + ".tmp"):
+            if os.path.isfile(fname):
+                os.remove(fname)
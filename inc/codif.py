@@ -17,7 +17,6 @@ Author: Niclas Eesser <nesser@mpifr-bonn.mpg.de>
 """
 
 from __future__ import division
-import curses
 import pcapy
 import sys
 import struct
@@ -30,12 +29,23 @@ import re
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
-from threading import Thread
+from threading import Thread, Lock
+from collections import OrderedDict
 from Queue import Queue
 from copy import deepcopy
 
 from inc.constants import *
 from inc.utils import *
+from inc.metrics import MetricsRegistry, MetricsReporter, create_sinks
+from inc.profiling import clock, Progress
+from inc.batch import FrameAssembler, Headers, frame_time
+from inc.correlator import CORRELATORS
+from inc.fileio import PrefetchReader, DirectFile, copy_range, write_all
+from inc.dada import read_dada_header, format_dada_header
+from inc.synthetic import network_header, UDP_BASE_PORT
+from inc.cache import StreamSums
+from inc.voltage import VoltageArray
+from inc.repack import Repacker
 
 
 class HandlerError(Exception):
@@ -83,15 +93,21 @@ class CodifPacket:
     def __str__(self):
         return self.header.__str__()
 
-    def update(self, bytestream, skip=False):
+    def update(self, bytestream, skip=False, profiler=None):
         self.stream = bytestream
+        if profiler is not None:
+            start = clock()
         self.header.update(self.stream) # Instantiate CODIF header
+        if profiler is not None:
+            start = profiler.add("header", start)
         # Skip payload (Much faster if just header data are required)
         if skip:
             self.payload = 0
         # Or instantiate a payload object
         else:
             self.payload.update(self.stream)
+            if profiler is not None:
+                profiler.add("payload", start)
 
 
 class CodifPayload:
@@ -120,7 +136,7 @@ class CodifPayload:
                 bytestream that corresponds to one CODIF packet.
         """
         self.stream = stream
-        self.data = np.frombuffer(stream.getvalue()[CODIF_HEADER:], dtype='int16') \
+        self.data = np.frombuffer(stream.getvalue()[CODIF_HEADER:], dtype=np.dtype('short').newbyteorder('>')) \
             .reshape(CODIF_BLOCKS_IN_PACKET, CODIF_CHANNELS_IN_BLOCK, CODIF_POLARIZATION, 2) \
             .astype(dtype='float') \
             .view(dtype='complex') \
@@ -468,12 +484,28 @@ class CodifFile:
             Stores faulty packets and the id of occurence
         zeroed_cnt : string
             Counts the number of packets which are zeroed. Usually occur in 'dada' files
+        frame_cnt : integer
+            Counts the number of frames assembled by next_frame()
+        acm_frame_cnt : integer
+            Counts the number of frames integrated into an ACM
+        profiler : StageProfiler
+            If set, the time spent for reading and decoding is accumulated (see inc/profiling.py)
+        direct : bool
+            If True, 'dada' files are read with O_DIRECT bypassing the page cache (see inc/fileio.py)
+        file : file object
+            Opened file or None if the file is closed (see open() and close())
         stream_position : integer
             Position of the file stream
         dada_header : BytesIO
-            Contains DADA header information
+            Contains DADA header information (see metadata() for the parsed header)
     Methods
     -------
+        open(self)
+
+        close(self)
+
+        metadata(self)
+
         seek_packet(self, packet, offset, whence, size)
 
         seek(self, offset, whence)
@@ -488,13 +520,19 @@ class CodifFile:
 
         read(self, packets, validate, add, verbose, skip_payload)
 
-        write(self, start, end, keep)
+        select(self, start, stop, beams, freq_group)
+
+        write(self, fname, start, stop, beams, freq_group, type)
 
         proof_order(self, packet, prev_reference)
 
         not_order_msg(self, packet, prev_reference)
+
+        metrics_sample(self)
     """
-    def __init__(self, fname, type="dada"):
+    empty_payload = empty_string(CODIF_PAYLOAD) # Used if payload needs to be padded, shared by all files
+
+    def __init__(self, fname, type="dada", direct=False, lazy=False):
         """
         Description:
         ------------
@@ -506,9 +544,14 @@ class CodifFile:
                 Entire path to file
             type : string
                 Filetype
+            direct : bool
+                Read with O_DIRECT (only 'dada' files)
+            lazy : bool
+                If True, the file is not opened before open() is called (e.g. by a FilePool)
         """
         self.fname = fname
         self.type = type
+        self.direct = direct
         self.size = os.path.getsize(fname)
         self.packet_list = []
         self.packet = 0
@@ -519,35 +562,103 @@ class CodifFile:
         self.stream_position = 0
         self.random_payload = ""
         self.frame_cnt = 0
+        self.acm_frame_cnt = 0
+        self.profiler = None
         self.node_name = self.get_node_name()
-        self.empty_payload = empty_string(CODIF_PAYLOAD) # Used if payload needs to be padded
+        self.file = None
+        self.endlocation = self.size
+        self.dada_header = ""
+        # The passed file is a .dada file
+        if self.type == "dada":
+            # Calculate the number of packet
+            self.npackets = (self.size - DADA_HEADER_SIZE) / CODIF_PACKET_SIZE
+        # The passed file is a .pcap file
+        elif self.type == "pcap":
+            # Calculate the number of packet
+            self.npackets = (self.size) / CODIF_TOTAL_SIZE
+        # The passed file type is not known
+        else:
+            raise HandlerError("Failed: CodifFile does not know format " + self.type)
+        if not lazy:
+            self.open()
+
+    def open(self):
+        """
+        Description:
+        ------------
+            Opens the file. A 'dada' file which was closed by close() continues at
+            the previous stream position.
+        Parameters
+        ----------
+            None
+        Returns:
+        --------
+            -
+        """
+        if self.file is not None:
+            return
         # The passed file is a .dada file
         if self.type == "dada":
             # Try to open the file
             try:
-                self.file = open(self.fname, "rb")
-            except IOError as e:
+                if self.direct:
+                    self.file = DirectFile(self.fname)
+                else:
+                    self.file = open(self.fname, "rb")
+            except (IOError, OSError) as e:
                 raise e
-            self.seek(0,2)
-            self.endlocation = self.file.tell()
-            self.seek(0)
             # Read dada header (Note: Every DADA file has an extra header)
             self.dada_header = self.file.read(DADA_HEADER_SIZE)
-            # Calculate the number of packet
-            self.npackets = (self.size - DADA_HEADER_SIZE) / CODIF_PACKET_SIZE
+            if self.stream_position > DADA_HEADER_SIZE:
+                self.file.seek(self.stream_position)
         # The passed file is a .pcap file
-        elif self.type == "pcap":
+        else:
             # Try to open the file
             try:
                 # Here we use the PCAP lib functions to do offline parsing instead of file open()
                 self.file = pcapy.open_offline(self.fname)
             except IOError as e:
                 raise e
-            # Calculate the number of packet
-            self.npackets = (self.size) / CODIF_TOTAL_SIZE
-        # The passed file type is not known
-        else:
-            raise HandlerError("Failed: CodifFile does not know format " + self.type)
+
+    def close(self):
+        """
+        Description:
+        ------------
+            Closes the file and keeps all counters and the stream position. 'pcap' files
+            can not be reopened at the previous position and are kept open.
+        Parameters
+        ----------
+            None
+        Returns:
+        --------
+            True if the file was closed
+        """
+        if self.file is None or not self.resumable():
+            return False
+        self.stream_position = self.file.tell()
+        self.file.close()
+        self.file = None
+        return True
+
+    def resumable(self):
+        return self.type == "dada"
+
+    def metadata(self):
+        """
+        Description:
+        ------------
+            Parsed DADA header (see inc/dada.py). The header is read once and cached,
+            the file does not need to be opened.
+        Parameters
+        ----------
+            None
+        Returns:
+        --------
+            DadaHeader or None for 'pcap' files
+        """
+        if self.type != "dada":
+            return None
+        return read_dada_header(self.fname)
 
     def empty(self):
         """
@@ -561,6 +672,8 @@ class CodifFile:
         --------
             Returns True if end is reached otherwise false
         """
+        if self.file is None:
+            return self.stream_position >= self.endlocation
         if self.file.tell() >= self.endlocation:
             return True
         else:
@@ -655,6 +768,8 @@ class CodifFile:
         --------
             True on success and False on failure
         """
+        if self.profiler is not None:
+            start = clock()
         # Read packet from pcap file
         if self.type == "pcap":
             # Pcap library directly supports frame collecting
@@ -668,6 +783,8 @@ class CodifFile:
                 self.seek(CODIF_PAYLOAD, 1)    # And skip the payload
             else:
                 packet = self.file.read(CODIF_PACKET_SIZE)
+        if self.profiler is not None:
+            self.profiler.add("read", start)
 
         # Check if we have enough bytes to create a packet
         if len(packet) >= CODIF_PACKET_SIZE:
@@ -677,7 +794,7 @@ class CodifFile:
                 self.add()
             # Reuse object by just updateing payload and header data
             else:
-                self.packet.update(io.BytesIO(packet), skip_payload)
+                self.packet.update(io.BytesIO(packet), skip_payload, self.profiler)
             self.packet_cnt += 1
             return True
         else:
@@ -714,6 +831,7 @@ class CodifFile:
             if self.packet.header.beam_id == nelements-1:
                 if len(frame) == None:
                     frame = []
+                self.frame_cnt += 1
                 return frame
 
     def add(self, packet=None):
@@ -759,7 +877,7 @@ class CodifFile:
 
 
 
-    def read(self, packets=-1, validate=False, add=False, verbose=False, skip_payload=False):
+    def read(self, packets=-1, validate=False, add=False, verbose=False, skip_payload=False, reference=None):
         """
         Description:
         ------------
@@ -779,13 +897,22 @@ class CodifFile:
                 = True, verbose messages. Has only effect in combination with validate
             skip_payload : bool
                 = True, skips the payload
+            reference : tuple
+                (beam_id, frame_id, epoch) of the packet preceding the first read packet, e.g. the
+                last packet of the previous file (see CodifStream.reference()). If not set the
+                first packet is taken as reference and is not proofed (optional)
         Returns:
         --------
             -
         """
-        ref_beam = 0
-        ref_frame = 0
-        ref_epoch = 0
+        if reference is None:
+            # The first packet has no predecessor and is taken as reference
+            if not self.next(skip_payload, add):
+                return
+            reference = (self.packet.header.beam_id, self.packet.header.frame_id, self.packet.header.epoch)
+            if packets > 0:
+                packets -= 1
+        ref_beam, ref_frame, ref_epoch = reference
         # If not the entire file should be read
         if packets != -1:
             bytes = packets*CODIF_PACKET_SIZE
@@ -835,35 +962,169 @@ class CodifFile:
         with open(fname+".json", "w") as f:
             json.dump(self.faulty_packets, f, indent=4)
 
-    def write(self, start=0, end=None, keep=False):
+    def packet_times(self, headers, reference=None):
         """
         Description:
         ------------
-            Not implemented
+            Time of packets in seconds since UTC_START, derived from their frame time. The first
+            non-zeroed packet of the file is placed at its position given by the DADA header
+            (OBS_OFFSET, BYTES_PER_SECOND). Without DADA header the first packet is at 0.
         Parameters
         ----------
-            -
+            headers : Headers
+                Decoded headers of the packets
+            reference : tuple
+                (seconds, frame time) of the reference packet, see reference_time() (optional)
         Returns:
         --------
-            -
+            float64 array
         """
-        # if self.output_file:
-        #     if end == None:
-        #         end = len(self.packet_list)
-        #     if start > end:
-        #         raise HandlerError("failed write(): start index is greater than end index")
-        #     if len(self.packet_list) >= end:
-        #         for packet_idx in range(start,end):
-        #             self.output_file.write(self.packet_list[packet_idx].stream)
-        #         if keep:
-        #             return
-        #         self.packet_list.clear()
-        #     else:
-        #         raise HandlerError("failed write(): list out of range")
-        #
-        # else:
-        #     raise HandlerError("failed write(): File not opened, can not write")
-
+        if reference is None:
+            reference = self.reference_time()
+        return reference[0] + frame_time(headers.epoch, headers.frame_id) - reference[1]
+
+    def reference_time(self, batch=4096):
+        # (seconds since UTC_START, frame time) of the first non-zeroed packet
+        data = self.packet_view()
+        for start in range(0, len(data), batch):
+            headers = Headers(data[start:start+batch])
+            valid = np.flatnonzero(~headers.zeroed)
+            if len(valid):
+                idx = valid[0]
+                header = self.metadata()
+                seconds = header.time_of(start + idx) if header is not None and header.bytes_per_second else 0.0
+                return seconds, frame_time(int(headers.epoch[idx]), int(headers.frame_id[idx]))
+        return 0.0, 0.0
+
+    def packet_view(self):
+        # Memory mapped packets of a 'dada' file, only the touched pages are read
+        if self.type != "dada":
+            raise HandlerError("Failed: only 'dada' files can be mapped")
+        if not int(self.npackets):
+            return np.zeros((0, CODIF_PACKET_SIZE), dtype=np.uint8)
+        return np.memmap(self.fname, dtype=np.uint8, mode="r", offset=DADA_HEADER_SIZE, shape=(int(self.npackets), CODIF_PACKET_SIZE))
+
+    def select(self, start=None, stop=None, beams=None, freq_group=None, batch=65536):
+        """
+        Description:
+        ------------
+            Selects packets by time range, beam_id and freq_group. Only the headers are read.
+            Zeroed packets are never selected.
+        Parameters
+        ----------
+            start : float
+                Seconds since UTC_START, earlier packets are skipped (optional)
+            stop : float
+                Seconds since UTC_START, later packets are skipped (optional)
+            beams : list
+                beam_ids to keep (optional, default all)
+            freq_group : int
+                freq_group to keep (optional, default all)
+            batch : int
+                Number of headers decoded at once
+        Returns:
+        --------
+            int64 array of the indices of the selected packets
+        """
+        data = self.packet_view()
+        reference = self.reference_time() if start is not None or stop is not None else None
+        selected = []
+        for first in range(0, len(data), batch):
+            headers = Headers(data[first:first+batch])
+            keep = ~headers.zeroed
+            if reference is not None:
+                seconds = self.packet_times(headers, reference)
+                if start is not None:
+                    keep &= seconds >= start
+                if stop is not None:
+                    keep &= seconds < stop
+            if beams is not None:
+                keep &= np.isin(headers.beam_id.astype(np.int64), np.asarray(list(beams), dtype=np.int64))
+            if freq_group is not None:
+                keep &= headers.freq_group == freq_group
+            selected.append(np.flatnonzero(keep) + first)
+        return np.concatenate(selected) if selected else np.zeros(0, dtype=np.int64)
+
+    def write(self, fname, start=None, stop=None, beams=None, freq_group=None, type="dada", buffer_size=64*1024**2):
+        """
+        Description:
+        ------------
+            Writes the packets selected by select() into a new 'dada' or 'pcap' file.
+            Contiguous runs of packets are copied within the kernel (see copy_range()), thus
+            extracts are written at disk speed. The DADA header of the source is kept with
+            updated FILE_SIZE and OBS_OFFSET, selecting beams also updates NBEAM and BYTES_PER_SECOND.
+            'pcap' files get the network layers of inc/synthetic.py and timestamps derived
+            from UTC_START and the frame time.
+        Parameters
+        ----------
+            fname : string
+                Output file
+            start, stop, beams, freq_group :
+                Selection, see select()
+            type : string
+                'dada' or 'pcap'
+            buffer_size : int
+                Maximum number of bytes read at once if the packets have to be converted ('pcap')
+        Returns:
+        --------
+            Number of written packets
+        """
+        if type not in ("dada", "pcap"):
+            raise HandlerError("Failed: write() does not know format " + str(type))
+        index = self.select(start, stop, beams, freq_group)
+        # Runs of consecutive packets (first packet, number of packets)
+        breaks = np.flatnonzero(np.diff(index) != 1) + 1
+        run_start = index[np.concatenate(([0], breaks))] if len(index) else index
+        run_count = np.diff(np.concatenate(([0], breaks, [len(index)]))) if len(index) else index
+        header = self.metadata()
+        src = os.open(self.fname, os.O_RDONLY)
+        dst = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            if type == "dada":
+                keys = OrderedDict(header.keys)
+                keys["FILE_SIZE"] = len(index) * CODIF_PACKET_SIZE
+                rate = 1.0
+                if beams is not None and header.nbeam:
+                    keys["NBEAM"] = len(beams)
+                    rate = len(beams) / header.nbeam
+                    if header.bytes_per_second:
+                        keys["BYTES_PER_SECOND"] = repr(header.bytes_per_second * rate)
+                if len(index):
+                    # The first packet keeps its time relative to UTC_START (see DadaHeader.time_of())
+                    keys["OBS_OFFSET"] = int(round((header.obs_offset + int(index[0]) * CODIF_PACKET_SIZE) * rate))
+                write_all(dst, format_dada_header(keys, header.hdr_size))
+                for first, count in zip(run_start, run_count):
+                    copy_range(src, dst, DADA_HEADER_SIZE + int(first) * CODIF_PACKET_SIZE, int(count) * CODIF_PACKET_SIZE)
+            else:
+                self.write_pcap(dst, header, run_start, run_count, buffer_size)
+        finally:
+            os.close(src)
+            os.close(dst)
+        return len(index)
+
+    def write_pcap(self, dst, header, run_start, run_count, buffer_size):
+        # Packets are read run by run, prefixed with record and network headers and written in bulk
+        data = self.packet_view()
+        utc = header.start_time() if header is not None and header.start_time() is not None else 0
+        reference = self.reference_time()
+        write_all(dst, struct.pack("<IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+        record = 16 + CODIF_HEADER_TOTAL - CODIF_HEADER
+        batch = max(buffer_size // CODIF_TOTAL_SIZE, 1)
+        for first, count in zip(run_start, run_count):
+            for pos in range(int(first), int(first + count), batch):
+                packets = np.asarray(data[pos:min(pos + batch, first + count)])
+                headers = Headers(packets)
+                stamp = utc + self.packet_times(headers, reference)
+                out = np.empty((len(packets), record + CODIF_PACKET_SIZE), dtype=np.uint8)
+                # Rounding the microseconds after the split could give 1000000
+                seconds, usec = divmod(np.round(stamp * 1e6).astype(np.int64), 1000000)
+                out[:, :16] = np.stack((seconds, usec, np.full(len(packets), CODIF_TOTAL_SIZE),
+                    np.full(len(packets), CODIF_TOTAL_SIZE)), axis=1).astype("<u4").view(np.uint8)
+                for beam in np.unique(headers.beam_id):
+                    rows = headers.beam_id == beam
+                    out[rows, 16:record] = np.frombuffer(network_header(UDP_BASE_PORT + int(beam), UDP_BASE_PORT + int(headers.freq_group[rows][0])), dtype=np.uint8)
+                out[:, record:] = packets
+                write_all(dst, out.tobytes())
 
     # Horrible dirty function
     def proof_order(self, packet, ref_beam, ref_frame, ref_epoch):
@@ -912,6 +1173,26 @@ class CodifFile:
             #self.faulty_list.append([self.packet_cnt, deepcopy(packet)])
             self.faulty_cnt += 1
 
+    def metrics_sample(self):
+        """
+        Description:
+        ------------
+            Samples the counters of the file. Called by MetricsRegistry from another thread,
+            all counters have this object as single writer.
+        Parameters
+        ----------
+            None
+        Returns:
+        --------
+            Tuple of (packets, bytes, faulty, zeroed, frames, acm_frames), see inc.metrics.FIELDS
+        """
+        packets = self.packet_cnt - 1
+        if self.type == "pcap":
+            size = CODIF_TOTAL_SIZE
+        else:
+            size = CODIF_PACKET_SIZE
+        return (packets, packets*size, self.faulty_cnt, self.zeroed_cnt, self.frame_cnt, self.acm_frame_cnt)
+
     def not_order_msg(self, packet, ref_beam, ref_frame, ref_epoch):
         """
         Description:
@@ -944,6 +1225,380 @@ class CodifFile:
         return string
 
 
+class FilePool:
+    """
+    Description:
+    ------------
+        Bounded pool of opened CodifFiles. Files are opened on demand by acquire(). If more than
+        max_open files are open, the least recently used file which is not acquired is closed.
+        A closed 'dada' file is reopened at its previous position, thus counters and
+        stream positions are kept. The pool is thread safe.
+
+    Attributes
+    ----------
+        max_open : int
+            Maximum number of open files (may be exceeded by acquired files)
+        opened : OrderedDict
+            Open files in the order of their last use, values are the number of acquisitions
+    Methods
+    -------
+        acquire(self, file)
+            Opens the file if necessary and protects it from being closed
+        release(self, file)
+            Allows the pool to close the file
+        close(self)
+            Closes all files
+    """
+    def __init__(self, max_open=64):
+        self.max_open = max_open
+        self.opened = OrderedDict()
+        self.lock = Lock()
+
+    def acquire(self, file):
+        with self.lock:
+            users = self.opened.pop(file, 0)
+            file.open()
+            self.opened[file] = users + 1
+            self.evict()
+        return file
+
+    def release(self, file):
+        with self.lock:
+            if file in self.opened:
+                self.opened[file] = max(self.opened[file] - 1, 0)
+                self.evict()
+
+    def evict(self):
+        # Oldest entries come first
+        for file in list(self.opened):
+            if len(self.opened) <= self.max_open:
+                break
+            if self.opened[file] == 0 and file.close():
+                del self.opened[file]
+
+    def close(self):
+        with self.lock:
+            for file in self.opened:
+                file.close()
+            self.opened.clear()
+
+
+def stream_key(file):
+    """
+    Description:
+    ------------
+        Sort key of consecutive files, the timestamp (offset) in the filename (see splitter())
+    """
+    return (splitter(os.path.basename(file.fname)), file.fname)
+
+
+class CodifStream:
+    """
+    Description:
+    ------------
+        CodifStream presents consecutive '.dada' files of one node as one continuous sequence of
+        packets. Files are ordered by the timestamp in their name and opened on demand by a
+        FilePool, thus frames which are split over two files are assembled and validation
+        continues over file boundaries.
+
+    Attributes
+    ----------
+        files : list of CodifFile
+            Files ordered by stream_key()
+        pool : FilePool
+            Opens and closes the files
+        file : CodifFile
+            The file of the latest packet
+        packet : CodifPacket
+            The latest packet that was parsed
+        npackets : int
+            Number of packets of all files
+        profiler : StageProfiler
+            Passed to the current file (optional)
+        ranges : dict
+            Byte range (begin, end) per file set by select(), empty if all packets are read
+    Methods
+    -------
+        select(self, start, stop, align)
+            Restricts the stream to a time range using the DADA headers
+        skip_to(self, index, offset)
+            Skips all packets before a byte offset of a file (e.g. to resume from a checkpoint)
+        next(self, skip_payload)
+            Collects the next CodifPacket of the stream
+        next_frame(self, nelements, skip_payload)
+            Collects a dataframe, which may be split over two files
+        batches(self, buffer_size, direct)
+            Yields large batches of packets of all files read by one PrefetchReader
+        reference(self, file)
+            Returns the reference for validating the first packet of a file
+        close(self)
+            Closes all files
+    """
+    def __init__(self, files, type="dada", direct=False, pool=None, max_open=4):
+        """
+        Description:
+        ------------
+            Constructor of CodifStream.
+
+        Parameters
+        ----------
+            files : list of strings or CodifFile
+                Consecutive files of one node. Filenames are opened lazily.
+            type : string
+                Filetype of passed filenames
+            direct : bool
+                Read passed filenames with O_DIRECT
+            pool : FilePool
+                Pool shared with other streams (optional)
+            max_open : int
+                Size of the pool if no pool is passed (optional)
+        """
+        files = [f if isinstance(f, CodifFile) else CodifFile(f, type, direct, lazy=True) for f in files]
+        self.files = sorted(files, key=stream_key)
+        self.own_pool = pool is None
+        self.pool = pool if pool is not None else FilePool(max_open)
+        self.index = -1
+        self.file = None
+        self.packet = None
+        self.profiler = None
+        self.ranges = {}
+        self.npackets = sum(int(f.npackets) for f in self.files)
+
+    def __len__(self):
+        return len(self.files)
+
+    def select(self, start=None, stop=None, align=1):
+        """
+        Description:
+        ------------
+            Restricts the stream to packets recorded between start and stop. The positions are
+            computed from OBS_OFFSET, BYTES_PER_SECOND and PKT_SIZE of the DADA headers, thus
+            no packet is read and files outside of the range are not opened.
+        Parameters
+        ----------
+            start : float
+                Seconds since UTC_START (optional, default beginning of the stream)
+            stop : float
+                Seconds since UTC_START (optional, default end of the stream)
+            align : int
+                The first packet is rounded down and the last packet up to a multiple of
+                align packets, e.g. the number of beams of a frame (optional)
+        Returns:
+        --------
+            Number of selected packets
+        """
+        self.ranges = {}
+        total = 0
+        for file in self.files:
+            header = file.metadata()
+            if header is None or not header.bytes_per_second:
+                raise HandlerError("Failed select(): " + file.fname + " has no BYTES_PER_SECOND in its DADA header")
+            npackets = int(file.npackets)
+            first = 0
+            last = npackets
+            if start is not None:
+                first = min(max(header.packet_at(start) // align * align, 0), npackets)
+            if stop is not None:
+                last = min(max(-(-(header.packet_at(stop) + 1) // align) * align, first), npackets)
+            self.ranges[file] = (DADA_HEADER_SIZE + first*CODIF_PACKET_SIZE, DADA_HEADER_SIZE + last*CODIF_PACKET_SIZE)
+            total += last - first
+        return total
+
+    def skip_to(self, index, offset):
+        """
+        Description:
+        ------------
+            Restricts the stream to the packets starting at a position, packets before are not read
+        Parameters
+        ----------
+            index : int
+                Index of the file in files (len(files) skips the entire stream)
+            offset : int
+                Byte offset of the first packet to read within the file
+        """
+        ranges = {}
+        for idx, file in enumerate(self.files):
+            begin, end = self.span(file)
+            if idx < index:
+                begin = end
+            elif idx == index:
+                begin = min(max(begin, offset), end)
+            ranges[file] = (begin, end)
+        self.ranges = ranges
+
+    def span(self, file):
+        """
+        Description:
+        ------------
+            Byte range (begin, end) of the packets of a 'dada' file which are read
+        """
+        if file in self.ranges:
+            return self.ranges[file]
+        return (DADA_HEADER_SIZE, DADA_HEADER_SIZE + int(file.npackets)*CODIF_PACKET_SIZE)
+
+    def advance(self):
+        """
+        Description:
+        ------------
+            Switches to the next file of the stream
+        Returns:
+        --------
+            False if the end of the stream is reached
+        """
+        if self.file is not None:
+            self.file.profiler = None
+            self.pool.release(self.file)
+            self.file = None
+        while self.index + 1 < len(self.files):
+            self.index += 1
+            file = self.files[self.index]
+            if self.ranges:
+                begin, end = self.span(file)
+                if begin >= end:
+                    continue
+            self.file = self.pool.acquire(file)
+            self.file.profiler = self.profiler
+            if self.ranges and self.file.file.tell() < begin:
+                self.file.seek(begin)
+            return True
+        self.index = len(self.files)
+        return False
+
+    def readable(self):
+        # Checks if the current file has packets left within the selected range
+        return not self.ranges or self.file.file.tell() < self.span(self.file)[1]
+
+    def empty(self):
+        """
+        Description:
+        ------------
+            Returns True if all files (or all packets of the selected range) are read
+        """
+        for file in self.files[max(self.index, 0):]:
+            if self.ranges:
+                begin, end = self.span(file)
+                if file is self.file and file.file is not None:
+                    begin = max(begin, file.file.tell())
+                if begin < end:
+                    return False
+            elif not file.empty():
+                return False
+        return True
+
+    def next(self, skip_payload=False):
+        """
+        Description:
+        ------------
+            Collects the next CodifPacket. At the end of a file the stream continues with the next file.
+        Parameters
+        ----------
+            skip_payload : bool
+                If set to True the payload is not read from the file
+        Returns:
+        --------
+            True on success and False at the end of the stream
+        """
+        while True:
+            if self.file is not None and self.readable() and self.file.next(skip_payload):
+                self.packet = self.file.packet
+                return True
+            if not self.advance():
+                return False
+
+    def next_frame(self, nelements=36, skip_payload=False):
+        """
+        Description:
+        ------------
+            Collects a dataframe like CodifFile.next_frame(), but a frame is continued in the next file.
+            The frame is counted by the file containing its last packet.
+        Parameters
+        ----------
+            nelements : int
+                Number of elements (beam_id).
+            skip_payload : bool
+                If set to True the payload is not read from the file
+        Returns:
+        --------
+            List of CodifPacket or None at the end of the stream
+        """
+        epoch = -1
+        frame_id = -1
+        frame = []
+        while self.next(skip_payload):
+            header = self.packet.header
+            if header.epoch != 0 and epoch == -1:
+                epoch = header.epoch
+                frame_id = header.frame_id
+            if epoch == header.epoch and frame_id == header.frame_id:
+                frame.insert(header.beam_id, deepcopy(self.packet))
+            if header.beam_id == nelements-1:
+                self.file.frame_cnt += 1
+                return frame
+
+    def batches(self, buffer_size=128*1024**2, direct=False):
+        """
+        Description:
+        ------------
+            Reads all files with one PrefetchReader. The background thread continues with the next
+            file while the last buffer of a file is processed, files are opened one after the other.
+            Only 'dada' files are supported.
+        Parameters
+        ----------
+            buffer_size : int
+                Size of one buffer in bytes
+            direct : bool
+                Read with O_DIRECT
+        Returns:
+        --------
+            Generator of (CodifFile, uint8 array of shape (packets, CODIF_PACKET_SIZE)). The array is only valid until the next step
+        """
+        for file in self.files:
+            if file.type != "dada":
+                raise HandlerError("Failed: CodifStream.batches() supports only 'dada' files")
+        indices = [idx for idx, f in enumerate(self.files) if self.span(f)[0] < self.span(f)[1]]
+        segments = [(self.files[idx].fname,) + self.span(self.files[idx]) for idx in indices]
+        reader = PrefetchReader(segments=segments, buffer_size=buffer_size, direct=direct)
+        for packets in reader:
+            self.index = indices[reader.segment]
+            self.file = self.files[self.index]
+            yield self.file, packets
+        self.index = len(self.files)
+        self.file = None
+
+    def reference(self, file):
+        """
+        Description:
+        ------------
+            Reads the header of the last packet of the file preceding the passed file. It is used
+            as reference of CodifFile.read() to validate the first packet of a file.
+        Parameters
+        ----------
+            file : CodifFile
+                File of this stream
+        Returns:
+        --------
+            (beam_id, frame_id, epoch) or None for the first file of the stream
+        """
+        idx = self.files.index(file)
+        if idx == 0 or file.type != "dada":
+            return None
+        previous = self.files[idx-1]
+        if int(previous.npackets) < 1:
+            return None
+        with open(previous.fname, "rb") as f:
+            f.seek(DADA_HEADER_SIZE + (int(previous.npackets) - 1)*CODIF_PACKET_SIZE)
+            packet = CodifPacket(io.BytesIO(f.read(CODIF_PACKET_SIZE)), skip=True)
+        return (packet.header.beam_id, packet.header.frame_id, packet.header.epoch)
+
+    def close(self):
+        if self.file is not None:
+            self.pool.release(self.file)
+            self.file = None
+        # A shared pool is closed by its owner
+        if self.own_pool:
+            self.pool.close()
+
+
 class CodifHandler:
     """
     Description:
@@ -959,24 +1614,61 @@ class CodifHandler:
             All files must have the same type (either 'dada' or 'pcap')
         file_handle : list of CodifFile
             List containg all CodifFile objects
+        registry : MetricsRegistry
+            Collects the counters of all files which are currently processed
+        direct : bool
+            If True, files are read with O_DIRECT bypassing the page cache
+        pool : FilePool
+            Opens files on demand and limits the number of open files to max_open
+        streams : list of CodifStream
+            One stream of consecutive files per node
+        sk : SpectralKurtosis
+            RFI statistics of the last compute_acm() (None if disabled)
     Methods
     -------
-        validate(self, packets, threads, deamon)
-            Validates all passed files and visualize the progress within a curses window
+        validate(self, packets, threads, deamon, display, sinks, interval)
+            Validates all passed files and publishes the progress to metrics sinks (curses, log, json, prometheus)
         compute_acm(self, nelements, nsamples=128, nchannel=7, pol=2)
             Computes ACMs from a given file set. It should be noted that only files of the same channel group can be passed.
+        compute_acm_prefetched(self, nelements, nchannel=7, pol=2, prefetch=128)
+            Computes ACMs with background reads of large buffers and batched decoding and correlation
+        process(self, products, nelements, prefetch=128)
+            Reads all files once and feeds several products (validation, index, ACM, bandpass) with every batch
+        metadata(self)
+            Parsed DADA header of the first file
+        configure(self, nelements, start_time, stop_time)
+            Derives pipeline parameters from the DADA header and selects a time range
         plot_acm(self, acm, freq, dir="")
             Plots a passed ACM
-        merge()
-            not implemented
-        clean()
-            not implemented
-        to_array()
-            not implemented
+        merge(self, odir, file_size, window)
+            Repacks the files of every node ordered and without zeroed, duplicated and late packets into files of a fixed size
+        clean(self, odir, window)
+            Like merge(), the output files have the size of the input files
+        to_array(self, node, nelements, masked, index)
+            Lazy array of the voltages of a node, packets are decoded on access
         threaded_read(self, q, packets, validate, add, skip_payload)
-            Wraps CodifFile.read() into a Queue of Thread objects
+            Wraps CodifFile.read() into a Queue of Thread objects, items are tuples of (CodifStream, CodifFile)
     """
-    def __init__(self, fin_list, type="dada", fout=""):
+    def __init__(self, fin_list, type="dada", fout="", direct=False, max_open=64):
+        """
+        Description:
+        ------------
+            Constructor of CodifHandler. Only file sizes and node names are collected,
+            files are opened on demand by the FilePool.
+
+        Parameters
+        ----------
+            fin_list : list of strings
+                Files to handle
+            type : string
+                Filetype of all files
+            fout : string
+                Output file (not used)
+            direct : bool
+                Read files with O_DIRECT
+            max_open : int
+                Maximum number of files which are open at the same time
+        """
         print("Found " + str(len(fin_list)) + " files that matches expression")
         self.fin_list = fin_list
         self.fout = fout
@@ -984,16 +1676,122 @@ class CodifHandler:
         self.numa_list = []
         self.timestamp = 0
         self.total_packets = 0
-        # For each item in list create a CodifFile object
+        self.registry = MetricsRegistry()
+        self.profiler = None
+        self.sk = None
+        self.lock = Lock()
+        self.direct = direct
+        self.pool = FilePool(max_open)
+        node_files = {}
+        # For each item in list create a CodifFile object (not opened yet)
         for fname in (fin_list):
-            self.file_handle.append( CodifFile(fname, type) )
-            file = self.file_handle[-1]
-            if not file.node_name in self.numa_list:
-                self.numa_list.append(self.file_handle[-1].node_name)
-            self.total_packets += self.file_handle[-1].npackets
+            file = CodifFile(fname, type, direct, lazy=True)
+            self.file_handle.append( file )
+            if not file.node_name in node_files:
+                self.numa_list.append(file.node_name)
+                node_files[file.node_name] = []
+            node_files[file.node_name].append(file)
+            self.total_packets += file.npackets
+            self.registry.expect(file.node_name, file.npackets)
+        # Files of a node are consecutive segments of one stream
+        self.streams = []
+        for node in self.numa_list:
+            self.streams.append( CodifStream(node_files[node], pool=self.pool) )
 
 
-    def compute_acm(self, nelements, nsamples=CODIF_BLOCKS_IN_PACKET, nchannel=CODIF_CHANNELS_IN_BLOCK, pol=CODIF_POLARIZATION):
+    def metadata(self):
+        """
+        Description:
+        ------------
+            Returns the parsed DADA header of the first 'dada' file (see inc/dada.py).
+            All files of a snapshot are expected to be recorded with the same settings.
+        Parameters
+        ----------
+            None
+        Returns:
+        --------
+            DadaHeader or None if no 'dada' file is handled
+        """
+        for file in self.file_handle:
+            header = file.metadata()
+            if header is None:
+                continue
+            if header.pkt_size != CODIF_PACKET_SIZE:
+                raise HandlerError("Failed: " + file.fname + " contains packets of " + str(header.pkt_size) + " bytes")
+            if header.nchan != CODIF_CHANNELS_IN_BLOCK or header.npol != CODIF_POLARIZATION:
+                print("Warning: DADA header of " + file.fname + " reports " + str(header.nchan) + " channels and " + str(header.npol) + " polarizations")
+            return header
+        return None
+
+    def packet_settings(self, npackets=4096):
+        """
+        Description:
+        ------------
+            Decodes the headers of the first packets of the first 'dada' file which contains
+            non-zeroed packets
+        Parameters
+        ----------
+            npackets : int
+                Maximum number of decoded packets
+        Returns:
+        --------
+            Tuple of (freq_group, nelements), nelements is the largest beam_id + 1. (None, None) if no packet was found
+        """
+        for stream in self.streams:
+            for file in stream.files:
+                if file.type != "dada" or not int(file.npackets):
+                    continue
+                headers = Headers(np.asarray(file.packet_view()[:npackets]))
+                valid = ~headers.zeroed
+                if valid.any():
+                    return int(headers.freq_group[valid][0]), int(headers.beam_id[valid].max()) + 1
+        return None, None
+
+    def configure(self, nelements=None, start_time=None, stop_time=None):
+        """
+        Description:
+        ------------
+            Derives the number of elements and the channel frequencies from the DADA header and
+            restricts all streams to a time range (see CodifStream.select()) without reading packets.
+            FREQ_GROUP (or FREQ) and NBEAM of the header are checked against the first packets
+            (see packet_settings()), the values of the packets are used if they differ.
+        Parameters
+        ----------
+            nelements : int
+                Number of elements. If None, NBEAM of the DADA header is used (36 if not recorded)
+            start_time : float
+                Seconds since UTC_START of the first integrated packet (optional)
+            stop_time : float
+                Seconds since UTC_START of the last integrated packet (optional)
+        Returns:
+        --------
+            Tuple of (nelements, freq). freq is None if the header contains no frequency
+        """
+        header = self.metadata()
+        freq = None
+        if header is not None:
+            freq_group, nbeam = self.packet_settings()
+            freq = header.channel_frequencies()
+            if freq is not None and freq_group is not None and abs(freq[0] - freq_group) >= header.bw / header.nchan:
+                # The frequencies are derived from the first complete frame instead
+                print("Warning: DADA header reports " + str(freq[0]) + " MHz as first channel, but the packets belong to freq_group " + str(freq_group))
+                freq = None
+            if nelements is None and header.nbeam:
+                nelements = header.nbeam
+                if nbeam is not None and nbeam != header.nbeam:
+                    print("Warning: DADA header reports " + str(header.nbeam) + " beams, but the packets contain " + str(nbeam) + " beams")
+                    nelements = nbeam
+        if nelements is None:
+            nelements = 36
+        for stream in self.streams:
+            if start_time is not None or stop_time is not None:
+                packets = stream.select(start_time, stop_time, nelements)
+                print("Selected " + str(packets) + "/" + str(stream.npackets) + " packets between " + str(start_time) + " s and " + str(stop_time) + " s")
+            else:
+                stream.ranges = {}
+        return nelements, freq
+
+    def compute_acm(self, nelements=None, nsamples=CODIF_BLOCKS_IN_PACKET, nchannel=CODIF_CHANNELS_IN_BLOCK, pol=CODIF_POLARIZATION, profiler=None, progress_rate=2.0, prefetch=0, start_time=None, stop_time=None, correlator="integer", checkpoint=None, cache=None, sk=None):
         """
         Description:
         ------------
@@ -1001,37 +1799,80 @@ class CodifHandler:
         Parameters
         ----------
             nelements : int
-                Number of elements which has to be equal to the recorded 'beams'.
+                Number of elements which has to be equal to the recorded 'beams'. If None
+                the number is taken from the DADA header (see configure())
             nsamples : int
                 Number of samples in a datablock (optional). Should not be set for now
             nchannel : int
                 Number of channels within a channel group (optional). Should not be set for now
             pol : int
                 Number of polarizations (optional). Should not be set for now
+            profiler : StageProfiler
+                Accumulates the time spent in read, header, payload, frame, correlate and output (optional)
+            progress_rate : float
+                Maximum number of progress updates per second, 0 disables the progress output (optional)
+            prefetch : int
+                Size of the prefetch buffers in MB (optional). If set, the files are read by a background
+                thread and processed in batches (see compute_acm_prefetched())
+            start_time : float
+                Seconds since UTC_START, packets recorded before are skipped without reading (optional)
+            stop_time : float
+                Seconds since UTC_START, packets recorded afterwards are skipped (optional)
+            correlator : string
+                Correlator of the batched path, 'integer' (exact) or 'complex64' (see inc/correlator.py)
+            checkpoint : Checkpoint
+                Saves the state of the batched path periodically and after every file (optional, see inc/checkpoint.py)
+            cache : ACMCache
+                Cache of per-file partial sums of the batched path (optional, see inc/cache.py)
+            sk : dict
+                Spectral kurtosis settings of the batched path (optional, see compute_acm_prefetched())
         Returns:
         --------
             Returns calculated ACM as 3D ndarray of size [channels, elements*pol, elements*pol] and frequencies of channels
         """
+        if prefetch > 0:
+            return self.compute_acm_prefetched(nelements, nchannel, pol, profiler, progress_rate, prefetch, start_time, stop_time, correlator, checkpoint, cache, sk)
+        if checkpoint is not None or cache is not None or sk:
+            print("Warning: checkpoints, caches and spectral kurtosis are only supported by the prefetched path (prefetch > 0)")
+        self.sk = None
+        nelements, freq = self.configure(nelements, start_time, stop_time)
+        progress = Progress(progress_rate)
+        status = ' Total frames: {:d}/{:d}, file frames: {:d}/{:d}, uncomplete: {:d}; duration: {:.2f} s'
         # Construct necessary numpy array
         acm = np.zeros((nchannel, nelements*pol, nelements*pol), dtype=np.complex64)
         data = np.zeros((nelements*pol, nsamples, nchannel), dtype=np.complex64)
-        freq = []
 
         # Set counters for displaying current progress
         frame_cnt = 0
         uncomplete_cnt = 0
 
-        # Iterate over all passed CodifFiles
-        for fidx, file in enumerate(self.file_handle):
-            print("\nWorking on file " + str(fidx+1) + "/" + str(len(self.file_handle)))
-            # Further variables (displaying purposes)
+        # Iterate over the streams of all nodes, frames are continued over file boundaries
+        fidx = 0
+        for stream in self.streams:
+            stream.profiler = profiler
+            file = None
             start = time.time()
             file_frame_cnt = 0
 
-            # As long as not all data read from current file
-            while not file.empty():
+            # As long as not all data read from current stream
+            while not stream.empty():
+                if profiler is not None:
+                    tstamp = clock()
+                    nested = profiler.elapsed()
                 # Read the next frame (A frame contains nelements == beams (e.g. 36) CodifPackets )
-                frame = file.next_frame(nelements)
+                frame = stream.next_frame(nelements)
+                if profiler is not None:
+                    tstamp = profiler.add("frame", tstamp, nested)
+                if stream.file is not file and stream.file is not None:
+                    if file is not None:
+                        self.registry.release(file)
+                    file = stream.file
+                    fidx += 1
+                    print("\nWorking on file " + str(fidx) + "/" + str(len(self.file_handle)))
+                    # Further variables (displaying purposes)
+                    start = time.time()
+                    file_frame_cnt = 0
+                    self.registry.register(file)
                 # Check if we should ignore frame (zeroed packets)
                 if frame != None:
                     # Check if we should ignore frame (packet loss)
@@ -1041,11 +1882,13 @@ class CodifHandler:
                         if frame_cnt == 0:
                             first_epoch = frame[0].header.epoch
                             first_frame_id = frame[0].header.frame_id
-                            # Calculate frequencies of channels
-                            freq = np.arange(frame[0].header.freq_group, frame[0].header.freq_group+7)
+                            # Calculate frequencies of channels if the DADA header does not contain them
+                            if freq is None:
+                                freq = np.arange(frame[0].header.freq_group, frame[0].header.freq_group+7)
 
                         frame_cnt += 1
                         file_frame_cnt += 1
+                        file.acm_frame_cnt += 1
 
                         # Iterate over each element (remember a frame contains all elements)
                         for element in frame:
@@ -1055,8 +1898,8 @@ class CodifHandler:
                         # Calculate ACM by dot product over each channel within a channel group
                         for chan in range(nchannel):
                             acm[chan] += data[:,:,chan].dot(data[:,:,chan].conj().T)
-                        # if frame_cnt == 50:
-                        #     return  acm, freq, frame_cnt
+                        if profiler is not None:
+                            tstamp = profiler.add("correlate", tstamp)
 
                     # Register lost packet
                     else:
@@ -1066,13 +1909,27 @@ class CodifHandler:
                     uncomplete_cnt += 1
 
                 # Display progress
-                sys.stdout.write('\r Total frames: {:d}/{:d}, file frames: {:d}/{:d}, uncomplete: {:d}; duration: {:.2f} s' \
-                    .format(frame_cnt + uncomplete_cnt,
+                if file is not None:
+                    progress.update(status,
+                        frame_cnt + uncomplete_cnt,
                         int(self.total_packets/nelements),
                         file_frame_cnt + uncomplete_cnt,
                         int(file.npackets/nelements),
                         uncomplete_cnt,
-                        time.time()-start))
+                        time.time()-start)
+                if profiler is not None:
+                    profiler.add("output", tstamp)
+            if file is not None:
+                progress.update(status,
+                    frame_cnt + uncomplete_cnt,
+                    int(self.total_packets/nelements),
+                    file_frame_cnt + uncomplete_cnt,
+                    int(file.npackets/nelements),
+                    uncomplete_cnt,
+                    time.time()-start,
+                    force=True)
+                self.registry.release(file)
+            stream.profiler = None
 
         try:
             # Get last epoch and frame index
@@ -1086,15 +1943,285 @@ class CodifHandler:
         except:
             print("\nCould not determine duration, last frame has no content")
 
-        return acm, freq, frame_cnt
+        return acm, freq if freq is not None else [], frame_cnt
+
 
 
+    def compute_acm_prefetched(self, nelements=None, nchannel=CODIF_CHANNELS_IN_BLOCK, pol=CODIF_POLARIZATION, profiler=None, progress_rate=2.0, prefetch=128, start_time=None, stop_time=None, correlator="integer", checkpoint=None, cache=None, sk=None):
+        """
+        Description:
+        ------------
+            Computes an ACM like compute_acm(), but reads the files with a PrefetchReader. While the
+            background thread fills the next buffer, the packets of the current buffer are decoded,
+            assembled to frames (FrameAssembler) and correlated block-wise (Correlator).
+            Frames which are split over two buffers or two files are assembled as well.
+            Only 'dada' files are supported.
+        Parameters
+        ----------
+            nelements : int
+                Number of elements which has to be equal to the recorded 'beams'.
+            nchannel : int
+                Number of channels within a channel group (optional). Should not be set for now
+            pol : int
+                Number of polarizations (optional). Should not be set for now
+            profiler : StageProfiler
+                Accumulates the time spent in read, frame (header decoding and assembly), correlate and output (optional)
+            progress_rate : float
+                Maximum number of progress updates per second, 0 disables the progress output (optional)
+            prefetch : int
+                Size of one prefetch buffer in MB. Rounded to complete frames, but not larger than the largest file
+            start_time : float
+                Seconds since UTC_START, packets recorded before are skipped without reading (optional)
+            stop_time : float
+                Seconds since UTC_START, packets recorded afterwards are skipped (optional)
+            correlator : string
+                'integer' accumulates exactly in int64, 'complex64' in complex64 (see inc/correlator.py)
+            checkpoint : Checkpoint
+                Saves the accumulated ACM, the pending packets and the position within the files at the
+                interval of the checkpoint and at the end of every file. If the checkpoint resumes, the
+                computation continues from the saved state (optional, see inc/checkpoint.py)
+            cache : ACMCache
+                Every file is integrated separately and its partial sum is stored in the cache. Files whose
+                partial sum is cached are not read, their sums are merged (optional, see inc/cache.py)
+            sk : dict
+                Settings of the spectral kurtosis RFI test (frames, threshold, fraction, exclude), see inc/rfi.py.
+                The statistics are stored in the attribute sk (SpectralKurtosis). With exclude, the ACM
+                of a channel only contains the frames of blocks which passed the test (optional)
+        Returns:
+        --------
+            Returns calculated ACM as 3D ndarray of size [channels, elements*pol, elements*pol], frequencies of channels
+            and the number of integrated frames
+        """
+        for file in self.file_handle:
+            if file.type != "dada":
+                raise HandlerError("Failed: compute_acm_prefetched() supports only 'dada' files")
+        nelements, freq = self.configure(nelements, start_time, stop_time)
+        progress = Progress(progress_rate)
+        status = ' Total frames: {:d}/{:d}, file frames: {:d}/{:d}, uncomplete: {:d}; duration: {:.2f} s'
+        if correlator not in CORRELATORS:
+            raise HandlerError("Failed: unknown correlator '" + str(correlator) + "', use one of " + ", ".join(sorted(CORRELATORS)))
+        name = correlator
+        correlator = CORRELATORS[correlator](nelements, nchannel, pol, sk=sk)
+        self.sk = correlator.sk
+        assembler = FrameAssembler(nelements)
+        sk_settings = str(sorted(sk.items())) if sk else "None"
+        # Partial sums without spectral kurtosis keep their cache keys
+        settings = (nelements, nchannel, pol, name) + ((sk_settings,) if sk else ())
+        # Next byte to read (file index, offset) of every stream
+        positions = np.array([(0, 0) for stream in self.streams], dtype=np.int64).reshape(-1, 2)
+        fnames = np.array([f.fname for stream in self.streams for f in stream.files])
+        # The positions of a checkpoint are only valid for the same time range
+        time_range = str((start_time, stop_time))
+        if checkpoint is not None:
+            state = checkpoint.load()
+            if state is not None and "done" not in state:
+                if (list(state["files"]) != list(fnames) or int(state["nelements"]) != nelements
+                    or str(state["correlator"]) != name or str(state.get("sk", "None")) != sk_settings
+                    or str(state.get("time_range", "None")) != time_range):
+                    print("Warning: checkpoint " + checkpoint.fname + " belongs to other files or settings, starting over")
+                else:
+                    correlator.restore(dict((key[11:], value) for key, value in state.items() if key.startswith("correlator_")))
+                    assembler.restore(dict((key[10:], value) for key, value in state.items() if key.startswith("assembler_")))
+                    positions = state["positions"]
+                    for stream, (index, offset) in zip(self.streams, positions):
+                        stream.skip_to(index, offset)
+                    print("Resuming from checkpoint " + checkpoint.fname + " with " + str(correlator.frame_cnt) + " integrated frames")
+                    if cache is not None:
+                        # Partial sums of a resumed stream depend on the checkpoint, they are not cached
+                        print("Warning: the cache is not used while resuming from a checkpoint")
+                        cache = None
+        # Partial sum of the current file if the cache is used
+        part = {"correlator" : None, "start" : None, "first" : None}
+
+        def save():
+            state = {"files" : fnames, "nelements" : np.array(nelements), "correlator" : np.array(name), "sk" : np.array(sk_settings),
+                "time_range" : np.array(time_range), "positions" : positions}
+            for key, value in correlator.state().items():
+                state["correlator_" + key] = value if part["correlator"] is None else value + part["correlator"].state()[key]
+            for key, value in assembler.state().items():
+                state["assembler_" + key] = value
+            checkpoint.save(state)
+        # Buffers contain complete frames (no pending packets for lossless data) and are not larger than needed
+        frame_size = nelements*CODIF_PACKET_SIZE
+        largest = max([stream.span(f)[1] - stream.span(f)[0] for stream in self.streams for f in stream.files] + [frame_size])
+        buffer_size = max(min(prefetch*1024**2, largest + frame_size - 1) // frame_size, 1) * frame_size
+
+        def split(entry, prefix):
+            return dict((key[len(prefix):], value) for key, value in entry.items() if key.startswith(prefix))
+
+        def merge_cached(sums, until):
+            # Merges the cached partial sums of the files which precede the next file to read
+            for cached, entry in sums.entries(until):
+                correlator.merge(split(entry, "correlator_"))
+                assembler.merge(split(entry, "assembler_"))
+                print("Merged cached partial sum of " + cached.fname)
+
+        def begin_file():
+            part["correlator"] = CORRELATORS[name](nelements, nchannel, pol, sk=sk)
+            part["start"] = assembler.state()
+            part["first"] = assembler.first
+            assembler.first = None
+
+        def end_file(sums, file):
+            # Stores the partial sum of a completely read file and adds it to the total
+            start = part["start"]
+            end = assembler.state()
+            entry = {"assembler_pending" : end["pending"], "assembler_counters" : end["counters"] - start["counters"],
+                "assembler_first" : end["first"], "assembler_last" : end["last"] if assembler.frame_cnt > int(start["counters"][0]) else np.array((-1, -1, -1))}
+            for key, value in part["correlator"].state().items():
+                entry["correlator_" + key] = value
+            sums.store(file, entry)
+            correlator.merge(part["correlator"].state())
+            part["correlator"] = None
+            if part["first"] is not None:
+                assembler.first = part["first"]
+
+        fidx = 0
+        for sidx, stream in enumerate(self.streams):
+            file = None
+            sums = None
+            if cache is not None:
+                sums = StreamSums(cache, stream.files, [stream.span(f) for f in stream.files], settings)
+                # Cached files are not read
+                if sums.cached:
+                    stream.ranges = dict((f, (stream.span(f)[1],)*2 if f in sums.cached else stream.span(f)) for f in stream.files)
+                    fidx += len(sums.cached)
+            if profiler is not None:
+                tstamp = clock()
+            for current, packets in stream.batches(buffer_size, self.direct):
+                if profiler is not None:
+                    tstamp = profiler.add("read", tstamp)
+                if current is not file:
+                    if file is not None:
+                        self.registry.release(file)
+                        if sums is not None:
+                            end_file(sums, file)
+                    if sums is not None:
+                        merge_cached(sums, current)
+                        begin_file()
+                    file = current
+                    fidx += 1
+                    print("\nWorking on file " + str(fidx) + "/" + str(len(self.file_handle)))
+                    start = time.time()
+                    self.registry.register(file)
+                    positions[sidx] = (stream.index, stream.span(file)[0])
+                frames, keys = assembler.add(packets)
+                if profiler is not None:
+                    tstamp = profiler.add("frame", tstamp)
+                (part["correlator"] if part["correlator"] is not None else correlator).integrate(frames)
+                if profiler is not None:
+                    tstamp = profiler.add("correlate", tstamp)
+                file.packet_cnt += len(packets)
+                file.frame_cnt += len(frames)
+                file.acm_frame_cnt += len(frames)
+                positions[sidx, 1] += len(packets)*CODIF_PACKET_SIZE
+                if checkpoint is not None and (checkpoint.due() or positions[sidx, 1] >= stream.span(file)[1]):
+                    save()
+                progress.update(status,
+                    assembler.frame_cnt + assembler.uncomplete_cnt,
+                    int(self.total_packets/nelements),
+                    file.frame_cnt,
+                    int(file.npackets/nelements),
+                    assembler.uncomplete_cnt,
+                    time.time()-start)
+                if profiler is not None:
+                    tstamp = profiler.add("output", tstamp)
+            if file is not None:
+                self.registry.release(file)
+                if sums is not None:
+                    end_file(sums, file)
+            if sums is not None:
+                merge_cached(sums, None)
+            positions[sidx] = (len(stream.files), 0)
+        assembler.flush()
+
+        if assembler.first is not None:
+            # Calculate frequencies of channels if the DADA header does not contain them and snapshot duration
+            if freq is None:
+                freq = np.arange(assembler.first[2], assembler.first[2]+nchannel)
+            duration = frame_time(*assembler.last[:2]) - frame_time(*assembler.first[:2])
+            print("\nDuration of record: " +str(duration) + " s")
+        else:
+            print("\nCould not determine duration, no complete frame found")
+        return correlator.result(), freq if freq is not None else [], correlator.frame_cnt
 
-    def validate(self, packets=-1, threads=1, deamon=True, display="file"):
+    def process(self, products, nelements=None, profiler=None, progress_rate=2.0, prefetch=128, start_time=None, stop_time=None):
         """
         Description:
         ------------
-            Validates all files in file_handle list
+            Reads all streams once and passes every batch of packets to several products (see inc/pipeline.py),
+            e.g. validation counters, packet index, ACM and bandpass. The headers of a batch are decoded once
+            for all products. Only 'dada' files are supported.
+        Parameters
+        ----------
+            products : list
+                Objects with the methods add(stream, file, packets, headers) and end(stream)
+            nelements : int
+                Number of elements. If None, NBEAM of the DADA header is used
+            profiler : StageProfiler
+                Accumulates the time spent in read, decode and in every product (by class name) (optional)
+            progress_rate : float
+                Maximum number of progress updates per second, 0 disables the progress output (optional)
+            prefetch : int
+                Size of one prefetch buffer in MB. Rounded to complete frames, but not larger than the largest file
+            start_time : float
+                Seconds since UTC_START, packets recorded before are skipped without reading (optional)
+            stop_time : float
+                Seconds since UTC_START, packets recorded afterwards are skipped (optional)
+        Returns:
+        --------
+            Tuple of (nelements, freq) as returned by configure()
+        """
+        for file in self.file_handle:
+            if file.type != "dada":
+                raise HandlerError("Failed: process() supports only 'dada' files")
+        nelements, freq = self.configure(nelements, start_time, stop_time)
+        progress = Progress(progress_rate)
+        status = ' Total packets: {:d}/{:d}, file packets: {:d}/{:d}; duration: {:.2f} s'
+        frame_size = nelements*CODIF_PACKET_SIZE
+        largest = max([stream.span(f)[1] - stream.span(f)[0] for stream in self.streams for f in stream.files] + [frame_size])
+        buffer_size = max(min(prefetch*1024**2, largest + frame_size - 1) // frame_size, 1) * frame_size
+        names = [product.__class__.__name__ for product in products]
+        total = 0
+        fidx = 0
+        start = time.time()
+        for stream in self.streams:
+            file = None
+            if profiler is not None:
+                tstamp = clock()
+            for current, packets in stream.batches(buffer_size, self.direct):
+                if profiler is not None:
+                    tstamp = profiler.add("read", tstamp)
+                if current is not file:
+                    if file is not None:
+                        self.registry.release(file)
+                    file = current
+                    fidx += 1
+                    print("\nWorking on file " + str(fidx) + "/" + str(len(self.file_handle)))
+                    self.registry.register(file)
+                headers = Headers(packets)
+                file.packet_cnt += len(packets)
+                total += len(packets)
+                if profiler is not None:
+                    tstamp = profiler.add("decode", tstamp)
+                for name, product in zip(names, products):
+                    product.add(stream, file, packets, headers)
+                    if profiler is not None:
+                        tstamp = profiler.add(name, tstamp)
+                progress.update(status, total, int(self.total_packets), file.packet_cnt, int(file.npackets), time.time()-start)
+            if file is not None:
+                self.registry.release(file)
+            for product in products:
+                product.end(stream)
+        print("")
+        return nelements, freq
+
+    def validate(self, packets=-1, threads=1, deamon=True, display="file", sinks=None, interval=1.0, profiler=None):
+        """
+        Description:
+        ------------
+            Validates all files in file_handle list. The progress is published by a
+            MetricsReporter to the passed sinks (see inc/metrics.py).
         Parameters
         ----------
             packets : int
@@ -1103,209 +2230,122 @@ class CodifHandler:
                 Number of parallel threads
             daemon: bool
                 Run threads as daemon. Do not set to False!
+            display : string
+                Publish rows per 'file' or per 'node'
+            sinks : list
+                Metrics sinks (optional). If not set curses is used on a TTY, otherwise log lines
+            interval : float
+                Time between two updates of the sinks in seconds
+            profiler : StageProfiler
+                Accumulates the time spent in read and header decoding of all threads (optional)
         Returns:
         --------
             -
         """
         print("Starting to validate " +str(len(self.file_handle))+ " with " + str(threads) + " threads")
+        if sinks is None:
+            sinks = create_sinks([], display)
+        self.profiler = profiler
+
+        # Files of the same timestamp are processed together, thus all nodes progress evenly
+        self.jobs = Queue()
+        jobs = [(stream, file) for stream in self.streams for file in stream.files]
+        for stream, file in sorted(jobs, key=lambda job: stream_key(job[1])):
+            if file.npackets >= 1:
+                self.jobs.put( (stream, file) )
+
+        # Launch Threads
+        for t in range(threads):
+            thread = Thread(target=self.threaded_read, args=(self.jobs, packets, True, False, True))
+            thread.daemon = deamon
+            thread.start()
+
+        reporter = MetricsReporter(self.registry, sinks, interval)
+        reporter.start()
+        try:
+            self.jobs.join()
+        finally:
+            reporter.stop()
 
-        # Create Queue and assign work
-        uniques = sorted(set([re.split('\_|\.', f)[1] for f in self.fin_list]))
-
-        sub_handle = [[] for i in range(len(uniques))]
-        total_pkt_num = 0
-        total_pkt_cnt = 0
-        total_fal_cnt = 0
-        total_zro_cnt = 0
-        pkt_cnt = []
-        fal_cnt = []
-        zro_cnt = []
-        last_time = []
-
-        total_pkt_numa_num = [0 for i in range(len(self.numa_list))]
-
-        occurence = [0]*len(uniques)
-        for k, file in enumerate(self.file_handle):
-            if file.npackets < 1:
-                continue
-            for i, f_expr in enumerate(uniques):
-                if f_expr in file.fname:
-                    occurence[i] += 1
-                    sub_handle[i].append(file)
-            idx = self.numa_list.index(file.node_name)
-            total_pkt_numa_num[idx] += file.npackets
-            total_pkt_num += int(file.npackets)
+    def merge(self, odir, file_size=4*1024**3, window=64, prefetch=128, progress_rate=2.0, start_time=None, stop_time=None):
+        """
+        Description:
+        ------------
+            Repacks the files of every node into consolidated files of a fixed size in '<odir>/<node>/'.
+            Zeroed, duplicated and late packets are dropped, the packets are ordered by
+            (epoch, frame_id, beam_id) within a window of frames. Every node directory gets an
+            'index.npz' of the frames (see inc/repack.py).
+        Parameters
+        ----------
+            odir : string
+                Output directory
+            file_size : int
+                Size of the packets of one output file in bytes (rounded down to complete packets)
+            window : int
+                Number of frames which are kept for reordering
+            prefetch : int
+                Size of one prefetch buffer in MB
+            progress_rate : float
+                Maximum number of progress updates per second, 0 disables the progress output (optional)
+            start_time, stop_time : float
+                Time range in seconds since UTC_START (optional, see configure())
+        Returns:
+        --------
+            List of counters per node, see Repacker.summary()
+        """
+        return self.repack(Repacker(check_slash(odir), max(int(file_size) // CODIF_PACKET_SIZE, 1), window), prefetch, progress_rate, start_time, stop_time)
 
-        for node in self.numa_list:
-            last_time.append(time.time())
-            pkt_cnt.append(0)
-            fal_cnt.append(0)
-            zro_cnt.append(0)
-
-        file_cnt = [0 for i in range(max(occurence))]
-        for sub_idx, sub in enumerate(sub_handle):
-
-            sub_pkt_num = 0
-            rows = len(sub_handle[0]) + 5
-            cols = 10
-            display_list = []
-
-            total_rate = 0
-            cur_rate = 0
-
-
-            if display == "node":
-                last_pkt_cnt = [0 for i in range(len(self.numa_list))]
-                last_zro_cnt = [0 for i in range(len(self.numa_list))]
-                last_fal_cnt = [0 for i in range(len(self.numa_list))]
-
-            elif display == "file":
-                pkt_cnt = [0 for i in range(len(sub))]
-                fal_cnt = [0 for i in range(len(sub))]
-                zro_cnt = [0 for i in range(len(sub))]
-                last_pkt_cnt = [0 for i in range(len(sub))]
-                last_zro_cnt = [0 for i in range(len(sub))]
-                last_fal_cnt = [0 for i in range(len(sub))]
-
-            self.jobs = Queue()
-            for file_idx, file in enumerate(sub):
-                if file.npackets > 0:
-                    self.jobs.put( file )
-                    sub_pkt_num += file.npackets
-                    if sub_idx != 0:
-                        file_cnt[file_idx] += len(sub_handle[sub_idx-1])
-                    else:
-                        file_cnt[file_idx] += file_idx
-                # If the file is too "small" do not join Queue and delete from list
-                else:
-                    sub.remove(file)
-
-
-            # Launch Threads
-            for t in range(threads):
-                thread = Thread(target=self.threaded_read, args=(self.jobs, packets, True, False, True))
-                thread.daemon = deamon
-                thread.start()
-
-
-            file_header_row = ["File", "Progress", "Read pkt", "Total pkt", "Faulty [%]", "Faulty pkt", "Zeroed [%]", "Zeroed pkt", "Rate [pkt/s]", "Filename"]
-            seperater_row = ["------------", "------------", "------------", "------------", "------------", "------------", "------------", "------------", "------------", "------------"]
-
-            monitor = Monitor(rows, cols)
-            while not self.jobs.empty():
-                if not KeyboardInterrupt:
-                    monitor.close()
-                    break
-
-                for r in range(rows):
-                    display_list.append([])
-                    if r == 0:
-                        display_list[r] = file_header_row
-                        continue
-
-                    elif r == 1 or r == rows-1 or r == rows - 4:
-                        display_list[r] = seperater_row
-                        continue
-                    elif r == rows-2:
-                        if display == "file":
-                            display_list[r] = ['Subset',
-                                '{:.2f}%'.format(sum(pkt_cnt)/sub_pkt_num*100),
-                                ' ',' ',
-                                '{:.2f}%'.format(sum(fal_cnt)/sub_pkt_num*100),
-                                ' ',
-                                '{:.2f}%'.format(sum(zro_cnt)/sub_pkt_num*100),
-                                ' ',
-                                '{:.2f}'.format(total_rate),
-                                sub[0].fname.rsplit('/',1)[1]]
-                        elif display == "node":
-                            display_list[r] = seperater_row
-                    elif r == rows-3:
-                        display_list[r] = ['Total',
-                            '{:.2f}%'.format(total_pkt_cnt/total_pkt_num*100),
-                            ' ',' ',
-                            '{:.2f}%'.format(total_fal_cnt/total_pkt_num*100),
-                            ' ',
-                            '{:.2f}%'.format(total_zro_cnt/total_pkt_num*100),
-                            ' ',
-                            '{:.2f}'.format(total_rate),
-                            sub[0].fname.rsplit('/',1)[1]]
-                        total_rate = 0
-                    else:
-                        if display == "file":
-                            i = r-2
-                            if i < len(sub):
-                                file = sub[i]
-                                cur_dif = file.packet_cnt-last_pkt_cnt[i]
-                                cur_time = time.time()
-                                cur_rate = cur_dif/(cur_time-last_time[i])
-                                pkt_cnt[i] += cur_dif
-                                fal_cnt[i] += file.faulty_cnt - last_fal_cnt[i]
-                                zro_cnt[i] += file.zeroed_cnt - last_zro_cnt[i]
-                                total_pkt_cnt += cur_dif
-                                total_fal_cnt += file.faulty_cnt - last_fal_cnt[i]
-                                total_zro_cnt += file.zeroed_cnt - last_zro_cnt[i]
-                                total_rate += cur_rate
-                                display_list[r] = ['{:<5}'.format(file_cnt[i]),
-                                    '{:<6.2f}%'.format(file.packet_cnt/file.npackets*100),
-                                    '{:<9}'.format(file.packet_cnt),
-                                    '{:<9}'.format(file.npackets),
-                                    '{:<6.2f}%'.format(file.faulty_cnt/file.packet_cnt*100),
-                                    '{:<7}'.format(file.faulty_cnt),
-                                    '{:<6.2f}%'.format(file.zeroed_cnt/file.packet_cnt*100.0),
-                                    '{:<7}'.format(file.zeroed_cnt),
-                                    '{:<6.1f}'.format(cur_rate),
-                                    '{}'.format(file.fname)]
-
-                                last_time[i] = cur_time
-                                last_pkt_cnt[i] = file.packet_cnt
-                                last_zro_cnt[i] = file.zeroed_cnt
-                                last_fal_cnt[i] = file.faulty_cnt
-
-                        elif display == "node":
-                            i = r-2
-                            if i < len(sub):
-                                file = sub[i]
-                                idx = self.numa_list.index(file.node_name)
-                                cur_dif = file.packet_cnt-last_pkt_cnt[idx]
-                                cur_time = time.time()
-                                cur_rate = cur_dif/(cur_time-last_time[idx])
-                                pkt_cnt[idx] += cur_dif
-                                fal_cnt[idx] += file.faulty_cnt - last_fal_cnt[idx]
-                                zro_cnt[idx] += file.zeroed_cnt - last_zro_cnt[idx]
-                                total_pkt_cnt += cur_dif
-                                total_fal_cnt += file.faulty_cnt - last_fal_cnt[i]
-                                total_zro_cnt += file.zeroed_cnt - last_zro_cnt[i]
-                                total_rate += cur_rate
-                                display_list[r] = [self.numa_list[idx],
-                                    '{:<6.2f}%'.format(pkt_cnt[idx]/total_pkt_numa_num[idx]*100),
-                                    '{:<9}'.format(pkt_cnt[idx]),
-                                    '{:<9}'.format(total_pkt_numa_num[idx]),
-                                    '{:<6.2f}%'.format(fal_cnt[idx]/total_pkt_numa_num[idx]*100),
-                                    '{:<7}'.format(fal_cnt[idx]),
-                                    '{:<6.2f}%'.format(zro_cnt[idx]/total_pkt_numa_num[idx]*100.0),
-                                    '{:<7}'.format(zro_cnt[idx]),
-                                    '{:<6.1f}'.format(cur_rate),
-                                    '{}'.format(file.fname)]
-
-                                last_time[idx] = cur_time
-                                last_pkt_cnt[idx] = file.packet_cnt
-                                last_zro_cnt[idx] = file.zeroed_cnt
-                                last_fal_cnt[idx] = file.faulty_cnt
-
-                monitor.update(display_list)
-                time.sleep(0.2)
-
-	monitor.wait_for_input()
-	monitor.close()
-
-    def merge(self):
-        pass
-
-    def clean(self):
-        pass
-
-    def to_array(self):
-        pass
+    def clean(self, odir, window=64, prefetch=128, progress_rate=2.0, start_time=None, stop_time=None):
+        """
+        Description:
+        ------------
+            Like merge(), but the output files contain as many packets as the largest input file of
+            their node, thus the snapshot keeps its layout without zeroed, duplicated and late packets
+        Returns:
+        --------
+            List of counters per node, see Repacker.summary()
+        """
+        return self.repack(Repacker(check_slash(odir), None, window), prefetch, progress_rate, start_time, stop_time)
+
+    def repack(self, repacker, prefetch=128, progress_rate=2.0, start_time=None, stop_time=None):
+        # All packets are passed to the repacker, thus the number of elements only sets the read buffer size
+        header = self.metadata()
+        nelements = header.nbeam if header is not None and header.nbeam else 36
+        self.process([repacker], nelements, progress_rate=progress_rate, prefetch=prefetch, start_time=start_time, stop_time=stop_time)
+        summary = repacker.summary()
+        for item in summary:
+            print("Repacked " + str(item["packets"]) + " packets into " + str(item["files"]) + " files in " + item["directory"] + ", dropped zeroed: "
+                + str(item["zeroed"]) + ", duplicates: " + str(item["duplicates"]) + ", late: " + str(item["late"]))
+        return summary
+
+    def to_array(self, node=None, nelements=None, masked=False, index=None):
+        """
+        Description:
+        ------------
+            Returns the voltages of one node as lazy array of shape (frames, elements, samples,
+            channels, pol). Only the packet headers are read, packets are decoded when the array
+            is sliced (see inc/voltage.py).
+        Parameters
+        ----------
+            node : string
+                Name of the node (numa directory), optional if only one node is handled
+            nelements : int
+                Number of elements (optional, default NBEAM of the DADA header)
+            masked : bool
+                If True, slices are masked arrays with missing packets masked, otherwise they are zero
+            index : string
+                '.npz' file storing the frame map for later calls (optional)
+        Returns:
+        --------
+            VoltageArray
+        """
+        if node is None:
+            if len(self.streams) > 1:
+                raise HandlerError("Failed to_array(): select one of the nodes " + ", ".join(self.numa_list))
+            node = self.numa_list[0]
+        if node not in self.numa_list:
+            raise HandlerError("Failed to_array(): unknown node " + str(node))
+        return VoltageArray(self.streams[self.numa_list.index(node)].files, nelements, masked, index)
 
     def to_csv(self, dir, fname):
         # Store results in pandas dataframe
@@ -1324,36 +2364,23 @@ class CodifHandler:
 
     def threaded_read(self, q, packets=-1, validate=False, add=False, skip_payload=False):
         while True:
-            item = q.get()
-            item.read(packets, validate=validate, add=add, skip_payload=skip_payload)
-            q.task_done()
-
-
-class Monitor:
-    def __init__(self, rows, cols, col_width=12):
-        self.stdout = sys.stdout
-        self.rows = rows
-        self.cols = cols
-        self.col_width = col_width
-
-        # Create curses window
-        self.display = curses.initscr()
-        curses.noecho()
-        curses.cbreak()
-
-    def update(self, dlist):
-        # Below the current statistics are calculated
-        for r in range(self.rows):
-            for c in range(self.cols):
-                self.display.addstr(r,c*self.col_width, dlist[r][c])
-        self.display.refresh()
-
-    def wait_for_input(self):
-        while True:
-            c = self.display.getch()
-            if c:
-                break
-
-    def close(self):
-        curses.endwin()
-        sys.stdout = self.stdout
+            stream, item = q.get()
+            self.registry.register(item)
+            # Profilers are not thread safe, each file gets its own one
+            if self.profiler is not None:
+                item.profiler = self.profiler.child()
+            try:
+                # The first packet is proofed against the last packet of the previous file
+                reference = stream.reference(item)
+                self.pool.acquire(item)
+                try:
+                    item.read(packets, validate=validate, add=add, skip_payload=skip_payload, reference=reference)
+                finally:
+                    self.pool.release(item)
+            finally:
+                self.registry.release(item)
+                if item.profiler is not None:
+                    with self.lock:
+                        self.profiler.merge(item.profiler)
+                    item.profiler = None
+                q.task_done()
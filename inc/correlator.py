@@ -0,0 +1,250 @@
+"""
+ Description:
+ ------------
+    Correlators computing ACMs (Array Covariance Matrices) from blocks of assembled frames.
+    A block of frames (see FrameAssembler) is rearranged to one matrix per channel with
+    elements*pol rows and frames*samples columns, thus the ACM of a whole block is computed
+    by one matrix product per channel instead of one per frame.
+
+    The row order is equal to CodifHandler.compute_acm(): x-pol of all elements followed by y-pol.
+
+    Correlator accumulates in complex64, thus rounding errors grow with the integration time.
+    IntegerCorrelator correlates the int16 samples exactly: real and imaginary parts are
+    multiplied by one real GEMM per channel and block, whose result is an exact integer in
+    float64, and the results are accumulated in int64. The conversion to complex64 is done
+    once by result().
+
+    With sk (see inc/rfi.py) the spectral kurtosis of every element and channel is computed from the
+    same converted block, flagged blocks of frames can be excluded from the ACM per channel.
+
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+"""
+
+from __future__ import division
+import numpy as np
+
+from inc.constants import *
+from inc.rfi import SpectralKurtosis
+
+
+def to_voltages(frames, dtype=np.complex64):
+    """
+    Description:
+    ------------
+        Converts a block of frames to complex voltages per channel
+    Parameters
+    ----------
+        frames : numpy array
+            int16 array of shape (frames, elements, blocks, channels, pol, 2)
+        dtype : numpy dtype
+            Complex type of the voltages (optional)
+    Returns:
+    --------
+        Array of shape (channels, pol*elements, frames*blocks)
+    """
+    nframes, nelements, nsamples, nchannel, pol = frames.shape[:5]
+    real = np.dtype(dtype).char.lower()
+    data = frames.astype(real).view(dtype)[..., 0]
+    return data.transpose(3, 4, 1, 0, 2).reshape(nchannel, pol*nelements, nframes*nsamples)
+
+
+def to_real_rows(frames, dtype=np.float64):
+    """
+    Description:
+    ------------
+        Rearranges a block of frames to real rows per channel, the real parts of all
+        rows of to_voltages() are followed by their imaginary parts
+    Parameters
+    ----------
+        frames : numpy array
+            int16 array of shape (frames, elements, blocks, channels, pol, 2)
+        dtype : numpy dtype
+            Real type of the rows (optional)
+    Returns:
+    --------
+        Array of shape (channels, 2*pol*elements, frames*blocks)
+    """
+    nframes, nelements, nsamples, nchannel, pol = frames.shape[:5]
+    # Transposing int16 before the conversion moves a quarter of the bytes of a float64 transpose
+    data = np.ascontiguousarray(frames.transpose(3, 5, 4, 1, 0, 2)).astype(dtype)
+    return data.reshape(nchannel, 2*pol*nelements, nframes*nsamples)
+
+
+class Correlator:
+    """
+    Description:
+    ------------
+        Accumulates ACMs of blocks of frames in complex64
+
+    Attributes
+    ----------
+        nelements : int
+            Number of elements (beams)
+        nchannel : int
+            Number of channels
+        pol : int
+            Number of polarizations
+        acm : numpy array
+            Accumulated ACM of shape (channels, elements*pol, elements*pol)
+        frame_cnt : int
+            Number of integrated frames
+        block : int
+            Maximum number of frames converted at once, limits the size of temporary arrays
+        sk : SpectralKurtosis
+            RFI statistics, None if disabled. Created from a dictionary of settings (frames, threshold,
+            fraction, exclude), the block size is rounded to a multiple of the SK block
+    Methods
+    -------
+        integrate(frames)
+            Adds the ACM of a block of frames
+        result()
+            Returns the accumulated ACM as complex64
+        channel_frames()
+            Returns the number of integrated frames of every channel
+        state()
+            Returns the accumulated data as dictionary of arrays (e.g. for checkpoints)
+        restore(state)
+            Continues the accumulation of a state returned by state()
+        merge(state)
+            Adds a state of another correlator with the same settings (e.g. a partial sum)
+    """
+    def __init__(self, nelements, nchannel=CODIF_CHANNELS_IN_BLOCK, pol=CODIF_POLARIZATION, block=256, sk=None):
+        self.nelements = nelements
+        self.nchannel = nchannel
+        self.pol = pol
+        self.block = block
+        n = nelements * pol
+        self.sk = SpectralKurtosis(nchannel, n, **sk) if sk else None
+        if self.sk is not None:
+            self.block = max(block // self.sk.frames, 1) * self.sk.frames
+        self.acm = np.zeros((nchannel, n, n), dtype=np.complex64)
+        self.frame_cnt = 0
+
+    def integrate(self, frames):
+        """
+        Description:
+        ------------
+            Adds the ACM of a block of frames
+        Parameters
+        ----------
+            frames : numpy array
+                int16 array of shape (frames, elements, blocks, channels, pol, 2)
+        """
+        for start in range(0, len(frames), self.block):
+            data = to_voltages(frames[start:start+self.block])
+            if self.sk is not None:
+                keep = self.sk.test(data.real**2 + data.imag**2)
+                if keep is not None:
+                    data *= keep[:, None, :]
+            self.acm += np.matmul(data, data.conj().transpose(0, 2, 1))
+        self.frame_cnt += len(frames)
+
+    def result(self):
+        return self.acm
+
+    def channel_frames(self):
+        frames = np.full(self.nchannel, self.frame_cnt, dtype=np.int64)
+        if self.sk is not None and self.sk.exclude:
+            frames -= self.sk.flagged_frames
+        return frames
+
+    def accumulators(self):
+        # Names of the accumulated arrays
+        return ["acm"]
+
+    def state(self):
+        state = {"frame_cnt" : np.array(self.frame_cnt)}
+        for name in self.accumulators():
+            state[name] = getattr(self, name)
+        if self.sk is not None:
+            for name, value in self.sk.state().items():
+                state["sk_" + name] = value
+        return state
+
+    def sk_state(self, state):
+        return dict((key[3:], value) for key, value in state.items() if key.startswith("sk_"))
+
+    def restore(self, state):
+        for name in self.accumulators():
+            target = getattr(self, name)
+            if state[name].shape != target.shape:
+                raise ValueError("State of " + name + " has shape " + str(state[name].shape) + ", expected " + str(target.shape))
+            target[...] = state[name]
+        if self.sk is not None:
+            self.sk.restore(self.sk_state(state))
+        self.frame_cnt = int(state["frame_cnt"])
+
+    def merge(self, state):
+        for name in self.accumulators():
+            target = getattr(self, name)
+            target += state[name]
+        if self.sk is not None:
+            self.sk.merge(self.sk_state(state))
+        self.frame_cnt += int(state["frame_cnt"])
+
+
+class IntegerCorrelator(Correlator):
+    """
+    Description:
+    ------------
+        Accumulates exact ACMs of blocks of frames.
+        With x = a + ib the ACM is sum(x x^H) = (a a^T + b b^T) + i(b a^T - a b^T). All four
+        products are computed by one GEMM of the stacked rows [a; b]. Products of int16
+        samples are below 2^31, thus a block of up to 2^21 samples is summed exactly
+        in float64 and accumulated in int64 without any rounding error.
+
+    Attributes
+    ----------
+        real : numpy array
+            int64 array of shape (channels, elements*pol, elements*pol), real part of the ACM
+        imag : numpy array
+            int64 array of the same shape, imaginary part of the ACM
+    Methods
+    -------
+        integrate(frames)
+            Adds the ACM of a block of frames
+        result(dtype)
+            Returns the accumulated ACM converted to dtype (default complex64)
+    """
+    def __init__(self, nelements, nchannel=CODIF_CHANNELS_IN_BLOCK, pol=CODIF_POLARIZATION, block=64, sk=None):
+        Correlator.__init__(self, nelements, nchannel, pol, block, sk)
+        shape = self.acm.shape
+        self.acm = None
+        self.real = np.zeros(shape, dtype=np.int64)
+        self.imag = np.zeros(shape, dtype=np.int64)
+
+    def integrate(self, frames):
+        """
+        Description:
+        ------------
+            Adds the ACM of a block of frames
+        Parameters
+        ----------
+            frames : numpy array
+                int16 array of shape (frames, elements, blocks, channels, pol, 2)
+        """
+        n = self.nelements * self.pol
+        for start in range(0, len(frames), self.block):
+            data = to_real_rows(frames[start:start+self.block])
+            if self.sk is not None:
+                keep = self.sk.test(data[:, :n]**2 + data[:, n:]**2)
+                if keep is not None:
+                    data *= keep[:, None, :]
+            prod = np.matmul(data, data.transpose(0, 2, 1))
+            self.real += (prod[:, :n, :n] + prod[:, n:, n:]).astype(np.int64)
+            self.imag += (prod[:, n:, :n] - prod[:, :n, n:]).astype(np.int64)
+        self.frame_cnt += len(frames)
+
+    def result(self, dtype=np.complex64):
+        acm = np.empty(self.real.shape, dtype=dtype)
+        acm.real = self.real
+        acm.imag = self.imag
+        return acm
+
+    def accumulators(self):
+        return ["real", "imag"]
+
+
+# Correlators selectable by name (e.g. CodifHandler.compute_acm(correlator=...))
+CORRELATORS = {"complex64" : Correlator, "integer" : IntegerCorrelator}
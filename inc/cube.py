@@ -0,0 +1,327 @@
+"""
+ Description:
+ ------------
+    Conversion of CODIF packets to a chunked voltage cube in HDF5.
+    The '.dada' files are packet-major: a packet holds CODIF_BLOCKS_IN_PACKET samples of all
+    channels of one element, thus the time series of a single element or channel is spread
+    over every byte of a snapshot. VoltageCube is a product of the single-pass pipeline (see
+    CodifHandler.process() and inc/pipeline.py) which assembles frames and writes them
+    transposed to time x element x channel x pol. The chunks contain the samples of one element
+    and one channel (both polarizations), thus per-element or per-channel analyses read only
+    their part of the cube.
+
+    The transpose is streamed: assembled frames are kept until they fill one row of chunks along
+    the time axis, which is then written at once. Every chunk is written exactly once and the
+    memory is limited to one row of chunks.
+
+    Every stream (numa node) is stored in its own group 'stream<index>' (attribute 'node' is set by save()):
+        <group>/voltage     int16 (samples, elements, channels, pol, 2), real and imaginary part
+        <group>/key         int64 (frames,), frame_key of every frame (see inc/batch.py)
+        <group>/freq        float64 (channels,), channel frequencies in MHz
+    Only complete frames are stored, gaps are given by the keys. CubeReader reads the cube as
+    blocks of frames like FrameAssembler, thus correlators (see inc/correlator.py) integrate
+    the cube directly.
+
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+"""
+
+from __future__ import division
+import numbers
+import numpy as np
+import h5py
+
+from inc.constants import *
+from inc.batch import FrameAssembler, frame_time
+from inc.correlator import CORRELATORS
+
+CUBE_SHAPE = (CODIF_CHANNELS_IN_BLOCK, CODIF_POLARIZATION, 2)
+
+
+class VoltageCube:
+    """
+    Description:
+    ------------
+        Assembles frames and appends them transposed to an HDF5 voltage cube
+
+    Attributes
+    ----------
+        fname : string
+            Name of the HDF5 file
+        nelements : int
+            Number of beams per frame
+        chunk : int
+            Number of samples per chunk, rounded to complete frames
+        compression : string
+            HDF5 compression filter, e.g. 'gzip' or 'lzf' (None: uncompressed)
+        assemblers : dict
+            FrameAssembler of every stream
+    Methods
+    -------
+        add(stream, file, packets, headers)
+            Assembles the frames of a batch of packets
+        end(stream)
+            Writes the pending frames of a stream
+        save(streams, freqs, nodes)
+            Writes the frequencies and closes the file
+    """
+    def __init__(self, fname, nelements=36, chunk=16384, compression="gzip", shuffle=True):
+        self.fname = fname
+        self.nelements = nelements
+        self.chunk_frames = max(int(chunk) // CODIF_BLOCKS_IN_PACKET, 1)
+        self.chunk = self.chunk_frames * CODIF_BLOCKS_IN_PACKET
+        self.compression = compression
+        # The shuffle filter groups the bytes of the samples, which improves the compression of int16
+        self.shuffle = shuffle and compression is not None
+        self.file = h5py.File(fname, "w")
+        self.file.attrs["nelements"] = nelements
+        self.file.attrs["samples_per_frame"] = CODIF_BLOCKS_IN_PACKET
+        self.groups = {}
+        self.assemblers = {}
+        self.pending = {}
+
+    def create(self, stream):
+        group = self.file.create_group("stream" + str(len(self.groups)))
+        group.attrs["file"] = stream.files[0].fname
+        shape = (self.nelements,) + CUBE_SHAPE
+        group.create_dataset("voltage", shape=(0,) + shape, maxshape=(None,) + shape, chunks=(self.chunk, 1, 1, CODIF_POLARIZATION, 2),
+            dtype=np.int16, compression=self.compression, shuffle=self.shuffle)
+        group.create_dataset("key", shape=(0,), maxshape=(None,), chunks=(max(self.chunk_frames, 1024),), dtype=np.int64)
+        self.groups[stream] = group
+        self.assemblers[stream] = FrameAssembler(self.nelements)
+        self.pending[stream] = []
+
+    def add(self, stream, file, packets, headers):
+        if stream not in self.groups:
+            self.create(stream)
+        frames, keys = self.assemblers[stream].add(packets)
+        file.frame_cnt += len(frames)
+        if not len(frames):
+            return
+        pending = self.pending[stream]
+        pending.append((frames, keys))
+        # Complete rows of chunks are written, the rest waits for the next batch
+        nframes = sum([len(item[1]) for item in pending])
+        if nframes >= self.chunk_frames:
+            self.write(stream, nframes // self.chunk_frames * self.chunk_frames)
+
+    def write(self, stream, nframes):
+        pending = self.pending[stream]
+        frames = np.concatenate([item[0] for item in pending])
+        keys = np.concatenate([item[1] for item in pending])
+        self.pending[stream] = [(frames[nframes:], keys[nframes:])] if nframes < len(keys) else []
+        group = self.groups[stream]
+        old = group["key"].shape[0]
+        group["key"].resize(old + nframes, axis=0)
+        group["key"][old:] = keys[:nframes]
+        group["voltage"].resize((old + nframes) * CODIF_BLOCKS_IN_PACKET, axis=0)
+        for start in range(0, nframes, self.chunk_frames):
+            block = frames[start:start+self.chunk_frames]
+            # (frames, elements, samples, channels, pol, 2) -> (frames*samples, elements, channels, pol, 2)
+            data = np.ascontiguousarray(block.transpose(0, 2, 1, 3, 4, 5), dtype=np.int16).reshape((-1, self.nelements) + CUBE_SHAPE)
+            group["voltage"][(old + start) * CODIF_BLOCKS_IN_PACKET:(old + start + len(block)) * CODIF_BLOCKS_IN_PACKET] = data
+
+    def end(self, stream):
+        if stream not in self.assemblers:
+            return
+        self.assemblers[stream].flush()
+        nframes = sum([len(item[1]) for item in self.pending[stream]])
+        if nframes:
+            self.write(stream, nframes)
+
+    def save(self, streams, freqs=None, nodes=None):
+        """
+        Description:
+        ------------
+            Writes the frequencies and the frame counters of every stream and closes the file
+        Parameters
+        ----------
+            streams : list
+                CodifStreams
+            freqs : list
+                Channel frequencies of every stream (optional, default derived from the freq_group)
+            nodes : list
+                Node (numa) ID of every stream (optional)
+        """
+        for idx, stream in enumerate(streams):
+            if stream not in self.groups:
+                continue
+            assembler = self.assemblers[stream]
+            freq = freqs[idx] if freqs is not None else None
+            if freq is None and assembler.first is not None:
+                freq = assembler.first[2] + np.arange(CODIF_CHANNELS_IN_BLOCK)
+            group = self.groups[stream]
+            if nodes is not None:
+                group.attrs["node"] = nodes[idx]
+            if freq is not None:
+                group.create_dataset("freq", data=np.asarray(freq, dtype=np.float64))
+            group.attrs["frame_cnt"] = assembler.frame_cnt
+            group.attrs["uncomplete_cnt"] = assembler.uncomplete_cnt
+        self.file.close()
+
+
+def as_selection(index):
+    # Elements and channels are selected by a slice or an increasing list (h5py)
+    if index is None:
+        return slice(None)
+    if isinstance(index, numbers.Integral):
+        return [int(index)]
+    if isinstance(index, slice):
+        return index
+    return sorted(set(int(value) for value in index))
+
+
+class CubeReader:
+    """
+    Description:
+    ------------
+        Reads voltage cubes written by VoltageCube
+
+    Attributes
+    ----------
+        file : h5py.File
+            The opened cube
+        streams : list of strings
+            Names of the groups (one per node)
+    Methods
+    -------
+        samples(stream, start, stop, elements, channels)
+            Complex voltages of a range of samples
+        frames(stream, block, elements, channels, start, stop)
+            Yields blocks of frames in the format of FrameAssembler
+        compute_acm(stream, correlator, elements, channels, block, start, stop)
+            Integrates the ACM of a stream
+        frequencies(stream, channels)
+            Channel frequencies of a stream
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.file = h5py.File(fname, "r")
+        self.streams = sorted([name for name in self.file if "voltage" in self.file[name]], key=lambda name: int(name[len("stream"):]))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def group(self, stream):
+        # Group of a stream passed by name, node (attribute) or position
+        if isinstance(stream, numbers.Integral):
+            return self.file[self.streams[stream]]
+        for name in self.streams:
+            if name == stream or self.file[name].attrs.get("node") == stream:
+                return self.file[name]
+        raise KeyError("Unknown stream " + str(stream) + " in " + self.fname)
+
+    def nframes(self, stream):
+        return self.group(stream)["key"].shape[0]
+
+    def keys(self, stream):
+        return self.group(stream)["key"][:]
+
+    def times(self, stream):
+        keys = self.keys(stream)
+        return frame_time(keys // PAF_EPOCH_PERIOD, keys % PAF_EPOCH_PERIOD)
+
+    def frequencies(self, stream, channels=None):
+        group = self.group(stream)
+        if "freq" not in group:
+            return None
+        return group["freq"][:][as_selection(channels)]
+
+    def read(self, stream, start, stop, elements=None, channels=None):
+        # int16 samples (samples, elements, channels, pol, 2), h5py accepts only one list per selection
+        dataset = self.group(stream)["voltage"]
+        elements, channels = as_selection(elements), as_selection(channels)
+        if isinstance(elements, list) and isinstance(channels, list):
+            return np.concatenate([dataset[start:stop, elements, channel:channel+1] for channel in channels], axis=2)
+        return dataset[start:stop, elements, channels]
+
+    def samples(self, stream, start=0, stop=None, elements=None, channels=None):
+        """
+        Description:
+        ------------
+            Reads a range of samples of selected elements and channels, only their chunks are read
+        Parameters
+        ----------
+            stream : int or string
+                Position, group name or node of the stream
+            start : int
+                First sample
+            stop : int
+                Sample after the last one (optional, default end of the stream)
+            elements : slice or list
+                Elements (beam_ids) to read (optional, default all)
+            channels : slice or list
+                Channels to read (optional, default all)
+        Returns:
+        --------
+            complex64 array of shape (samples, elements, channels, pol)
+        """
+        data = self.read(stream, start, stop, elements, channels)
+        return data.astype(np.float32).view(np.complex64)[..., 0]
+
+    def frames(self, stream, block=None, elements=None, channels=None, start=0, stop=None):
+        """
+        Description:
+        ------------
+            Yields blocks of frames of selected elements and channels in the format of
+            FrameAssembler.add(), e.g. to be passed to Correlator.integrate()
+        Parameters
+        ----------
+            stream : int or string
+                Position, group name or node of the stream
+            block : int
+                Number of frames per block (optional, default the frames of 4 rows of chunks)
+            elements : slice or list
+                Elements (beam_ids) to read (optional, default all)
+            channels : slice or list
+                Channels to read (optional, default all)
+            start : int
+                First frame
+            stop : int
+                Frame after the last one (optional, default end of the stream)
+        Returns:
+        --------
+            Generator of (frames, keys), frames is an int16 array of shape (frames, elements, blocks, channels, pol, 2)
+        """
+        group = self.group(stream)
+        if block is None:
+            block = max(group["voltage"].chunks[0] // CODIF_BLOCKS_IN_PACKET, 1) * 4
+        keys = group["key"]
+        stop = keys.shape[0] if stop is None else min(stop, keys.shape[0])
+        for first in range(start, stop, block):
+            last = min(first + block, stop)
+            data = self.read(stream, first * CODIF_BLOCKS_IN_PACKET, last * CODIF_BLOCKS_IN_PACKET, elements, channels)
+            data = data.reshape((last - first, CODIF_BLOCKS_IN_PACKET) + data.shape[1:]).transpose(0, 2, 1, 3, 4, 5)
+            yield data, keys[first:last]
+
+    def compute_acm(self, stream, correlator="integer", elements=None, channels=None, block=None, start=0, stop=None):
+        """
+        Description:
+        ------------
+            Integrates the ACM of selected elements and channels of a stream
+        Parameters
+        ----------
+            correlator : string
+                Name of the correlator (see inc/correlator.py)
+            (see frames())
+        Returns:
+        --------
+            Tuple of (acm, freq, frame_cnt) like CodifHandler.compute_acm()
+        """
+        if correlator not in CORRELATORS:
+            raise ValueError("Unknown correlator '" + str(correlator) + "', use one of " + ", ".join(sorted(CORRELATORS)))
+        instance = None
+        for frames, keys in self.frames(stream, block, elements, channels, start, stop):
+            if instance is None:
+                instance = CORRELATORS[correlator](frames.shape[1], frames.shape[3], frames.shape[4])
+            instance.integrate(frames)
+        freq = self.frequencies(stream, channels)
+        if instance is None:
+            return None, freq if freq is not None else [], 0
+        return instance.result(), freq if freq is not None else [], instance.frame_cnt
@@ -0,0 +1,226 @@
+"""
+ Description:
+ ------------
+    Parser for the ASCII header of '.dada' files.
+    Every '.dada' file starts with a header of DADA_HEADER_SIZE bytes containing one
+    'KEY value' pair per line (padded with zeros). The header describes the recorded
+    stream (UTC_START, BYTES_PER_SECOND, FREQ, NCHAN, ...) and the position of the file
+    within the observation (OBS_OFFSET), thus pipelines can be configured and time ranges
+    can be located without reading any packet.
+    Parsed headers are cached per file, repeated requests do not touch the disk.
+
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+"""
+
+from __future__ import division
+import os
+import calendar
+import time
+import threading
+import numpy as np
+from collections import OrderedDict
+
+from inc.constants import *
+
+UTC_FORMAT = "%Y-%m-%d-%H:%M:%S"
+
+
+def parse_dada_header(raw):
+    """
+    Description:
+    ------------
+        Splits a raw DADA header into keys and values
+    Parameters
+    ----------
+        raw : bytes or string
+            Header as read from the file
+    Returns:
+    --------
+        OrderedDict of key (string) -> value (string)
+    """
+    if not isinstance(raw, str):
+        raw = raw.decode("ascii", "replace")
+    keys = OrderedDict()
+    for line in raw.split("\0", 1)[0].splitlines():
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        item = line.split(None, 1)
+        keys[item[0]] = item[1].strip() if len(item) > 1 else ""
+    return keys
+
+def format_dada_header(keys, size=DADA_HEADER_SIZE):
+    """
+    Description:
+    ------------
+        Counterpart of parse_dada_header(), creates an ASCII header padded with zeros to size bytes
+    Parameters
+    ----------
+        keys : OrderedDict
+            Keys and values
+        size : int
+            Size of the header in bytes (HDR_SIZE)
+    Returns:
+    --------
+        Header as bytes
+    """
+    text = "".join("{:<20}{}\n".format(key, value) for key, value in keys.items()).encode("ascii")
+    if len(text) > size:
+        raise ValueError("DADA header of " + str(len(text)) + " bytes exceeds HDR_SIZE " + str(size))
+    return text.ljust(size, b"\0")
+
+
+class DadaHeader:
+    """
+    Description:
+    ------------
+        Typed access to the keys of a DADA header. Keys which are not contained in
+        the header are None or fall back to the CODIF constants.
+
+    Attributes
+    ----------
+        keys : OrderedDict
+            All keys and values as strings
+        hdr_size : int
+            Size of the header in bytes
+        utc_start : string
+            Start time of the observation (YYYY-MM-DD-hh:mm:ss)
+        obs_offset : int
+            Byte offset of the first packet of the file within the observation
+        file_size : int
+            Number of data bytes of the file
+        bytes_per_second : float
+            Data rate of the recorded stream
+        freq : float
+            Center frequency in MHz
+        bw : float
+            Bandwidth in MHz
+        nchan : int
+            Number of channels
+        npol : int
+            Number of polarizations
+        nbeam : int
+            Number of beams / elements (None if not recorded)
+        freq_group : int
+            Frequency group (None if not recorded)
+        tsamp : float
+            Sampling time in us
+        pkt_size : int
+            Size of one packet in bytes
+    Methods
+    -------
+        get(key, default, type)
+            Returns the value of a key converted to type
+        start_time()
+            UTC_START as unix time
+        channel_frequencies()
+            Frequency of every channel
+        time_of(packet)
+            Time of a packet relative to UTC_START
+        packet_at(seconds)
+            Index of the packet recorded at a time relative to UTC_START
+    """
+    def __init__(self, raw):
+        self.keys = parse_dada_header(raw)
+        self.hdr_size = self.get("HDR_SIZE", DADA_HEADER_SIZE, int)
+        self.utc_start = self.get("UTC_START")
+        self.obs_offset = self.get("OBS_OFFSET", 0, int)
+        self.file_size = self.get("FILE_SIZE", None, int)
+        self.bytes_per_second = self.get("BYTES_PER_SECOND", None, float)
+        self.freq = self.get("FREQ", None, float)
+        self.nchan = self.get("NCHAN", CODIF_CHANNELS_IN_BLOCK, int)
+        self.bw = self.get("BW", float(self.nchan), float)
+        self.npol = self.get("NPOL", CODIF_POLARIZATION, int)
+        self.nbeam = self.get("NBEAM", None, int)
+        self.freq_group = self.get("FREQ_GROUP", None, int)
+        self.tsamp = self.get("TSAMP", 1e6 / PAF_SAMPLE_PERIOD, float)
+        self.pkt_size = self.get("PKT_SIZE", CODIF_PACKET_SIZE, int)
+
+    def __str__(self):
+        return "".join("{:<20}{}\n".format(key, value) for key, value in self.keys.items())
+
+    def get(self, key, default=None, type=str):
+        """
+        Description:
+        ------------
+            Returns the value of key converted by type, or default if the key is missing or invalid
+        """
+        try:
+            return type(self.keys[key])
+        except (KeyError, ValueError):
+            return default
+
+    def start_time(self):
+        """
+        Description:
+        ------------
+            Converts UTC_START to seconds since 1970 (None if not set)
+        """
+        if self.utc_start is None:
+            return None
+        return calendar.timegm(time.strptime(self.utc_start, UTC_FORMAT))
+
+    def channel_frequencies(self):
+        """
+        Description:
+        ------------
+            Frequencies of all channels in MHz like the freq_group of the CODIF header (frequency
+            of the first channel). Computed from FREQ_GROUP if recorded, otherwise from FREQ, BW and NCHAN
+        Returns:
+        --------
+            numpy array of length nchan or None if neither FREQ_GROUP nor FREQ is set
+        """
+        width = self.bw / self.nchan
+        if self.freq_group is not None:
+            return self.freq_group + np.arange(self.nchan) * width
+        if self.freq is None:
+            return None
+        return self.freq + (np.arange(self.nchan) - (self.nchan - 1) / 2) * width
+
+    def time_of(self, packet):
+        """
+        Description:
+        ------------
+            Time of the n-th packet of the file in seconds since UTC_START
+        """
+        return (self.obs_offset + packet * self.pkt_size) / self.bytes_per_second
+
+    def packet_at(self, seconds):
+        """
+        Description:
+        ------------
+            Index of the packet of this file which was recorded at seconds after UTC_START.
+            The result may be negative or exceed the file if the time is not covered by the file.
+        """
+        return int(np.floor((seconds * self.bytes_per_second - self.obs_offset) / self.pkt_size))
+
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+def read_dada_header(fname):
+    """
+    Description:
+    ------------
+        Reads and parses the DADA header of a file. Results are cached, a file is only read
+        again if its size or modification time changed.
+    Parameters
+    ----------
+        fname : string
+            '.dada' file
+    Returns:
+    --------
+        DadaHeader
+    """
+    stat = os.stat(fname)
+    key = (fname, stat.st_size, stat.st_mtime)
+    with _cache_lock:
+        header = _cache.get(fname)
+        if header is not None and header[0] == key:
+            return header[1]
+    with open(fname, "rb") as f:
+        header = DadaHeader(f.read(DADA_HEADER_SIZE))
+    with _cache_lock:
+        _cache[fname] = (key, header)
+    return header
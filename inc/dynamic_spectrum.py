@@ -0,0 +1,225 @@
+"""
+ Description:
+ ------------
+    Autocorrelation-only processing for health checks. DynamicSpectrum is a product of the
+    single-pass pipeline (see CodifHandler.process() and inc/pipeline.py) which computes only the
+    power |x|^2 of every packet, i.e. per element, channel and polarization summed over the
+    CODIF_BLOCKS_IN_PACKET samples, without assembling frames or building ACMs.
+    The power is averaged in time bins of a configurable resolution and written bin by bin
+    into chunked HDF5 datasets (time x channel x element x pol), thus the memory does not grow
+    with the duration of the snapshot.
+
+    Every stream (numa node) is stored in its own group 'stream<index>' (attribute 'node' is set by save()):
+        <group>/power       float32 (time, channels, elements, pol), mean power per sample
+        <group>/count       uint32 (time, elements), number of packets per bin
+        <group>/time        float64 (time,), start of the bin in seconds since the reference epoch (see frame_time())
+        <group>/freq        float64 (channels,), channel frequencies in MHz
+        <group>/bandpass    float32 (channels, elements, pol), mean power of the whole snapshot (quicklook)
+    The bins are aligned to multiples of the resolution, thus the bins of all nodes coincide.
+
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+"""
+
+from __future__ import division
+import numpy as np
+import h5py
+
+from inc.constants import *
+from inc.batch import records, frame_time, isolated
+
+
+class DynamicSpectrum:
+    """
+    Description:
+    ------------
+        Accumulates the power of every packet in time bins and appends completed bins to an HDF5 file
+
+    Attributes
+    ----------
+        fname : string
+            Name of the HDF5 file
+        nelements : int
+            Number of beams per frame, packets with a larger beam_id are skipped
+        resolution : float
+            Length of a time bin in seconds
+        chunk : int
+            Number of time bins per HDF5 chunk
+        late_cnt : int
+            Number of packets of bins which were already written (skipped)
+        max_gap : float
+            Bins further apart than max_gap seconds (at least one bin) are separated by a gap. The
+            pending bins are written before the bins after a gap, the bins in between are not stored
+        min_packets : int
+            Groups of less than min_packets packets of a batch which are separated by gaps from all
+            other packets and the newest accepted bin are skipped (corrupt headers, see isolated())
+        outlier_cnt : int
+            Number of skipped packets of isolated groups
+    Methods
+    -------
+        add(stream, file, packets, headers)
+            Adds a batch of packets
+        end(stream)
+            Writes the pending bins of a stream
+        save(streams, freqs, nodes)
+            Writes the frequencies and bandpasses and closes the file
+    """
+    def __init__(self, fname, nelements=36, resolution=1.0, chunk=64, compression=None, block=1024, max_gap=60.0, min_packets=64):
+        self.fname = fname
+        self.nelements = nelements
+        self.resolution = float(resolution)
+        self.chunk = int(chunk)
+        self.compression = compression
+        self.block = block
+        self.file = h5py.File(fname, "w")
+        self.file.attrs["resolution"] = self.resolution
+        self.groups = {}
+        self.written = {}
+        self.pending = {}
+        self.freq_group = {}
+        self.late_cnt = 0
+        self.max_gap = float(max_gap)
+        self.min_packets = int(min_packets)
+        self.newest = {}
+        self.outlier_cnt = 0
+
+    def create(self, stream, bin):
+        # Resizable datasets of a new stream, the first bin is the first one of the stream
+        group = self.file.create_group("stream" + str(len(self.groups)))
+        group.attrs["file"] = stream.files[0].fname
+        shape = (CODIF_CHANNELS_IN_BLOCK, self.nelements, CODIF_POLARIZATION)
+        group.create_dataset("power", shape=(0,) + shape, maxshape=(None,) + shape, chunks=(self.chunk,) + shape, dtype=np.float32, compression=self.compression)
+        group.create_dataset("count", shape=(0, self.nelements), maxshape=(None, self.nelements), chunks=(self.chunk, self.nelements), dtype=np.uint32, compression=self.compression)
+        group.create_dataset("time", shape=(0,), maxshape=(None,), chunks=(self.chunk,), dtype=np.float64)
+        self.groups[stream] = group
+        self.written[stream] = bin
+        self.pending[stream] = (np.zeros((0, self.nelements, CODIF_CHANNELS_IN_BLOCK*CODIF_POLARIZATION)), np.zeros((0, self.nelements), dtype=np.int64))
+
+    def add(self, stream, file, packets, headers):
+        valid = np.flatnonzero(~headers.zeroed & (headers.beam_id < self.nelements))
+        if not len(valid):
+            return
+        bins = np.floor(frame_time(headers.epoch[valid], headers.frame_id[valid]) / self.resolution).astype(np.int64)
+        # Largest distance of bins without gap
+        gap = max(self.max_gap, self.resolution) / self.resolution
+        # Corrupt headers would allocate all bins up to their time
+        outlier = isolated(bins, gap, self.min_packets, self.newest.get(stream))
+        if outlier.any():
+            self.outlier_cnt += int(np.count_nonzero(outlier))
+            valid, bins = valid[~outlier], bins[~outlier]
+            if not len(valid):
+                return
+        if stream not in self.groups:
+            self.create(stream, int(bins.min()))
+            self.freq_group[stream] = int(headers.freq_group[valid[0]])
+        late = bins < self.written[stream]
+        if late.any():
+            self.late_cnt += int(np.count_nonzero(late))
+            valid, bins = valid[~late], bins[~late]
+            if not len(valid):
+                return
+        self.newest[stream] = max(self.newest.get(stream, int(bins.max())), int(bins.max()))
+        # Segments between gaps are accumulated one after another
+        used = np.unique(bins)
+        bounds = list(used[1:][np.diff(used) > gap]) + [used[-1] + 1]
+        first = used[0]
+        for last in bounds:
+            segment = (bins >= first) & (bins < last)
+            self.accumulate(stream, packets, valid[segment], bins[segment], headers.beam_id[valid[segment]], gap)
+            first = last
+
+    def accumulate(self, stream, packets, valid, bins, beam, gap):
+        power, count = self.pending[stream]
+        if bins.min() - (self.written[stream] + len(power) - 1) > gap:
+            # Real gap, the pending bins are written and the stream continues at the first bin after the gap
+            self.flush(stream, len(power))
+            self.written[stream] = int(bins.min())
+            power, count = self.pending[stream]
+        rel = bins - self.written[stream]
+        nbins = int(rel.max()) + 1
+        if nbins > len(power):
+            power = np.concatenate((power, np.zeros((nbins - len(power),) + power.shape[1:])))
+            count = np.concatenate((count, np.zeros((nbins - len(count), self.nelements), dtype=np.int64)))
+        payload = records(packets)["payload"]
+        index = rel * self.nelements + beam.astype(np.int64)
+        size = len(power) * self.nelements
+        flat = power.reshape(size, -1)
+        # Converted in blocks, limits the size of the float arrays
+        for start in range(0, len(valid), self.block):
+            data = payload[valid[start:start+self.block]].astype(np.float32)
+            sums = (data * data).sum(axis=(1, 4)).reshape(len(data), -1)
+            for col in range(sums.shape[1]):
+                flat[:, col] += np.bincount(index[start:start+self.block], weights=sums[:, col], minlength=size)
+        count += np.bincount(index, minlength=size).reshape(count.shape)
+        self.pending[stream] = (power, count)
+        # All bins but the last one are complete, packets of a stream are in time order
+        self.flush(stream, len(power) - 1)
+
+    def flush(self, stream, nbins):
+        if nbins <= 0:
+            return
+        power, count = self.pending[stream]
+        group = self.groups[stream]
+        samples = np.maximum(count[:nbins], 1) * CODIF_BLOCKS_IN_PACKET
+        mean = power[:nbins] / samples[:, :, None]
+        # (bins, elements, channels*pol) -> (bins, channels, elements, pol)
+        mean = mean.reshape(nbins, self.nelements, CODIF_CHANNELS_IN_BLOCK, CODIF_POLARIZATION).transpose(0, 2, 1, 3)
+        old = group["power"].shape[0]
+        for name in ("power", "count", "time"):
+            group[name].resize(old + nbins, axis=0)
+        group["power"][old:] = mean
+        group["count"][old:] = count[:nbins]
+        group["time"][old:] = (self.written[stream] + np.arange(nbins)) * self.resolution
+        self.written[stream] += nbins
+        self.pending[stream] = (power[nbins:], count[nbins:])
+
+    def end(self, stream):
+        if stream in self.pending:
+            self.flush(stream, len(self.pending[stream][0]))
+
+    def bandpass(self, stream):
+        """
+        Description:
+        ------------
+            Mean power of a stream over the whole snapshot, read chunk by chunk from the file
+        Returns:
+        --------
+            float array of shape (channels, elements, pol)
+        """
+        group = self.groups[stream]
+        power = np.zeros(group["power"].shape[1:])
+        count = np.zeros(self.nelements)
+        for start in range(0, group["power"].shape[0], self.chunk):
+            weights = group["count"][start:start+self.chunk].astype(np.float64)
+            power += np.einsum("tcep,te->cep", group["power"][start:start+self.chunk], weights)
+            count += weights.sum(axis=0)
+        return power / np.maximum(count, 1)[None, :, None]
+
+    def save(self, streams, freqs=None, nodes=None):
+        """
+        Description:
+        ------------
+            Writes the frequencies and the bandpass of every stream and closes the file
+        Parameters
+        ----------
+            streams : list
+                CodifStreams
+            freqs : list
+                Channel frequencies of every stream (optional, default derived from the freq_group)
+            nodes : list
+                Node (numa) ID of every stream (optional)
+        """
+        for idx, stream in enumerate(streams):
+            if stream not in self.groups:
+                continue
+            freq = freqs[idx] if freqs is not None else None
+            if freq is None:
+                freq = self.freq_group[stream] + np.arange(CODIF_CHANNELS_IN_BLOCK)
+            group = self.groups[stream]
+            if nodes is not None:
+                group.attrs["node"] = nodes[idx]
+            group.create_dataset("freq", data=np.asarray(freq, dtype=np.float64))
+            group.create_dataset("bandpass", data=self.bandpass(stream).astype(np.float32))
+        self.file.attrs["late_packets"] = self.late_cnt
+        self.file.attrs["outlier_packets"] = self.outlier_cnt
+        self.file.close()
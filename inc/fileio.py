@@ -0,0 +1,381 @@
+"""
+ Description:
+ ------------
+    File readers for large sequential scans of '.dada' files.
+    PrefetchReader reads large buffers on a background thread while the caller processes the
+    previous buffer. File reads and most numpy operations release the GIL, thus disk and CPU
+    work in parallel (double buffering).
+    DirectFile reads with O_DIRECT, bypassing the page cache. Scanning a snapshot of several
+    terabytes therefore neither evicts the cache of other jobs nor pays for the copy through
+    the kernel. Filesystems without O_DIRECT support are read buffered.
+
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+"""
+
+from __future__ import division
+import io
+import os
+import errno
+import mmap
+import threading
+import numpy as np
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from inc.constants import *
+
+PAGE_SIZE = mmap.PAGESIZE
+DIRECT_ALIGNMENT = 4096
+# Least common multiple of alignment and packet size (64 packets). Buffers of a multiple of this
+# size read at DADA_HEADER_SIZE + n*DIRECT_BLOCK are aligned and contain only complete packets
+DIRECT_BLOCK = DIRECT_ALIGNMENT * CODIF_PACKET_SIZE // 64
+
+
+def aligned_empty(nbytes, alignment=PAGE_SIZE):
+    """
+    Description:
+    ------------
+        Allocates an uint8 numpy array whose data start at a multiple of alignment
+    """
+    raw = np.empty(nbytes + alignment, dtype=np.uint8)
+    offset = (-raw.ctypes.data) % alignment
+    return raw[offset:offset+nbytes]
+
+def fadvise(fd, offset, length, advice):
+    # posix_fadvise is only available on python >= 3.3, it is just a hint anyway
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, offset, length, getattr(os, advice))
+        except OSError:
+            pass
+
+def read_full(file, buf):
+    """
+    Description:
+    ------------
+        Reads len(buf) bytes into buf. readinto() may return less bytes than requested (e.g.
+        signals, network filesystems), thus it is repeated until the buffer is full or the end
+        of the file is reached. Only the last buffer of a file can be shorter.
+    Returns:
+    --------
+        Number of read bytes
+    """
+    nbytes = 0
+    while nbytes < len(buf):
+        n = file.readinto(buf[nbytes:])
+        if not n:
+            break
+        nbytes += n
+    return nbytes
+
+def write_all(fd, data):
+    # os.write() may write less than passed
+    written = 0
+    while written < len(data):
+        written += os.write(fd, data[written:])
+
+def copy_range(src, dst, offset, length, buffer_size=64*1024**2):
+    """
+    Description:
+    ------------
+        Copies a byte range of a file to the current position of another file. The copy is done
+        within the kernel by copy_file_range() or sendfile() if available (python >= 3.8 / 3.3),
+        otherwise by reads and writes of buffer_size bytes.
+    Parameters
+    ----------
+        src : int
+            File descriptor of the source
+        dst : int
+            File descriptor of the destination
+        offset : int
+            Position of the range in the source
+        length : int
+            Number of bytes
+    Returns:
+    --------
+        Number of copied bytes
+    """
+    copied = 0
+    for name in ("copy_file_range", "sendfile"):
+        if not hasattr(os, name):
+            continue
+        try:
+            while copied < length:
+                if name == "copy_file_range":
+                    n = os.copy_file_range(src, dst, length - copied, offset + copied)
+                else:
+                    n = os.sendfile(dst, src, offset + copied, length - copied)
+                if n <= 0:
+                    return copied
+                copied += n
+            return copied
+        except OSError as e:
+            # Not supported by the filesystem (e.g. across devices), continue with the next method
+            if copied or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    while copied < length:
+        os.lseek(src, offset + copied, os.SEEK_SET)
+        data = os.read(src, min(buffer_size, length - copied))
+        if not data:
+            break
+        write_all(dst, data)
+        copied += len(data)
+    return copied
+
+
+class DirectFile:
+    """
+    Description:
+    ------------
+        Read-only file object using O_DIRECT. Provides read(), readinto(), seek() and tell()
+        and can therefore replace the file object of a CodifFile.
+        Reads of aligned size into aligned buffers at aligned positions (e.g. PrefetchReader)
+        are passed directly to the kernel. All other reads, like single packets of 7232 bytes,
+        are served from an aligned chunk which is refilled with direct reads.
+        If the filesystem does not support O_DIRECT the file is read buffered.
+
+    Attributes
+    ----------
+        fname : string
+            File to read
+        direct : bool
+            True if O_DIRECT is used
+        chunk_size : int
+            Size of the internal chunk in bytes
+    """
+    def __init__(self, fname, direct=True, chunk_size=16*1024**2):
+        self.fname = fname
+        self.size = os.path.getsize(fname)
+        self.position = 0
+        self.chunk_size = max(chunk_size // DIRECT_ALIGNMENT, 1) * DIRECT_ALIGNMENT
+        self.chunk = aligned_empty(self.chunk_size, DIRECT_ALIGNMENT)
+        self.chunk_start = 0
+        self.chunk_len = 0
+        self.direct = direct and hasattr(os, "O_DIRECT")
+        self.file = None
+        self.open()
+
+    def open(self):
+        flags = os.O_RDONLY
+        if self.direct:
+            try:
+                fd = os.open(self.fname, flags | os.O_DIRECT)
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+                # Filesystem does not support O_DIRECT (e.g. tmpfs)
+                self.direct = False
+        if not self.direct:
+            fd = os.open(self.fname, flags)
+        self.file = io.FileIO(fd, "rb", closefd=True)
+
+    def fallback(self):
+        # Some filesystems accept O_DIRECT on open(), but fail on read()
+        self.file.close()
+        self.direct = False
+        self.open()
+
+    def pread(self, buf, position):
+        self.file.seek(position)
+        try:
+            return self.file.readinto(buf)
+        except (IOError, OSError) as e:
+            if not self.direct or e.errno != errno.EINVAL:
+                raise
+            self.fallback()
+            self.file.seek(position)
+            return self.file.readinto(buf)
+
+    def aligned(self, buf):
+        return (self.position % DIRECT_ALIGNMENT == 0 and len(buf) % DIRECT_ALIGNMENT == 0
+            and buf.ctypes.data % DIRECT_ALIGNMENT == 0)
+
+    def readinto(self, buf):
+        """
+        Description:
+        ------------
+            Reads len(buf) bytes into the numpy uint8 array buf
+        Returns:
+        --------
+            Number of read bytes
+        """
+        if isinstance(buf, np.ndarray) and (self.aligned(buf) or not self.direct):
+            nbytes = self.pread(buf, self.position)
+            # Direct reads may return more bytes than the file contains
+            nbytes = min(nbytes, max(self.size - self.position, 0))
+            self.position += nbytes
+            return nbytes
+        data = self.read(len(buf))
+        buf[:len(data)] = np.frombuffer(data, dtype=np.uint8)
+        return len(data)
+
+    def read(self, size=-1):
+        """
+        Description:
+        ------------
+            Reads size bytes (all remaining bytes if size < 0) through the aligned chunk
+        Returns:
+        --------
+            bytes
+        """
+        if size < 0:
+            size = max(self.size - self.position, 0)
+        parts = []
+        while size > 0 and self.position < self.size:
+            offset = self.position - self.chunk_start
+            if offset < 0 or offset >= self.chunk_len:
+                self.chunk_start = self.position - self.position % DIRECT_ALIGNMENT
+                self.chunk_len = min(self.pread(self.chunk, self.chunk_start), self.size - self.chunk_start)
+                offset = self.position - self.chunk_start
+                if self.chunk_len <= offset:
+                    break
+            n = min(size, self.chunk_len - offset)
+            parts.append(self.chunk[offset:offset+n].tobytes())
+            self.position += n
+            size -= n
+        return b"".join(parts)
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self.position = offset
+        elif whence == 1:
+            self.position += offset
+        elif whence == 2:
+            self.position = self.size + offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PrefetchReader:
+    """
+    Description:
+    ------------
+        Reads a file in large buffers on a background thread.
+        Iterating over the reader yields uint8 arrays of shape (packets, stride). A yielded
+        array is only valid until the next iteration step, afterwards its buffer is reused.
+        Several files can be read as one sequence by passing segments. The background thread
+        continues with the next segment without waiting for the caller, a buffer never contains
+        data of two segments (aligned direct reads), the index of the segment of the latest
+        yielded buffer is stored in segment.
+
+    Attributes
+    ----------
+        fname : string
+            File to read
+        offset : int
+            Position of the first byte to read (e.g. DADA_HEADER_SIZE)
+        end : int
+            Position after the last byte to read (optional, default end of file)
+        buffer_size : int
+            Size of one buffer in bytes. Rounded down to a multiple of stride
+        nbuffers : int
+            Number of buffers (2 = double buffering)
+        stride : int
+            Size of one packet
+        direct : bool
+            Read with O_DIRECT (see DirectFile). The buffer size is rounded down to a multiple of DIRECT_BLOCK.
+            Reads start at the aligned position before the requested one, the leading bytes are skipped
+        segments : list of tuples
+            (fname, offset, end) of every file to read (optional). If passed, fname, offset and end are ignored
+        segment : int
+            Index of the segment the latest yielded buffer belongs to
+    Methods
+    -------
+        close()
+            Stops the background thread
+    """
+    def __init__(self, fname=None, offset=DADA_HEADER_SIZE, end=None, buffer_size=128*1024**2, nbuffers=2, stride=CODIF_PACKET_SIZE, direct=False, segments=None):
+        if segments is None:
+            segments = [(fname, offset, end if end is not None else os.path.getsize(fname))]
+        self.segments = segments
+        self.segment = 0
+        self.stride = stride
+        self.direct = direct
+        block = DIRECT_BLOCK if direct and stride == CODIF_PACKET_SIZE else stride
+        self.buffer_size = max(buffer_size // block, 1) * block
+        self.free = Queue()
+        self.full = Queue()
+        # Direct reads of unaligned positions need space for the leading bytes
+        extra = DIRECT_ALIGNMENT if direct else 0
+        for __ in range(nbuffers):
+            self.free.put(aligned_empty(self.buffer_size + extra, DIRECT_ALIGNMENT))
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            for idx, (fname, offset, end) in enumerate(self.segments):
+                if self.stopped.is_set() or not self.read_segment(idx, fname, offset, end):
+                    break
+        except Exception as e:
+            self.full.put((e, 0, 0, 0))
+        self.full.put((None, 0, 0, 0))
+
+    def read_segment(self, idx, fname, offset, end):
+        # Files are only opened while they are read, thus at most one descriptor is used
+        if self.direct:
+            file = DirectFile(fname)
+        else:
+            file = io.open(fname, "rb", buffering=0)
+        with file:
+            fd = file.fileno()
+            fadvise(fd, offset, end - offset, "POSIX_FADV_SEQUENTIAL")
+            position = offset
+            while position < end and not self.stopped.is_set():
+                buf = self.free.get()
+                if buf is None:
+                    return False
+                size = min(self.buffer_size, end - position)
+                # Unaligned direct reads would be copied through the chunk of DirectFile, thus reads
+                # start aligned and the leading bytes are skipped (e.g. segments starting at start_time)
+                lead = position % DIRECT_ALIGNMENT if self.direct else 0
+                count = lead + size
+                if self.direct:
+                    count = -(-count // DIRECT_ALIGNMENT) * DIRECT_ALIGNMENT
+                file.seek(position - lead)
+                nbytes = min(read_full(file, buf[:count]) - lead, size)
+                if nbytes <= 0:
+                    self.free.put(buf)
+                    break
+                position += nbytes
+                fadvise(fd, position, self.buffer_size, "POSIX_FADV_WILLNEED")
+                self.full.put((buf, lead, nbytes, idx))
+        return True
+
+    def __iter__(self):
+        try:
+            while True:
+                buf, lead, nbytes, segment = self.full.get()
+                if buf is None:
+                    break
+                if isinstance(buf, Exception):
+                    raise buf
+                self.segment = segment
+                npackets = nbytes // self.stride
+                yield buf[lead:lead+npackets*self.stride].reshape(npackets, self.stride)
+                self.free.put(buf)
+        finally:
+            self.close()
+
+    def close(self):
+        self.stopped.set()
+        self.free.put(None)
@@ -0,0 +1,217 @@
+"""
+ Description:
+ ------------
+    Streaming writer of SIGPROC filterbank files ('.fil') as read by pulsar and transient
+    search tools (e.g. PRESTO, heimdall, your). A filterbank file consists of a binary header of
+    keyword/value pairs between HEADER_START and HEADER_END followed by the samples in time order,
+    every sample contains nifs x nchans values of nbits bits.
+
+    FilterbankWriter writes the header once and appends blocks of detected power with buffered
+    bulk writes, thus outputs of many hours never have to be kept in memory. With nbits=8 the
+    power is scaled per channel by the mean and standard deviation of the first block, the value
+    0 is reserved for samples without power.
+
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+"""
+
+from __future__ import division
+import struct
+import numpy as np
+from collections import OrderedDict
+
+# Types of the supported header keywords
+SIGPROC_INT = ["telescope_id", "machine_id", "data_type", "nchans", "nbits", "nifs", "nbeams", "ibeam", "barycentric", "pulsarcentric"]
+SIGPROC_DOUBLE = ["fch1", "foff", "tstart", "tsamp", "src_raj", "src_dej", "az_start", "za_start", "refdm"]
+SIGPROC_STRING = ["source_name", "rawdatafile"]
+# Telescope ID of Effelsberg in SIGPROC
+EFFELSBERG_ID = 8
+MJD_UNIX_EPOCH = 40587.0
+
+
+def pack_string(value):
+    value = value.encode() if not isinstance(value, bytes) else value
+    return struct.pack("<i", len(value)) + value
+
+
+def header_bytes(header):
+    """
+    Description:
+    ------------
+        Encodes a SIGPROC header
+    Parameters
+    ----------
+        header : dict
+            Keywords and values, see SIGPROC_INT, SIGPROC_DOUBLE and SIGPROC_STRING
+    Returns:
+    --------
+        bytes of the header including HEADER_START and HEADER_END
+    """
+    raw = pack_string("HEADER_START")
+    for key, value in header.items():
+        if value is None:
+            continue
+        if key in SIGPROC_INT:
+            raw += pack_string(key) + struct.pack("<i", int(value))
+        elif key in SIGPROC_DOUBLE:
+            raw += pack_string(key) + struct.pack("<d", float(value))
+        elif key in SIGPROC_STRING:
+            raw += pack_string(key) + pack_string(value)
+        else:
+            raise ValueError("Unknown SIGPROC header keyword '" + str(key) + "'")
+    return raw + pack_string("HEADER_END")
+
+
+def read_header(fname):
+    """
+    Description:
+    ------------
+        Reads the header of a filterbank file
+    Returns:
+    --------
+        Tuple of (header, size). header is a dictionary of all keywords, size the size of the header in bytes
+    """
+    header = {}
+    with open(fname, "rb") as f:
+        def read_string():
+            length = struct.unpack("<i", f.read(4))[0]
+            if length <= 0 or length > 80:
+                raise ValueError("File " + fname + " is no SIGPROC filterbank file")
+            return f.read(length).decode()
+        if read_string() != "HEADER_START":
+            raise ValueError("File " + fname + " is no SIGPROC filterbank file")
+        while True:
+            key = read_string()
+            if key == "HEADER_END":
+                break
+            if key in SIGPROC_INT:
+                header[key] = struct.unpack("<i", f.read(4))[0]
+            elif key in SIGPROC_DOUBLE:
+                header[key] = struct.unpack("<d", f.read(8))[0]
+            elif key in SIGPROC_STRING:
+                header[key] = read_string()
+            else:
+                raise ValueError("Unknown SIGPROC header keyword '" + key + "' in " + fname)
+        return header, f.tell()
+
+
+def read_data(fname):
+    """
+    Description:
+    ------------
+        Reads all samples of a filterbank file (memory mapped)
+    Returns:
+    --------
+        Tuple of (header, data), data has the shape (samples, nifs, nchans)
+    """
+    header, size = read_header(fname)
+    dtype = {8 : np.uint8, 16 : np.uint16, 32 : np.float32}[header["nbits"]]
+    data = np.memmap(fname, dtype=dtype, mode="r", offset=size)
+    return header, data.reshape(-1, header.get("nifs", 1), header["nchans"])
+
+
+def unix_to_mjd(seconds):
+    return seconds / 86400.0 + MJD_UNIX_EPOCH
+
+
+class FilterbankWriter:
+    """
+    Description:
+    ------------
+        Appends blocks of detected power to a filterbank file
+
+    Attributes
+    ----------
+        fname : string
+            Name of the output file
+        header : dict
+            SIGPROC header, written when the file is created
+        nbits : int
+            32 writes float32, 8 writes scaled uint8
+        buffer_size : int
+            Size of the write buffer in bytes
+        nsigma : float
+            8 bit: standard deviations which are mapped to the range of 1 to 255 around the mean
+        offset : numpy array
+            8 bit: mean power of every channel of the first block
+        scale : numpy array
+            8 bit: standard deviation of every channel of the first block
+        sample_cnt : int
+            Number of written samples
+    Methods
+    -------
+        write(data)
+            Appends a block of samples
+        flush()
+            Writes the buffered samples
+        close()
+            Flushes and closes the file
+    """
+    def __init__(self, fname, fch1, foff, nchans, tsamp, tstart, nbits=32, nifs=1, source_name="unknown",
+        telescope_id=EFFELSBERG_ID, machine_id=0, buffer_size=4*1024**2, nsigma=6.0, **keys):
+        if nbits not in (8, 32):
+            raise ValueError("Unsupported number of bits " + str(nbits) + ", use 8 or 32")
+        self.fname = fname
+        self.nbits = nbits
+        self.nifs = nifs
+        self.nchans = nchans
+        self.buffer_size = buffer_size
+        self.nsigma = float(nsigma)
+        self.offset = None
+        self.scale = None
+        self.header = OrderedDict([("telescope_id", telescope_id), ("machine_id", machine_id), ("data_type", 1), ("source_name", source_name),
+            ("fch1", fch1), ("foff", foff), ("nchans", nchans), ("nbits", nbits), ("nifs", nifs), ("tstart", tstart), ("tsamp", tsamp)])
+        for key in sorted(keys):
+            self.header[key] = keys[key]
+        self.file = open(fname, "wb")
+        self.file.write(header_bytes(self.header))
+        self.buffer = []
+        self.buffered = 0
+        self.sample_cnt = 0
+
+    def quantize(self, data):
+        # Maps the power to 8 bits, the scaling is fixed by the first block. Samples without power
+        # (e.g. filled gaps) stay 0
+        filled = (data != 0).any(axis=(1, 2))
+        if self.offset is None and filled.any():
+            self.offset = data[filled].mean(axis=0)
+            self.scale = data[filled].std(axis=0)
+            self.scale[self.scale == 0] = 1
+        if self.offset is None:
+            return np.zeros(data.shape, dtype=np.uint8)
+        levels = 128 + (data - self.offset) / self.scale * (128 / self.nsigma)
+        levels = np.clip(np.round(levels), 1, 255).astype(np.uint8)
+        levels[~filled] = 0
+        return levels
+
+    def write(self, data):
+        """
+        Description:
+        ------------
+            Appends a block of samples
+        Parameters
+        ----------
+            data : numpy array
+                Power of shape (samples, nchans) or (samples, nifs, nchans)
+        """
+        data = np.asarray(data, dtype=np.float32).reshape(-1, self.nifs, self.nchans)
+        if not len(data):
+            return
+        if self.nbits == 8:
+            data = self.quantize(data)
+        raw = data.tobytes()
+        self.buffer.append(raw)
+        self.buffered += len(raw)
+        self.sample_cnt += len(data)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(b"".join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
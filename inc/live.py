@@ -0,0 +1,381 @@
+"""
+ Description:
+ ------------
+    Live ingest of CODIF packets from UDP sockets.
+    UdpReceiver receives datagrams of one or more sockets directly into the rows of a
+    preallocated buffer (recv_into, no copy per packet) and returns them in batches like
+    PrefetchReader, thus the batched decoding of inc/batch.py is used as for files.
+    LiveCorrelator assembles the received packets to frames, integrates ACMs online and emits
+    the ACM of every cycle (fixed duration of recorded time, based on the frame timestamps).
+    UdpSender replays packets (e.g. of a '.dada' file) at a given rate, thus the live mode can be
+    tested and benchmarked on one machine over loopback.
+
+    All sockets of one receiver are expected to carry the same stream (one frequency group).
+
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+"""
+
+from __future__ import division
+import errno
+import select
+import socket
+import time
+import numpy as np
+
+from inc.constants import *
+from inc.batch import FrameAssembler, frame_time
+from inc.correlator import CORRELATORS
+from inc.fileio import PrefetchReader
+
+
+def frame_cycle(keys, cycle):
+    """
+    Description:
+    ------------
+        Index of the integration cycle of every frame, computed from the frame timestamps
+    Parameters
+    ----------
+        keys : numpy array
+            frame_key of every frame (see inc/batch.py)
+        cycle : float
+            Duration of a cycle in seconds
+    """
+    epoch = keys // PAF_EPOCH_PERIOD
+    frame_id = keys % PAF_EPOCH_PERIOD
+    return np.floor(frame_time(epoch, frame_id) / cycle).astype(np.int64)
+
+
+class UdpReceiver:
+    """
+    Description:
+    ------------
+        Receives CODIF packets (UDP payload of CODIF_PACKET_SIZE bytes) of several sockets in batches
+
+    Attributes
+    ----------
+        sockets : list of socket
+            Bound non-blocking UDP sockets
+        buffer : numpy array
+            Preallocated uint8 array of shape (batch, CODIF_PACKET_SIZE)
+        timeout : float
+            Maximum time receive() waits for the first packet
+        packet_cnt : int
+            Number of received packets
+        truncated_cnt : int
+            Number of datagrams with more or less than CODIF_PACKET_SIZE bytes (dropped)
+    Methods
+    -------
+        receive()
+            Returns the packets received since the last call
+        close()
+            Closes all sockets
+    """
+    def __init__(self, ports, host="0.0.0.0", batch=1024, timeout=0.1, rcvbuf=64*1024**2):
+        self.sockets = []
+        for port in ports:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+            except socket.error:
+                pass
+            sock.bind((host, int(port)))
+            sock.setblocking(False)
+            self.sockets.append(sock)
+        self.buffer = np.empty((batch, CODIF_PACKET_SIZE), dtype=np.uint8)
+        # Views of all rows are created once, recv_into() writes into them
+        self.rows = [self.buffer[idx] for idx in range(batch)]
+        # With MSG_TRUNC recv_into() returns the size of the whole datagram, thus longer datagrams are
+        # detected without copies. Otherwise datagrams are received into a scratch buffer of the maximum size
+        self.flags = getattr(socket, "MSG_TRUNC", 0)
+        self.scratch = None if self.flags else bytearray(65536)
+        self.timeout = timeout
+        self.packet_cnt = 0
+        self.truncated_cnt = 0
+
+    def receive(self):
+        """
+        Description:
+        ------------
+            Waits up to timeout for packets and reads all available packets of all sockets until the
+            buffer is full. The returned array is only valid until the next call.
+        Returns:
+        --------
+            uint8 array of shape (packets, CODIF_PACKET_SIZE), empty if no packet arrived
+        """
+        n = 0
+        ready = select.select(self.sockets, [], [], self.timeout)[0]
+        while ready and n < len(self.rows):
+            # Round robin over the sockets keeps the packets of a frame close together
+            remaining = []
+            for sock in ready:
+                if n == len(self.rows):
+                    break
+                try:
+                    if self.scratch is None:
+                        nbytes = sock.recv_into(self.rows[n], CODIF_PACKET_SIZE, self.flags)
+                    else:
+                        nbytes = sock.recv_into(self.scratch)
+                        if nbytes == CODIF_PACKET_SIZE:
+                            self.rows[n][:] = np.frombuffer(self.scratch, dtype=np.uint8, count=nbytes)
+                except socket.error as e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        continue
+                    raise
+                if nbytes == CODIF_PACKET_SIZE:
+                    n += 1
+                else:
+                    self.truncated_cnt += 1
+                remaining.append(sock)
+            ready = remaining
+        self.packet_cnt += n
+        return self.buffer[:n]
+
+    def close(self):
+        for sock in self.sockets:
+            sock.close()
+        self.sockets = []
+
+
+class LiveCorrelator:
+    """
+    Description:
+    ------------
+        Integrates ACMs of received packets and emits one ACM per cycle
+
+    Attributes
+    ----------
+        receiver : UdpReceiver
+            Source of packets
+        nelements : int
+            Number of beams per frame
+        cycle : float
+            Integration time of one ACM in seconds of recorded time
+        correlator : string
+            Name of the correlator (see inc/correlator.py)
+        assembler : FrameAssembler
+            Assembles frames over batches, frames may arrive out of order within window frames
+        late_cnt : int
+            Number of frames which arrived after their cycle was emitted (dropped)
+        cycle_cnt : int
+            Number of emitted cycles
+    Methods
+    -------
+        run(duration, cycles, callback, idle)
+            Receives packets and calls callback with the result of every cycle
+    """
+    def __init__(self, receiver, nelements=36, cycle=1.0, correlator="integer", window=4, nchannel=CODIF_CHANNELS_IN_BLOCK, pol=CODIF_POLARIZATION):
+        if correlator not in CORRELATORS:
+            raise ValueError("Unknown correlator '" + str(correlator) + "', use one of " + ", ".join(sorted(CORRELATORS)))
+        self.receiver = receiver
+        self.nelements = nelements
+        self.cycle = cycle
+        self.correlator_type = CORRELATORS[correlator]
+        self.nchannel = nchannel
+        self.pol = pol
+        self.assembler = FrameAssembler(nelements, window)
+        self.correlator = None
+        self.current = None
+        self.freq_group = None
+        self.late_cnt = 0
+        self.cycle_cnt = 0
+        # Counters at the last emitted cycle, results contain the differences of every cycle
+        self.uncomplete = 0
+        self.packets = 0
+        self.late = 0
+        self.truncated = 0
+
+    def emit(self, callback):
+        """
+        Description:
+        ------------
+            Passes the ACM of the current cycle to callback and starts the next cycle
+        """
+        freq = np.arange(self.freq_group, self.freq_group + self.nchannel) if self.freq_group is not None else []
+        expected = int(round(self.cycle / (CODIF_BLOCKS_IN_PACKET / PAF_SAMPLE_PERIOD)))
+        result = {
+            "acm" : self.correlator.result(),
+            "freq" : freq,
+            "frame_cnt" : self.correlator.frame_cnt,
+            "expected_frames" : expected,
+            "start" : self.current * self.cycle,
+            "packets" : self.receiver.packet_cnt - self.packets,
+            "uncomplete" : self.assembler.uncomplete_cnt - self.uncomplete,
+            "late" : self.late_cnt - self.late,
+            "truncated" : self.receiver.truncated_cnt - self.truncated}
+        self.packets = self.receiver.packet_cnt
+        self.uncomplete = self.assembler.uncomplete_cnt
+        self.late = self.late_cnt
+        self.truncated = self.receiver.truncated_cnt
+        self.cycle_cnt += 1
+        self.correlator = None
+        self.current = None
+        if callback is not None:
+            callback(result)
+        return result
+
+    def integrate(self, frames, keys, callback):
+        """
+        Description:
+        ------------
+            Integrates assembled frames, emits every cycle which is completed by them
+        """
+        if not len(keys):
+            return
+        cycles = frame_cycle(keys, self.cycle)
+        if self.current is not None:
+            late = cycles < self.current
+            if late.any():
+                self.late_cnt += int(np.count_nonzero(late))
+                frames, keys, cycles = frames[~late], keys[~late], cycles[~late]
+        # Frames are ordered by key, thus every cycle is a contiguous slice
+        for value in np.unique(cycles):
+            if self.current is not None and value != self.current:
+                self.emit(callback)
+            if self.current is None:
+                self.current = value
+                self.correlator = self.correlator_type(self.nelements, self.nchannel, self.pol)
+            self.correlator.integrate(frames[cycles == value])
+
+    def run(self, duration=None, cycles=None, callback=None, idle=None):
+        """
+        Description:
+        ------------
+            Receives and integrates packets until duration seconds passed, cycles were emitted or
+            no packet arrived for idle seconds
+        Parameters
+        ----------
+            duration : float
+                Maximum run time in seconds (optional, default endless)
+            cycles : int
+                Number of cycles to emit (optional)
+            callback : function
+                Called with a dictionary per cycle: acm, freq, frame_cnt, expected_frames, start (seconds
+                of the reference epoch) and packets, uncomplete, late and truncated since the last cycle (optional)
+            idle : float
+                Stop if no packet arrived for idle seconds (optional)
+        Returns:
+        --------
+            Number of emitted cycles
+        """
+        start = time.time()
+        last_packet = start
+        while True:
+            now = time.time()
+            if duration is not None and now - start >= duration:
+                break
+            if cycles is not None and self.cycle_cnt >= cycles:
+                break
+            if idle is not None and now - last_packet >= idle:
+                break
+            packets = self.receiver.receive()
+            if not len(packets):
+                continue
+            last_packet = now
+            frames, keys = self.assembler.add(packets)
+            if self.freq_group is None and self.assembler.first is not None:
+                self.freq_group = self.assembler.first[2]
+            self.integrate(frames, keys, callback)
+        # The last cycle is emitted even if it is not complete
+        self.assembler.flush()
+        if self.correlator is not None and (cycles is None or self.cycle_cnt < cycles):
+            self.emit(callback)
+        return self.cycle_cnt
+
+
+class UdpSender:
+    """
+    Description:
+    ------------
+        Sends CODIF packets as UDP datagrams at a fixed rate
+
+    Attributes
+    ----------
+        host : string
+            Destination address
+        ports : list of int
+            Destination ports, packets are distributed round robin
+        rate : float
+            Data rate in MB/s (0 sends as fast as possible)
+        packet_cnt : int
+            Number of sent packets
+    Methods
+    -------
+        send(packets)
+            Sends a batch of packets
+        replay(files, loops)
+            Sends all packets of '.dada' files
+        close()
+            Closes the socket
+    """
+    def __init__(self, host="127.0.0.1", ports=(17100,), rate=0.0, sndbuf=16*1024**2):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+        except socket.error:
+            pass
+        self.addresses = [(host, int(port)) for port in ports]
+        self.rate = rate
+        self.packet_cnt = 0
+        self.start = None
+
+    def pace(self):
+        # Sleeps until the sent bytes match the rate
+        if self.rate <= 0:
+            return
+        ahead = self.packet_cnt * CODIF_PACKET_SIZE / (self.rate * 1e6) - (time.time() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+    def send(self, packets):
+        """
+        Description:
+        ------------
+            Sends packets, one datagram per packet
+        Parameters
+        ----------
+            packets : numpy array
+                uint8 array of shape (packets, CODIF_PACKET_SIZE)
+        """
+        if self.start is None:
+            self.start = time.time()
+        naddr = len(self.addresses)
+        for idx in range(len(packets)):
+            address = self.addresses[self.packet_cnt % naddr]
+            while True:
+                try:
+                    self.sock.sendto(packets[idx], address)
+                    break
+                except socket.error as e:
+                    # Socket buffer full
+                    if e.errno not in (errno.EAGAIN, errno.ENOBUFS):
+                        raise
+                    time.sleep(0.0001)
+            self.packet_cnt += 1
+            if self.packet_cnt % 64 == 0:
+                self.pace()
+
+    def replay(self, files, loops=1, buffer_size=16*1024**2):
+        """
+        Description:
+        ------------
+            Sends all packets of '.dada' files in the passed order
+        Parameters
+        ----------
+            files : list of strings
+                '.dada' files
+            loops : int
+                Number of repetitions
+        Returns:
+        --------
+            Number of sent packets
+        """
+        for __ in range(loops):
+            for fname in files:
+                for packets in PrefetchReader(fname, buffer_size=buffer_size):
+                    self.send(packets)
+        return self.packet_cnt
+
+    def close(self):
+        self.sock.close()
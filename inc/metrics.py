@@ -0,0 +1,385 @@
+"""
+ Description:
+ ------------
+    Metrics module for the CODIF readers.
+    Readers (CodifFile objects) count packets, bytes, faulty and zeroed packets as well as
+    assembled and integrated frames. A MetricsRegistry samples the counters of all active
+    readers and aggregates finished readers per numa node, so that the cost of one sample
+    only depends on the number of active readers and nodes, but not on the number of files.
+    Every counter has a single writer (the thread reading the file), thus the readers do not
+    need any locking and reading the counters from the reporter thread is atomic in CPython.
+    The samples are published by a MetricsReporter thread to one or more sinks:
+
+        CursesSink      - table in a curses window (needs a TTY)
+        LogSink         - plain periodic log lines (batch scheduler friendly)
+        JsonSink        - JSON status file which is atomically replaced on every update
+        PrometheusSink  - Prometheus text format served by a local HTTP endpoint
+
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+"""
+
+from __future__ import division
+import curses
+import os
+import sys
+import time
+import json
+import threading
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Names of the counters provided by every reader (see CodifFile.metrics_sample())
+FIELDS = ("packets", "bytes", "faulty", "zeroed", "frames", "acm_frames")
+# Counters for which a rate is computed
+RATES = ("packets", "bytes")
+
+
+class MetricsRegistry:
+    """
+    Description:
+    ------------
+        Collects the counters of readers and aggregates them per numa node.
+
+    Attributes
+    ----------
+        active : dict
+            Readers which are currently processed, keyed by the reader object
+        completed : dict
+            Accumulated counters of finished readers per node
+        expected : dict
+            Number of packets per node that are expected to be processed
+    Methods
+    -------
+        expect(node, packets)
+            Registers the number of packets a node is going to process
+        register(reader)
+            Starts sampling a reader
+        release(reader)
+            Stops sampling a reader and adds its final counters to its node
+        snapshot()
+            Returns the current state of all counters including rates
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = {}
+        self.completed = {}
+        self.expected = {}
+        self.start = time.time()
+        self.last_time = self.start
+        self.last_files = {}
+        self.last_nodes = {}
+        self.last_total = None
+
+    def expect(self, node, packets):
+        with self.lock:
+            self.expected[node] = self.expected.get(node, 0) + int(packets)
+            self.completed.setdefault(node, [0] * len(FIELDS))
+
+    def register(self, reader):
+        with self.lock:
+            self.active[reader] = reader.metrics_sample()
+            self.completed.setdefault(reader.node_name, [0] * len(FIELDS))
+
+    def release(self, reader):
+        with self.lock:
+            start = self.active.pop(reader, None)
+            if start is None:
+                return
+            sample = reader.metrics_sample()
+            totals = self.completed.setdefault(reader.node_name, [0] * len(FIELDS))
+            for i in range(len(FIELDS)):
+                totals[i] += sample[i] - start[i]
+
+    def snapshot(self):
+        """
+        Description:
+        ------------
+            Samples all active readers and computes rates since the previous snapshot.
+        Returns:
+        --------
+            Dictionary with the keys 'time', 'elapsed', 'files', 'nodes' and 'total'.
+            Every row is a dictionary containing the counters (FIELDS), the rates
+            ('<field>_rate') and, if known, the progress in percent.
+        """
+        with self.lock:
+            now = time.time()
+            dt = max(now - self.last_time, 1e-9)
+            nodes = dict((node, list(values)) for node, values in self.completed.items())
+            files = []
+            for reader, start in self.active.items():
+                sample = reader.metrics_sample()
+                delta = [sample[i] - start[i] for i in range(len(FIELDS))]
+                row = self._row(reader.fname, delta, self.last_files.get(reader), dt)
+                if reader.npackets:
+                    row["progress"] = 100.0 * sample[0] / reader.npackets
+                files.append(row)
+                self.last_files[reader] = delta
+                totals = nodes.setdefault(reader.node_name, [0] * len(FIELDS))
+                for i in range(len(FIELDS)):
+                    totals[i] += delta[i]
+            # Forget readers that are not active anymore
+            for reader in list(self.last_files.keys()):
+                if reader not in self.active:
+                    del self.last_files[reader]
+            node_rows = []
+            total = [0] * len(FIELDS)
+            for node in sorted(nodes, key=str):
+                row = self._row(node, nodes[node], self.last_nodes.get(node), dt)
+                if self.expected.get(node):
+                    row["progress"] = 100.0 * nodes[node][0] / self.expected[node]
+                node_rows.append(row)
+                self.last_nodes[node] = nodes[node]
+                for i in range(len(FIELDS)):
+                    total[i] += nodes[node][i]
+            total_row = self._row("total", total, self.last_total, dt)
+            if self.expected:
+                total_row["progress"] = 100.0 * total[0] / max(sum(self.expected.values()), 1)
+            self.last_total = total
+            self.last_time = now
+            return {"time": now,
+                "elapsed": now - self.start,
+                "files": files,
+                "nodes": node_rows,
+                "total": total_row}
+
+    def _row(self, name, values, previous, dt):
+        row = {"name": str(name)}
+        for i, field in enumerate(FIELDS):
+            row[field] = values[i]
+        for field in RATES:
+            i = FIELDS.index(field)
+            prev = previous[i] if previous is not None else 0
+            row[field + "_rate"] = (values[i] - prev) / dt
+        return row
+
+
+class MetricsReporter(threading.Thread):
+    """
+    Description:
+    ------------
+        Daemon thread which periodically takes a snapshot of a MetricsRegistry and
+        passes it to all sinks.
+
+    Attributes
+    ----------
+        registry : MetricsRegistry
+            Registry to sample
+        sinks : list
+            Objects providing emit(snapshot) and close()
+        interval : float
+            Time between two snapshots in seconds
+    """
+    def __init__(self, registry, sinks, interval=1.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.registry = registry
+        self.sinks = sinks
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.emit()
+
+    def emit(self):
+        snapshot = self.registry.snapshot()
+        for sink in self.sinks:
+            sink.emit(snapshot)
+        return snapshot
+
+    def stop(self):
+        """
+        Description:
+        ------------
+            Stops the thread, emits a final snapshot and closes all sinks
+        """
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+        self.emit()
+        for sink in self.sinks:
+            sink.close()
+
+
+class LogSink:
+    """
+    Description:
+    ------------
+        Writes one line per node (or file) and snapshot. Does not need a TTY.
+    """
+    def __init__(self, display="node", stream=None):
+        self.display = display
+        self.stream = stream if stream is not None else sys.stdout
+
+    def emit(self, snapshot):
+        rows = snapshot["files"] if self.display == "file" else snapshot["nodes"]
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(snapshot["time"]))
+        for row in rows + [snapshot["total"]]:
+            self.stream.write(stamp + " " + format_row(row) + "\n")
+        self.stream.flush()
+
+    def close(self):
+        pass
+
+
+class JsonSink:
+    """
+    Description:
+    ------------
+        Writes the latest snapshot to a JSON file. The file is written to a temporary
+        file first and renamed, so readers never see a partially written file.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+
+    def emit(self, snapshot):
+        tmp = self.fname + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(snapshot, f, indent=4)
+        os.rename(tmp, self.fname)
+
+    def close(self):
+        pass
+
+
+class PrometheusSink:
+    """
+    Description:
+    ------------
+        Serves the latest snapshot in the Prometheus text exposition format on
+        http://<host>:<port>/metrics. The HTTP server runs in its own daemon thread.
+    """
+    def __init__(self, port=9110, host="127.0.0.1", prefix="codif"):
+        self.prefix = prefix
+        self.text = ""
+        sink = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = sink.text.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+        self.server = HTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, snapshot):
+        lines = []
+        for field in FIELDS:
+            name = self.prefix + "_" + field + "_total"
+            lines.append("# TYPE " + name + " counter")
+            for row in snapshot["nodes"]:
+                lines.append('{}{{node="{}"}} {}'.format(name, row["name"], row[field]))
+        for field in RATES:
+            name = self.prefix + "_" + field + "_per_second"
+            lines.append("# TYPE " + name + " gauge")
+            for row in snapshot["nodes"]:
+                lines.append('{}{{node="{}"}} {:.3f}'.format(name, row["name"], row[field + "_rate"]))
+        name = self.prefix + "_progress_percent"
+        lines.append("# TYPE " + name + " gauge")
+        for row in snapshot["nodes"]:
+            lines.append('{}{{node="{}"}} {:.3f}'.format(name, row["name"], row.get("progress", 0.0)))
+        self.text = "\n".join(lines) + "\n"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class CursesSink:
+    """
+    Description:
+    ------------
+        Displays the snapshot as table in a curses window. The window is only redrawn
+        with the rows of the current snapshot, so its cost does not grow over time.
+    """
+    header_row = ["Name", "Progress", "Read pkt", "Faulty [%]", "Faulty pkt", "Zeroed [%]", "Zeroed pkt", "Rate [pkt/s]", "Rate [MB/s]", "Frames"]
+
+    def __init__(self, display="node", col_width=12, wait=True):
+        self.display = display
+        self.col_width = col_width
+        self.wait = wait
+        self.window = curses.initscr()
+        curses.noecho()
+        curses.cbreak()
+
+    def emit(self, snapshot):
+        rows = snapshot["files"] if self.display == "file" else snapshot["nodes"]
+        table = [self.header_row, ["-" * (self.col_width - 1)] * len(self.header_row)]
+        for row in rows + [snapshot["total"]]:
+            table.append(table_row(row))
+        self.window.erase()
+        height, width = self.window.getmaxyx()
+        for r, line in enumerate(table[:height]):
+            for c, cell in enumerate(line):
+                if (c + 1) * self.col_width <= width:
+                    self.window.addstr(r, c * self.col_width, cell[:self.col_width - 1])
+        self.window.refresh()
+
+    def close(self):
+        if self.wait:
+            self.window.getch()
+        curses.endwin()
+
+
+def table_row(row):
+    packets = max(row["packets"], 1)
+    return [row["name"].rsplit("/", 1)[-1],
+        '{:.2f}%'.format(row.get("progress", 0.0)),
+        '{}'.format(row["packets"]),
+        '{:.2f}%'.format(row["faulty"] / packets * 100),
+        '{}'.format(row["faulty"]),
+        '{:.2f}%'.format(row["zeroed"] / packets * 100),
+        '{}'.format(row["zeroed"]),
+        '{:.1f}'.format(row["packets_rate"]),
+        '{:.1f}'.format(row["bytes_rate"] / 1e6),
+        '{}'.format(row["frames"])]
+
+def format_row(row):
+    return ('{name}: progress {percent:.2f}%, packets {packets}, faulty {faulty}, zeroed {zeroed}, '
+        + 'frames {frames}, acm frames {acm_frames}, {packets_rate:.1f} pkt/s, {mbs:.2f} MB/s').format(
+        percent=row.get("progress", 0.0), mbs=row["bytes_rate"] / 1e6, **row)
+
+def create_sinks(names, display="node", json_file="status.json", port=9110):
+    """
+    Description:
+    ------------
+        Creates sinks from a list of names ('curses', 'log', 'json', 'prometheus').
+        If no name is passed curses is used when stdout is a TTY and log otherwise.
+    Parameters
+    ----------
+        names : list of strings
+            Names of the sinks
+        display : string
+            Show rows per 'node' or per active 'file'
+        json_file : string
+            Output file of the JSON sink
+        port : int
+            Local port of the Prometheus endpoint
+    Returns:
+    --------
+        List of sinks
+    """
+    if not names:
+        names = ["curses"] if sys.stdout.isatty() else ["log"]
+    sinks = []
+    for name in names:
+        if name == "curses":
+            sinks.append(CursesSink(display))
+        elif name == "log":
+            sinks.append(LogSink(display))
+        elif name == "json":
+            sinks.append(JsonSink(json_file))
+        elif name == "prometheus":
+            sinks.append(PrometheusSink(port))
+        else:
+            raise ValueError("Unknown metrics sink '" + name + "'")
+    return sinks
@@ -0,0 +1,327 @@
+"""
+ Description:
+ ------------
+    Hermitian-packed storage of ACMs (Array Covariance Matrices).
+    An ACM is Hermitian, thus the upper triangle (including the diagonal) contains all
+    information. PackedACM stores n*(n+1)/2 instead of n*n values per matrix, which almost
+    halves the memory of large ACM arrays like the full band (8, 48, 192, 192) of convert.py.
+    Matrices are only expanded to the full form when they are needed, e.g. slice by slice
+    while writing the HDF5 file.
+
+    The upper triangle is stored row by row: (0,0), (0,1), ..., (0,n-1), (1,1), (1,2), ...
+
+    SparseACM stores only the rows and columns of the recorded ports (e.g. the 72 ports of
+    ELEMENT_LIST out of N_ELEMENTS = 192). The full N_ELEMENTS x N_ELEMENTS form is only
+    created for the accessed matrices, ports which were not recorded are zero.
+
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+"""
+
+from __future__ import division
+import numpy as np
+
+
+def packed_size(n):
+    """
+    Description:
+    ------------
+        Number of packed values of a n x n Hermitian matrix
+    """
+    return n * (n + 1) // 2
+
+def packed_index(n, row, col):
+    """
+    Description:
+    ------------
+        Position of the element (row, col) with row <= col in the packed vector
+    Parameters
+    ----------
+        n : int
+            Size of the matrix
+        row : int or numpy array
+        col : int or numpy array
+    """
+    return row * n - row * (row - 1) // 2 + (col - row)
+
+
+class PackedACM:
+    """
+    Description:
+    ------------
+        Array of Hermitian matrices of which only the upper triangles are stored.
+
+    Attributes
+    ----------
+        n : int
+            Size of a single matrix (n x n)
+        shape : tuple
+            Leading dimensions, e.g. (channels,) or (cycles, frequencies)
+        data : numpy array
+            Packed values of shape shape + (n*(n+1)/2,)
+    Methods
+    -------
+        unpack(index, out, dtype)
+            Expands all or a selection of matrices to the full form
+        add_block(index, rows, cols, block)
+            Adds a block of a full matrix (e.g. a tile product or a sub-matrix of selected ports)
+        select(index, ports)
+            Returns the full sub-matrix of the passed ports
+        diagonal()
+            Returns the diagonals (autocorrelations) of all matrices
+    """
+    def __init__(self, n, shape=(), dtype=np.complex64, data=None):
+        self.n = n
+        self.shape = tuple(shape)
+        if data is None:
+            data = np.zeros(self.shape + (packed_size(n),), dtype=dtype)
+        self.data = data
+        self.rows, self.cols = np.triu_indices(n)
+        self.diag = packed_index(n, np.arange(n), np.arange(n))
+        self.blocks = {}
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def __iadd__(self, other):
+        if isinstance(other, PackedACM):
+            self.data += other.data
+        else:
+            self.data += pack(other).data
+        return self
+
+    def unpack(self, index=Ellipsis, out=None, dtype=None):
+        """
+        Description:
+        ------------
+            Expands matrices to the full Hermitian form
+        Parameters
+        ----------
+            index : int, tuple or slice
+                Selection of the leading dimensions (optional, default all)
+            out : numpy array
+                Output array (optional)
+            dtype : numpy dtype
+                Type of the output (optional, default type of the packed data)
+        Returns:
+        --------
+            numpy array of shape selection + (n, n)
+        """
+        packed = self.data[index]
+        if out is None:
+            out = np.empty(packed.shape[:-1] + (self.n, self.n), dtype=dtype or self.dtype)
+        out[..., self.cols, self.rows] = np.conj(packed) if np.iscomplexobj(packed) else packed
+        out[..., self.rows, self.cols] = packed
+        return out
+
+    def block_index(self, rows, cols):
+        """
+        Description:
+        ------------
+            Index arrays to add a block with the passed global rows and columns. Only elements on or above
+            the diagonal are taken, elements below are represented by their conjugated counterpart.
+        Returns:
+        --------
+            Tuple of (positions in the block (flat), packed positions)
+        """
+        key = (tuple(rows), tuple(cols))
+        if key not in self.blocks:
+            r = np.asarray(rows)[:, None]
+            c = np.asarray(cols)[None, :]
+            upper = r <= c
+            # The block may contain both (i, j) and (j, i), only the upper one is taken
+            positions = np.flatnonzero(upper)
+            packed = packed_index(self.n, np.broadcast_to(r, upper.shape)[upper], np.broadcast_to(c, upper.shape)[upper])
+            self.blocks[key] = (positions, packed)
+        return self.blocks[key]
+
+    def add_block(self, index, rows, cols, block):
+        """
+        Description:
+        ------------
+            Adds a block of full matrices at the passed rows and columns
+        Parameters
+        ----------
+            index : int, tuple or slice
+                Selection of the leading dimensions (Ellipsis for all)
+            rows : list of int
+                Matrix rows of the block rows (must not contain duplicates)
+            cols : list of int
+                Matrix columns of the block columns (must not contain duplicates)
+            block : numpy array
+                Array of shape selection + (len(rows), len(cols))
+        """
+        positions, packed = self.block_index(rows, cols)
+        values = block.reshape(block.shape[:-2] + (-1,))[..., positions]
+        target = self.data[index]
+        target[..., packed] += values
+        if not isinstance(index, type(Ellipsis)):
+            self.data[index] = target
+
+    def select(self, index, ports):
+        """
+        Description:
+        ------------
+            Returns the full sub-matrix of the selected ports without expanding the entire matrix
+        Parameters
+        ----------
+            index : int, tuple or slice
+                Selection of the leading dimensions
+            ports : list of int
+                Rows and columns to select
+        Returns:
+        --------
+            numpy array of shape selection + (len(ports), len(ports))
+        """
+        ports = np.asarray(ports)
+        r = np.minimum(ports[:, None], ports[None, :])
+        c = np.maximum(ports[:, None], ports[None, :])
+        values = self.data[index][..., packed_index(self.n, r, c)]
+        lower = ports[:, None] > ports[None, :]
+        if np.iscomplexobj(values):
+            values[..., lower] = np.conj(values[..., lower])
+        return values
+
+    def diagonal(self):
+        return self.data[..., self.diag]
+
+
+def pack(full, dtype=None):
+    """
+    Description:
+    ------------
+        Packs an array of Hermitian matrices of shape (..., n, n)
+    Returns:
+    --------
+        PackedACM
+    """
+    n = full.shape[-1]
+    rows, cols = np.triu_indices(n)
+    data = np.array(full[..., rows, cols], dtype=dtype or full.dtype)
+    return PackedACM(n, full.shape[:-2], data=data)
+
+
+class SparseACM:
+    """
+    Description:
+    ------------
+        Array of ACMs of which only the rows and columns of the active ports are stored.
+        Indexing returns the full form like a numpy array of shape shape + (n, n), only
+        the selected matrices are expanded.
+
+    Attributes
+    ----------
+        ports : numpy array
+            Port of every stored row / column
+        n : int
+            Size of the full matrix (e.g. N_ELEMENTS)
+        data : numpy array or PackedACM
+            Stored ACMs of shape shape + (len(ports), len(ports))
+        shape : tuple
+            Leading dimensions
+    Methods
+    -------
+        positions(ports)
+            Rows of the passed ports in data (-1 if a port is not stored)
+        unpack(index, dtype)
+            Expands a selection of the leading dimensions to the full form
+        add(index, ports, acm)
+            Adds ACMs of the passed ports
+        select(index, ports)
+            Returns the sub-matrix of the passed ports
+    """
+    def __init__(self, ports, n, data):
+        self.ports = np.asarray(ports)
+        self.n = n
+        self.data = data
+        self.shape = tuple(data.shape) if isinstance(data, PackedACM) else data.shape[:-2]
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def positions(self, ports):
+        lookup = np.full(max(self.n, np.max(ports) + 1), -1, dtype=np.int64)
+        lookup[self.ports] = np.arange(len(self.ports))
+        return lookup[np.asarray(ports)]
+
+    def compact(self, index=Ellipsis):
+        """
+        Description:
+        ------------
+            Stored matrices of a selection of the leading dimensions in full form of the active ports
+        """
+        if isinstance(self.data, PackedACM):
+            return self.data.unpack(index)
+        return self.data[index]
+
+    def unpack(self, index=Ellipsis, dtype=None):
+        """
+        Description:
+        ------------
+            Expands a selection of the leading dimensions to the full n x n form
+        Returns:
+        --------
+            numpy array of shape selection + (n, n)
+        """
+        compact = self.compact(index)
+        out = np.zeros(compact.shape[:-2] + (self.n, self.n), dtype=dtype or compact.dtype)
+        out[..., self.ports[:, None], self.ports[None, :]] = compact
+        return out
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        nlead = len(self.shape)
+        full = self.unpack(key[:nlead])
+        rest = key[nlead:]
+        if not rest:
+            return full
+        return full[(Ellipsis,) + rest]
+
+    def add(self, index, ports, acm):
+        """
+        Description:
+        ------------
+            Adds ACMs whose rows / columns belong to the passed ports (must be active ports)
+        Parameters
+        ----------
+            index : int, tuple or slice
+                Selection of the leading dimensions
+            ports : list of int
+                Port of every row of acm
+            acm : numpy array
+                ACMs of shape selection + (len(ports), len(ports))
+        """
+        pos = self.positions(ports)
+        if np.any(pos < 0):
+            raise ValueError("Ports {} are not active".format(np.asarray(ports)[pos < 0]))
+        if isinstance(self.data, PackedACM):
+            self.data.add_block(index, pos, pos, acm)
+        else:
+            self.data[index + np.ix_(pos, pos)] += acm
+
+    def select(self, index, ports):
+        """
+        Description:
+        ------------
+            Returns the sub-matrix of the passed ports, inactive ports are zero
+        Returns:
+        --------
+            numpy array of shape selection + (len(ports), len(ports))
+        """
+        pos = self.positions(ports)
+        if np.any(pos < 0):
+            return self.unpack(index)[..., ports, :][..., ports]
+        if isinstance(self.data, PackedACM):
+            return self.data.select(index, pos)
+        return self.data[index][..., pos, :][..., pos]
@@ -0,0 +1,354 @@
+"""
+ Description:
+ ------------
+    Products of a single-pass pipeline (see CodifHandler.process()).
+    The raw data of a snapshot are read once; every batch of packets is passed to several
+    products, each computing one result:
+        PacketValidator     counts faulty and zeroed packets like CodifHandler.validate()
+        PacketIndex         index of the frames within the files (position, frame key, packets)
+        ACMIntegrator       ACM of every stream like CodifHandler.compute_acm_prefetched()
+        Bandpass            mean power per element, channel and polarization
+        FineChannels        power or ACM of fine channels (see inc/channelizer.py)
+    Every product implements add(stream, file, packets, headers), end(stream) and stores its result
+    at the end with save() (or returns it with result()).
+
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+"""
+
+from __future__ import division
+import numpy as np
+
+from inc.constants import *
+from inc.batch import FrameAssembler, records, frame_time
+from inc.correlator import CORRELATORS
+from inc.channelizer import FineCorrelator, FineSpectrometer
+
+
+class PacketValidator:
+    """
+    Description:
+    ------------
+        Vectorized counterpart of CodifFile.proof_order(). Every packet is proofed against its
+        predecessor in the stream, the first packet of a stream is taken as reference.
+        The counters faulty_cnt and zeroed_cnt of every file are updated, thus the results are
+        exported by CodifHandler.to_csv() like the results of CodifHandler.validate().
+
+    Attributes
+    ----------
+        nelements : int
+            Number of beams per frame, a beam_id of nelements-1 is followed by beam_id 0 of the next frame
+        faulty_cnt : int
+            Number of packets which are not in order
+        zeroed_cnt : int
+            Number of packets which are not in order and contain only zeros
+    """
+    def __init__(self, nelements=36):
+        self.nelements = nelements
+        self.reference = {}
+        self.faulty_cnt = 0
+        self.zeroed_cnt = 0
+
+    def add(self, stream, file, packets, headers):
+        beam = headers.beam_id.astype(np.int64)
+        frame = headers.frame_id.astype(np.int64)
+        epoch = headers.epoch.astype(np.int64)
+        period = headers.period.astype(np.int64)
+        # Predecessor of every packet, the last packet of the previous batch precedes the first one
+        if stream in self.reference:
+            ref_beam, ref_frame, ref_epoch = [np.concatenate(([ref], value[:-1])) for ref, value in zip(self.reference[stream], (beam, frame, epoch))]
+            proofed = slice(None)
+        else:
+            ref_beam, ref_frame, ref_epoch = beam[:-1], frame[:-1], epoch[:-1]
+            beam, frame, epoch, period = beam[1:], frame[1:], epoch[1:], period[1:]
+            proofed = slice(1, None)
+        same_frame = (beam - 1 == ref_beam) & (frame == ref_frame) & (epoch == ref_epoch)
+        next_frame = (ref_beam == self.nelements - 1) & (beam == 0) & (
+            ((frame - 1 == ref_frame) & (epoch == ref_epoch)) |
+            ((frame == 0) & (ref_frame == PAF_EPOCH_PERIOD - 1) & (epoch + period == ref_epoch)))
+        faulty = ~(same_frame | next_frame)
+        zeroed = faulty & headers.zeroed[proofed]
+        nzeroed = int(np.count_nonzero(zeroed))
+        nfaulty = int(np.count_nonzero(faulty)) - nzeroed
+        file.zeroed_cnt += nzeroed
+        file.faulty_cnt += nfaulty
+        self.zeroed_cnt += nzeroed
+        self.faulty_cnt += nfaulty
+        if len(headers):
+            self.reference[stream] = (int(headers.beam_id[-1]), int(headers.frame_id[-1]), int(headers.epoch[-1]))
+
+    def end(self, stream):
+        self.reference.pop(stream, None)
+
+
+class PacketIndex:
+    """
+    Description:
+    ------------
+        Index of the frames of all files. Consecutive packets of the same frame form one entry,
+        thus a lossless snapshot has one entry per frame. save() writes a '.npz' file with the arrays
+            files       file names
+            file_index  file (position in files) of every entry
+            packet      position of the first packet of the entry within the file (packets after the DADA header)
+            key         frame_key of the entry (see inc/batch.py)
+            count       number of packets of the entry
+    """
+    def __init__(self):
+        self.files = []
+        self.ids = {}
+        self.parts = []
+        self.positions = {}
+
+    def add(self, stream, file, packets, headers):
+        if file not in self.ids:
+            self.ids[file] = len(self.files)
+            self.files.append(file.fname)
+            self.positions[file] = (stream.span(file)[0] - DADA_HEADER_SIZE) // CODIF_PACKET_SIZE
+        if not len(headers):
+            return
+        key = headers.key
+        starts = np.flatnonzero(np.concatenate(([True], key[1:] != key[:-1])))
+        counts = np.diff(np.append(starts, len(key)))
+        self.parts.append((np.full(len(starts), self.ids[file], dtype=np.int32), starts + self.positions[file], key[starts], counts.astype(np.int32)))
+        self.positions[file] += len(key)
+
+    def end(self, stream):
+        pass
+
+    def result(self):
+        """
+        Description:
+        ------------
+            Concatenates the entries of all batches, entries which are split by a batch boundary are joined
+        Returns:
+        --------
+            Dictionary of the arrays described above
+        """
+        if not self.parts:
+            file, packet, key, count = [np.empty(0, dtype=dtype) for dtype in (np.int32, np.int64, np.int64, np.int32)]
+        else:
+            file, packet, key, count = [np.concatenate(values) for values in zip(*self.parts)]
+            joined = np.concatenate(([False], (file[1:] == file[:-1]) & (key[1:] == key[:-1]) & (packet[1:] == packet[:-1] + count[:-1])))
+            group = np.cumsum(~joined) - 1
+            count = np.bincount(group, weights=count).astype(np.int32)
+            file, packet, key = file[~joined], packet[~joined], key[~joined]
+        return {"files" : np.array(self.files), "file_index" : file, "packet" : packet, "key" : key, "count" : count}
+
+    def save(self, fname):
+        np.savez(fname, **self.result())
+
+
+class ACMIntegrator:
+    """
+    Description:
+    ------------
+        Assembles frames and integrates the ACM of every stream (frequency group)
+
+    Attributes
+    ----------
+        nelements : int
+            Number of beams per frame
+        correlator : string
+            Name of the correlator (see inc/correlator.py)
+        assemblers : dict
+            FrameAssembler of every stream
+        correlators : dict
+            Correlator of every stream
+        sk : dict
+            Settings of the spectral kurtosis RFI test (optional, see inc/rfi.py)
+    Methods
+    -------
+        result(stream)
+            Returns (acm, freq, frame_cnt) of a stream like CodifHandler.compute_acm_prefetched()
+    """
+    def __init__(self, nelements=36, correlator="integer", nchannel=CODIF_CHANNELS_IN_BLOCK, pol=CODIF_POLARIZATION, sk=None):
+        if correlator not in CORRELATORS:
+            raise ValueError("Unknown correlator '" + str(correlator) + "', use one of " + ", ".join(sorted(CORRELATORS)))
+        self.nelements = nelements
+        self.correlator = correlator
+        self.nchannel = nchannel
+        self.pol = pol
+        self.sk = sk
+        self.assemblers = {}
+        self.correlators = {}
+
+    def add(self, stream, file, packets, headers):
+        if stream not in self.assemblers:
+            self.assemblers[stream] = FrameAssembler(self.nelements)
+            self.correlators[stream] = CORRELATORS[self.correlator](self.nelements, self.nchannel, self.pol, sk=self.sk)
+        frames, keys = self.assemblers[stream].add(packets)
+        self.correlators[stream].integrate(frames)
+        file.frame_cnt += len(frames)
+        file.acm_frame_cnt += len(frames)
+
+    def end(self, stream):
+        if stream in self.assemblers:
+            self.assemblers[stream].flush()
+
+    def duration(self, stream):
+        assembler = self.assemblers.get(stream)
+        if assembler is None or assembler.first is None:
+            return 0.0
+        return frame_time(*assembler.last[:2]) - frame_time(*assembler.first[:2])
+
+    def result(self, stream, freq=None):
+        """
+        Description:
+        ------------
+            Returns the ACM of a stream
+        Parameters
+        ----------
+            stream : CodifStream
+            freq : list
+                Channel frequencies, e.g. of the DADA header (optional, default derived from the freq_group)
+        Returns:
+        --------
+            Tuple of (acm, freq, frame_cnt)
+        """
+        if stream not in self.correlators:
+            return None, freq if freq is not None else [], 0
+        assembler = self.assemblers[stream]
+        if freq is None and assembler.first is not None:
+            freq = np.arange(assembler.first[2], assembler.first[2] + self.nchannel)
+        correlator = self.correlators[stream]
+        return correlator.result(), freq if freq is not None else [], correlator.frame_cnt
+
+
+class Bandpass:
+    """
+    Description:
+    ------------
+        Accumulates the power of every beam_id, channel and polarization. Zeroed packets and packets
+        with beam_id >= nelements are skipped. save() writes a '.npz' file with the arrays
+            files       first file of every stream
+            freq_group  freq_group of every stream
+            power       mean power |x|^2 per sample of shape (streams, nelements, channels, pol)
+            packets     number of accumulated packets of shape (streams, nelements)
+    """
+    def __init__(self, nelements=36, block=1024):
+        self.nelements = nelements
+        self.block = block
+        self.power = {}
+        self.packets = {}
+        self.freq_group = {}
+
+    def add(self, stream, file, packets, headers):
+        if stream not in self.power:
+            self.power[stream] = np.zeros((self.nelements, CODIF_CHANNELS_IN_BLOCK*CODIF_POLARIZATION), dtype=np.float64)
+            self.packets[stream] = np.zeros(self.nelements, dtype=np.int64)
+        valid = np.flatnonzero(~headers.zeroed & (headers.beam_id < self.nelements))
+        if not len(valid):
+            return
+        if stream not in self.freq_group:
+            self.freq_group[stream] = int(headers.freq_group[valid[0]])
+        payload = records(packets)["payload"]
+        beam = headers.beam_id[valid].astype(np.intp)
+        power = self.power[stream]
+        # Converted in blocks, limits the size of the float arrays
+        for start in range(0, len(valid), self.block):
+            idx = valid[start:start+self.block]
+            data = payload[idx].astype(np.float32)
+            sums = (data * data).sum(axis=(1, 4)).reshape(len(idx), -1)
+            for col in range(sums.shape[1]):
+                power[:, col] += np.bincount(beam[start:start+self.block], weights=sums[:, col], minlength=self.nelements)
+        self.packets[stream] += np.bincount(beam, minlength=self.nelements)
+
+    def end(self, stream):
+        pass
+
+    def result(self, streams):
+        """
+        Description:
+        ------------
+            Mean power of the passed streams
+        Returns:
+        --------
+            Dictionary of the arrays described above
+        """
+        streams = [stream for stream in streams if stream in self.power]
+        power = np.zeros((len(streams), self.nelements, CODIF_CHANNELS_IN_BLOCK, CODIF_POLARIZATION))
+        packets = np.zeros((len(streams), self.nelements), dtype=np.int64)
+        for idx, stream in enumerate(streams):
+            packets[idx] = self.packets[stream]
+            samples = np.maximum(packets[idx], 1) * CODIF_BLOCKS_IN_PACKET
+            power[idx] = (self.power[stream] / samples[:, None]).reshape(self.nelements, CODIF_CHANNELS_IN_BLOCK, CODIF_POLARIZATION)
+        return {"files" : np.array([stream.files[0].fname for stream in streams]),
+            "freq_group" : np.array([self.freq_group.get(stream, -1) for stream in streams]),
+            "power" : power, "packets" : packets}
+
+    def save(self, fname, streams):
+        np.savez(fname, **self.result(streams))
+
+
+class FineChannels:
+    """
+    Description:
+    ------------
+        Assembles frames and channelizes the coarse channels of every stream. Depending on mode
+        the power ('spectrum') or the ACM ('acm') of the fine channels is accumulated. save() writes
+        a '.npz' file with the arrays
+            files       first file of every stream
+            freq        frequencies of the fine channels in MHz of shape (streams, channels*nfine)
+            power       mean power |x|^2 per spectrum of shape (streams, channels*nfine, elements*pol)
+            frames      number of channelized frames of every stream
+            resets      number of restarts of the time series at missing frames of every stream
+            acm         ACM of the fine channels of shape (streams, channels*nfine, elements*pol, elements*pol), only mode 'acm'
+    """
+    def __init__(self, nelements=36, mode="spectrum", nfft=32, taps=1, window="hann", crop=False):
+        if mode not in ("spectrum", "acm"):
+            raise ValueError("Unknown mode '" + str(mode) + "', use 'spectrum' or 'acm'")
+        self.nelements = nelements
+        self.mode = mode
+        self.settings = {"nfft" : nfft, "taps" : taps, "window" : window, "crop" : crop}
+        self.assemblers = {}
+        self.correlators = {}
+
+    def add(self, stream, file, packets, headers):
+        if stream not in self.assemblers:
+            self.assemblers[stream] = FrameAssembler(self.nelements)
+            cls = FineCorrelator if self.mode == "acm" else FineSpectrometer
+            self.correlators[stream] = cls(self.nelements, **self.settings)
+        frames, keys = self.assemblers[stream].add(packets)
+        self.correlators[stream].integrate(frames, keys)
+
+    def end(self, stream):
+        if stream in self.assemblers:
+            self.assemblers[stream].flush()
+
+    def result(self, streams, freqs=None):
+        """
+        Description:
+        ------------
+            Fine channels of the passed streams
+        Parameters
+        ----------
+            streams : list
+                CodifStreams
+            freqs : list
+                Center frequencies of the coarse channels of every stream (optional, default derived from the freq_group)
+        Returns:
+        --------
+            Dictionary of the arrays described above
+        """
+        streams = [stream for stream in streams if stream in self.correlators]
+        result = {"files" : np.array([stream.files[0].fname for stream in streams]), "freq" : [], "power" : [], "frames" : [], "resets" : []}
+        if self.mode == "acm":
+            result["acm"] = []
+        for idx, stream in enumerate(streams):
+            correlator = self.correlators[stream]
+            freq = freqs[idx] if freqs is not None else None
+            if freq is None:
+                first = self.assemblers[stream].first
+                freq = np.arange(first[2], first[2] + correlator.ncoarse) if first is not None else np.zeros(correlator.ncoarse)
+            result["freq"].append(correlator.frequencies(freq))
+            result["power"].append(correlator.spectrum())
+            result["frames"].append(correlator.frame_cnt)
+            result["resets"].append(correlator.channelizer.reset_cnt)
+            if self.mode == "acm":
+                result["acm"].append(correlator.result())
+        for key, value in result.items():
+            result[key] = np.array(value)
+        return result
+
+    def save(self, fname, streams, freqs=None):
+        np.savez(fname, **self.result(streams, freqs))
@@ -0,0 +1,196 @@
+"""
+ Description:
+ ------------
+    Opt-in instrumentation of the processing chain.
+    A StageProfiler accumulates the time spent in the stages of the chain
+    (read, header, payload, frame, correlate, output). Timestamps are taken with
+    perf_counter_ns (nanosecond integers, no float conversion), a few events per stage
+    are kept to produce a Chrome trace (chrome://tracing, https://ui.perfetto.dev).
+    Progress prints a status line at a fixed maximum rate instead of once per frame.
+
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+"""
+
+from __future__ import division
+import os
+import sys
+import time
+import json
+import threading
+
+try:
+    clock = time.perf_counter_ns
+except AttributeError:
+    # Python < 3.7
+    def clock():
+        return int(time.time() * 1e9)
+
+STAGES = ("read", "header", "payload", "frame", "correlate", "output")
+
+
+class StageProfiler:
+    """
+    Description:
+    ------------
+        Accumulates time spent per stage.
+        A StageProfiler must only be used by one thread, use child() to create a profiler
+        for another thread and merge() to collect its results.
+
+    Attributes
+    ----------
+        total : dict
+            Accumulated time in ns per stage
+        calls : dict
+            Number of calls per stage
+        events : list
+            Sampled events (stage, start, duration, thread id) for the Chrome trace
+        sample : int
+            Every sample-th call of a stage is stored as event
+        max_events : int
+            Maximum number of stored events
+    Methods
+    -------
+        add(stage, start, nested)
+            Adds the time since start to the stage and returns the current timestamp
+        elapsed()
+            Sum of all stage times
+        summary()
+            Summary table as string
+        to_chrome_trace(fname)
+            Writes the sampled events as Chrome trace JSON
+    """
+    def __init__(self, sample=1000, max_events=100000):
+        self.total = dict((stage, 0) for stage in STAGES)
+        self.calls = dict((stage, 0) for stage in STAGES)
+        self.events = []
+        self.sample = sample
+        self.max_events = max_events
+        self.origin = clock()
+        self.tid = threading.current_thread().ident
+
+    def add(self, stage, start, nested=None):
+        """
+        Description:
+        ------------
+            Adds the time since start to a stage.
+        Parameters
+        ----------
+            stage : string
+                Name of the stage
+            start : int
+                Timestamp returned by clock() or a previous add()
+            nested : int
+                Value of elapsed() at start (optional). If passed, the time spent in other
+                stages since then is subtracted (e.g. read and decode within frame assembly)
+        Returns:
+        --------
+            Current timestamp, which can be passed as start of the next stage
+        """
+        now = clock()
+        duration = now - start
+        if nested is not None:
+            duration -= self.elapsed() - nested
+        self.total[stage] = self.total.get(stage, 0) + duration
+        calls = self.calls.get(stage, 0)
+        self.calls[stage] = calls + 1
+        if calls % self.sample == 0 and len(self.events) < self.max_events:
+            self.events.append((stage, start, duration, self.tid))
+        return now
+
+    def elapsed(self):
+        return sum(self.total.values())
+
+    def child(self):
+        return StageProfiler(self.sample, self.max_events)
+
+    def merge(self, other):
+        for stage in other.total:
+            self.total[stage] = self.total.get(stage, 0) + other.total[stage]
+            self.calls[stage] = self.calls.get(stage, 0) + other.calls[stage]
+        self.events += other.events[:max(self.max_events - len(self.events), 0)]
+
+    def summary(self):
+        """
+        Description:
+        ------------
+            Creates a table containing time, calls and share of each stage
+        """
+        total = max(self.elapsed(), 1)
+        s = "{:<12}{:>12}{:>14}{:>14}{:>10}\n".format("Stage", "Calls", "Total [s]", "Mean [us]", "Share")
+        for stage in sorted(self.total, key=lambda k: -self.total[k]):
+            if not self.calls[stage]:
+                continue
+            s += "{:<12}{:>12}{:>14.3f}{:>14.2f}{:>9.1f}%\n".format(stage, self.calls[stage],
+                self.total[stage] / 1e9, self.total[stage] / self.calls[stage] / 1e3, 100.0 * self.total[stage] / total)
+        return s
+
+    def to_chrome_trace(self, fname):
+        """
+        Description:
+        ------------
+            Writes the sampled events in the Chrome trace event format
+        Parameters
+        ----------
+            fname : string
+                Output file (.json)
+        """
+        pid = os.getpid()
+        events = [{"name" : stage, "cat" : "codif", "ph" : "X", "pid" : pid, "tid" : tid,
+            "ts" : (start - self.origin) / 1e3, "dur" : duration / 1e3}
+            for stage, start, duration, tid in self.events]
+        # Accumulated times are added as metadata, since events are only sampled
+        events.append({"name" : "totals", "ph" : "M", "pid" : pid,
+            "args" : dict((stage, self.total[stage] / 1e9) for stage in self.total)})
+        with open(fname, "w") as f:
+            json.dump({"traceEvents" : events, "displayTimeUnit" : "ms"}, f)
+
+
+class Progress:
+    """
+    Description:
+    ------------
+        Writes a status line (carriage return) at most rate times per second
+    Attributes
+    ----------
+        rate : float
+            Maximum number of updates per second. If 0 nothing is written
+        stream : file
+            Output stream (default sys.stdout)
+    """
+    def __init__(self, rate=2.0, stream=None):
+        self.period = 1.0 / rate if rate > 0 else None
+        self.stream = stream if stream is not None else sys.stdout
+        self.next = 0
+
+    def update(self, message, *args, **kwargs):
+        """
+        Description:
+        ------------
+            Formats message with args and writes it if the last update is long enough ago.
+            The message is only formatted if it is written.
+        Parameters
+        ----------
+            force : bool
+                Write the message in any case (e.g. final state)
+        """
+        if self.period is None:
+            return
+        now = time.time()
+        if now < self.next and not kwargs.get("force", False):
+            return
+        self.next = now + self.period
+        self.stream.write("\r" + message.format(*args))
+        self.stream.flush()
+
+
+def report(profiler, output):
+    """
+    Description:
+    ------------
+        Prints the summary of a profiler and writes a Chrome trace if output ends with '.json'
+    """
+    print("\n" + profiler.summary())
+    if output.endswith(".json"):
+        profiler.to_chrome_trace(output)
+        print("Saved trace to " + output)
@@ -0,0 +1,279 @@
+"""
+ Description:
+ ------------
+    Defragmentation of recorded streams (see CodifHandler.merge() and CodifHandler.clean()).
+    Recordings contain zeroed packets and occasional late or duplicated packets, which every
+    reader has to detect and skip again. Repacker is a product of the single-pass pipeline (see
+    CodifHandler.process() and inc/pipeline.py) which rewrites every stream (numa node)
+    without them:
+
+        - zeroed packets are dropped
+        - packets are sorted by (epoch, frame_id, beam_id) within a reorder window of frames
+        - duplicates of a packet are dropped (the first one is kept), as well as packets
+          arriving after their frame was written (later than the window)
+
+    The packets are written into '.dada' files of a fixed number of packets (the last file of a
+    stream may be shorter). The DADA header of the first input file is kept with updated
+    FILE_SIZE and OBS_OFFSET, thus the first packet of every file keeps its time relative to
+    UTC_START and the files are named and ordered like the recorded ones.
+
+    Every node directory gets an 'index.npz' in the format of PacketIndex (see inc/pipeline.py).
+    Since the packets are ordered, every frame is one entry (split only by file boundaries),
+    readers can seek to frames without decoding headers.
+
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+"""
+
+from __future__ import division
+import os
+import numpy as np
+from collections import OrderedDict
+
+from inc.constants import *
+from inc.batch import Headers, frame_time, key_index
+from inc.dada import format_dada_header
+from inc.fileio import write_all
+
+
+class StreamRepacker:
+    """
+    Description:
+    ------------
+        Orders the packets of one stream and writes them into files of a fixed size
+
+    Attributes
+    ----------
+        odir : string
+            Output directory of the stream
+        header : DadaHeader
+            Header of the first input file, the template of all output headers
+        reference : tuple
+            (seconds since UTC_START, frame time) of a packet of the stream (see CodifFile.reference_time())
+        file_packets : int
+            Number of packets per output file
+        window : int
+            Number of frames which are kept for reordering
+        files : list of strings
+            Written files
+        packet_cnt : int
+            Number of written packets
+        zeroed_cnt : int
+            Number of dropped zeroed packets
+        duplicate_cnt : int
+            Number of dropped duplicated packets
+        late_cnt : int
+            Number of dropped packets which arrived after their frame was written
+    Methods
+    -------
+        add(packets, headers)
+            Adds a batch of packets, ordered packets outside of the window are written
+        finish()
+            Writes the pending packets and closes the last file
+        index()
+            Returns the index of the written files (format of PacketIndex)
+    """
+    def __init__(self, odir, header, reference, file_packets, window=64):
+        if file_packets < 1:
+            raise ValueError("Output files must contain at least one packet")
+        self.odir = odir
+        self.header = header
+        self.reference = reference
+        self.file_packets = int(file_packets)
+        self.window = int(window)
+        self.pending = np.empty((0, CODIF_PACKET_SIZE), dtype=np.uint8)
+        self.last = None
+        self.fd = None
+        self.fname = None
+        self.file_cnt = 0
+        self.files = []
+        self.entries = []
+        self.packet_cnt = 0
+        self.zeroed_cnt = 0
+        self.duplicate_cnt = 0
+        self.late_cnt = 0
+
+    def add(self, packets, headers):
+        keep = ~headers.zeroed
+        self.zeroed_cnt += int(np.count_nonzero(~keep))
+        if len(self.pending):
+            packets = np.concatenate((self.pending, packets[keep]))
+            headers = Headers(packets)
+        else:
+            packets = packets[keep]
+            headers = Headers(packets)
+        if not len(packets):
+            return
+        key, beam = headers.key, headers.beam_id.astype(np.int64)
+        if self.last is not None:
+            # Frames which are already written can not be completed any more
+            late = (key < self.last[0]) | ((key == self.last[0]) & (beam <= self.last[1]))
+            self.late_cnt += int(np.count_nonzero(late))
+            packets, key, beam = packets[~late], key[~late], beam[~late]
+        order = np.lexsort((beam, key))
+        # Duplicates are neighbours after sorting, the first received one is kept (stable sort)
+        duplicate = np.concatenate(([False], (key[order][1:] == key[order][:-1]) & (beam[order][1:] == beam[order][:-1])))
+        self.duplicate_cnt += int(np.count_nonzero(duplicate))
+        order = order[~duplicate]
+        packets, key, beam = packets[order], key[order], beam[order]
+        # Packets of the latest window frames may still be completed by later batches
+        # The window is counted in contiguous frames, frame_keys jump at every epoch boundary
+        index = key_index(key)
+        ready = int(np.searchsorted(index, index[-1] - self.window, side="right")) if len(key) else 0
+        self.write(packets[:ready], key[:ready], beam[:ready])
+        self.pending = packets[ready:]
+
+    def obs_offset(self, packet):
+        # OBS_OFFSET of a file starting with the passed packet, derived from its frame time
+        headers = Headers(packet[None, :])
+        if self.header is None or not self.header.bytes_per_second:
+            return self.packet_cnt * CODIF_PACKET_SIZE
+        seconds = self.reference[0] + frame_time(int(headers.epoch[0]), int(headers.frame_id[0])) - self.reference[1]
+        return int(round(seconds * self.header.bytes_per_second))
+
+    def open(self, packet):
+        offset = self.obs_offset(packet)
+        utc = self.header.utc_start if self.header is not None and self.header.utc_start else "unknown"
+        self.fname = self.odir + utc + "_" + str(offset).zfill(16) + ".000000.dada"
+        if self.fname in self.files:
+            self.fname = self.odir + utc + "_" + str(offset).zfill(16) + "." + str(len(self.files)).zfill(6) + ".dada"
+        self.offset = offset
+        self.fd = os.open(self.fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        write_all(self.fd, self.dada_header(self.file_packets))
+        self.files.append(self.fname)
+        self.file_cnt = 0
+
+    def dada_header(self, npackets):
+        keys = OrderedDict(self.header.keys) if self.header is not None else OrderedDict()
+        keys["HDR_SIZE"] = DADA_HEADER_SIZE
+        keys["FILE_SIZE"] = npackets * CODIF_PACKET_SIZE
+        keys["OBS_OFFSET"] = self.offset
+        return format_dada_header(keys, DADA_HEADER_SIZE)
+
+    def close(self):
+        if self.fd is None:
+            return
+        if self.file_cnt != self.file_packets:
+            # The last file is shorter, its FILE_SIZE is corrected
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            write_all(self.fd, self.dada_header(self.file_cnt))
+        os.close(self.fd)
+        self.fd = None
+
+    def write(self, packets, key, beam):
+        start = 0
+        while start < len(packets):
+            if self.fd is None:
+                self.open(packets[start])
+            count = min(self.file_packets - self.file_cnt, len(packets) - start)
+            write_all(self.fd, packets[start:start+count].reshape(-1))
+            # Index entries: one per frame and file
+            part = key[start:start+count]
+            first = np.flatnonzero(np.concatenate(([True], part[1:] != part[:-1])))
+            self.entries.append((np.full(len(first), len(self.files) - 1, dtype=np.int32), first + self.file_cnt, part[first],
+                np.diff(np.append(first, count)).astype(np.int32)))
+            self.file_cnt += count
+            self.packet_cnt += count
+            start += count
+            if self.file_cnt == self.file_packets:
+                self.close()
+        if len(packets):
+            self.last = (int(key[-1]), int(beam[-1]))
+
+    def finish(self):
+        if len(self.pending):
+            headers = Headers(self.pending)
+            self.write(self.pending, headers.key, headers.beam_id.astype(np.int64))
+            self.pending = self.pending[:0]
+        self.close()
+
+    def index(self):
+        """
+        Description:
+        ------------
+            Index of the written files in the format of PacketIndex.result()
+        Returns:
+        --------
+            Dictionary of the arrays files, file_index, packet, key and count
+        """
+        if not self.entries:
+            file, packet, key, count = [np.empty(0, dtype=dtype) for dtype in (np.int32, np.int64, np.int64, np.int32)]
+        else:
+            file, packet, key, count = [np.concatenate(values) for values in zip(*self.entries)]
+            # Frames split by a batch within the same file are joined
+            joined = np.concatenate(([False], (file[1:] == file[:-1]) & (key[1:] == key[:-1])))
+            group = np.cumsum(~joined) - 1
+            count = np.bincount(group, weights=count).astype(np.int32)
+            file, packet, key = file[~joined], packet[~joined].astype(np.int64), key[~joined]
+        return {"files" : np.array([os.path.basename(fname) for fname in self.files]), "file_index" : file, "packet" : packet, "key" : key, "count" : count}
+
+
+class Repacker:
+    """
+    Description:
+    ------------
+        Rewrites every stream ordered and without zeroed, duplicated and late packets into
+        '<odir>/<node>/', see StreamRepacker
+
+    Attributes
+    ----------
+        odir : string
+            Output directory
+        file_packets : int
+            Number of packets per output file (None: the number of packets of the largest input file of the stream)
+        window : int
+            Number of frames which are kept for reordering
+        streams : dict
+            StreamRepacker of every stream
+    Methods
+    -------
+        add(stream, file, packets, headers)
+            Adds a batch of packets
+        end(stream)
+            Writes the pending packets of a stream and its index
+        summary()
+            Returns the counters of all streams
+    """
+    def __init__(self, odir, file_packets=None, window=64):
+        self.odir = odir
+        self.file_packets = file_packets
+        self.window = window
+        self.streams = OrderedDict()
+
+    def create(self, stream, file):
+        odir = self.odir + file.node_name + "/"
+        if not os.path.isdir(odir):
+            os.makedirs(odir)
+        reference = (0.0, 0.0)
+        for candidate in stream.files:
+            reference = candidate.reference_time()
+            if reference != (0.0, 0.0):
+                break
+        file_packets = self.file_packets
+        if file_packets is None:
+            file_packets = max([int(candidate.npackets) for candidate in stream.files])
+        self.streams[stream] = StreamRepacker(odir, stream.files[0].metadata(), reference, file_packets, self.window)
+
+    def add(self, stream, file, packets, headers):
+        if stream not in self.streams:
+            self.create(stream, file)
+        self.streams[stream].add(packets, headers)
+
+    def end(self, stream):
+        if stream not in self.streams:
+            return
+        repacker = self.streams[stream]
+        repacker.finish()
+        np.savez(repacker.odir + "index.npz", **repacker.index())
+
+    def summary(self):
+        """
+        Description:
+        ------------
+            Counters of all streams
+        Returns:
+        --------
+            List of dictionaries (directory, files, packets, zeroed, duplicates, late)
+        """
+        return [{"directory" : repacker.odir, "files" : len(repacker.files), "packets" : repacker.packet_cnt, "zeroed" : repacker.zeroed_cnt,
+            "duplicates" : repacker.duplicate_cnt, "late" : repacker.late_cnt} for repacker in self.streams.values()]
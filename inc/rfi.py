@@ -0,0 +1,141 @@
+"""
+ Description:
+ ------------
+    Spectral kurtosis (SK) RFI detection within the correlation pass.
+    For a block of M samples of one element, polarization and channel with the power sums
+    S1 = sum |x|^2 and S2 = sum |x|^4 the generalized SK estimator is
+        SK = (M+1)/(M-1) * (M*S2/S1^2 - 1)
+    which is 1 for Gaussian noise with a standard deviation of about 2/sqrt(M) (Nita & Gary 2010).
+    Impulsive RFI increases SK, continuous narrow band RFI decreases it. A block fails the test if
+    |SK - 1| exceeds threshold standard deviations.
+
+    The test is applied per channel to blocks of consecutive frames. If more than a fraction of the
+    rows (elements and polarizations) of a channel fail, the samples of the whole block are flagged for
+    this channel, thus all entries of the ACM of a channel are integrated over the same samples. RFI
+    received by the array affects many elements at once, while noise alone lets single rows fail by
+    chance (about 0.3% of the rows at 3 standard deviations).
+
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+"""
+
+from __future__ import division
+import numpy as np
+
+from inc.constants import *
+
+
+class SpectralKurtosis:
+    """
+    Description:
+    ------------
+        Accumulates SK statistics and flags blocks of frames per channel
+
+    Attributes
+    ----------
+        nchannel : int
+            Number of channels
+        nrows : int
+            Number of rows (elements*pol)
+        frames : int
+            Frames per tested block, M = frames*CODIF_BLOCKS_IN_PACKET samples
+        threshold : float
+            Bound of |SK - 1| in standard deviations
+        fraction : float
+            A block is flagged if more than this fraction of the rows fail (0 flags if a single row fails)
+        exclude : bool
+            If True, flagged blocks are excluded from the ACM (see test())
+        s1 : numpy array
+            float64 array of shape (channels, rows), accumulated sum of |x|^2
+        s2 : numpy array
+            float64 array of shape (channels, rows), accumulated sum of |x|^4
+        failed : numpy array
+            int64 array of shape (channels, rows), number of failed blocks per row
+        flagged_frames : numpy array
+            int64 array of shape (channels,), number of frames of flagged blocks
+        frame_cnt : int
+            Number of tested frames
+    Methods
+    -------
+        test(power)
+            Tests the blocks of a batch, returns the mask of the samples to keep
+        flag_fraction()
+            Fraction of flagged frames per channel
+        kurtosis()
+            SK of every row and channel over all tested samples
+    """
+    def __init__(self, nchannel, nrows, frames=16, threshold=3.0, fraction=0.1, exclude=False):
+        self.nchannel = nchannel
+        self.nrows = nrows
+        self.frames = int(frames)
+        self.threshold = float(threshold)
+        self.fraction = float(fraction)
+        self.exclude = exclude
+        self.s1 = np.zeros((nchannel, nrows), dtype=np.float64)
+        self.s2 = np.zeros((nchannel, nrows), dtype=np.float64)
+        self.failed = np.zeros((nchannel, nrows), dtype=np.int64)
+        self.flagged_frames = np.zeros(nchannel, dtype=np.int64)
+        self.frame_cnt = 0
+
+    def test(self, power):
+        """
+        Description:
+        ------------
+            Accumulates the statistics of a batch and tests its blocks. A block contains frames
+            frames, the last block of a batch may be shorter.
+        Parameters
+        ----------
+            power : numpy array
+                |x|^2 of shape (channels, rows, frames*CODIF_BLOCKS_IN_PACKET), samples ordered by frame
+        Returns:
+        --------
+            bool array of shape (channels, samples) which is False for the samples of flagged blocks,
+            or None if nothing is excluded
+        """
+        nsamples = power.shape[-1]
+        if not nsamples:
+            return None
+        starts = np.arange(0, nsamples, self.frames * CODIF_BLOCKS_IN_PACKET)
+        m = np.diff(np.append(starts, nsamples)).astype(np.float64)
+        s1 = np.add.reduceat(power, starts, axis=-1, dtype=np.float64)
+        s2 = np.add.reduceat(power * power, starts, axis=-1, dtype=np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            sk = (m + 1) / (m - 1) * (m * s2 / (s1 * s1) - 1)
+        # Blocks without power (e.g. switched off elements) are not flagged
+        failed = (np.abs(sk - 1) > self.threshold * 2 / np.sqrt(m)) & (s1 > 0)
+        self.s1 += s1.sum(axis=-1)
+        self.s2 += s2.sum(axis=-1)
+        self.failed += failed.sum(axis=-1)
+        flagged = failed.sum(axis=1) > self.fraction * self.nrows
+        nframes = (m // CODIF_BLOCKS_IN_PACKET).astype(np.int64)
+        self.flagged_frames += (flagged * nframes).sum(axis=-1)
+        self.frame_cnt += nsamples // CODIF_BLOCKS_IN_PACKET
+        if not self.exclude or not flagged.any():
+            return None
+        return np.repeat(~flagged, m.astype(np.intp), axis=-1)
+
+    def flag_fraction(self):
+        return self.flagged_frames / max(self.frame_cnt, 1)
+
+    def kurtosis(self):
+        """
+        Description:
+        ------------
+            SK estimator over all tested samples per channel and row (NaN for rows without power)
+        """
+        m = self.frame_cnt * CODIF_BLOCKS_IN_PACKET
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (m + 1) / (m - 1) * (m * self.s2 / (self.s1 * self.s1) - 1)
+
+    def state(self):
+        return {"s1" : self.s1, "s2" : self.s2, "failed" : self.failed, "flagged_frames" : self.flagged_frames, "frame_cnt" : np.array(self.frame_cnt)}
+
+    def restore(self, state):
+        for name in ("s1", "s2", "failed", "flagged_frames"):
+            getattr(self, name)[...] = state[name]
+        self.frame_cnt = int(state["frame_cnt"])
+
+    def merge(self, state):
+        for name in ("s1", "s2", "failed", "flagged_frames"):
+            getattr(self, name)[...] += state[name]
+        self.frame_cnt += int(state["frame_cnt"])
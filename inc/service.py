@@ -0,0 +1,516 @@
+"""
+ Description:
+ ------------
+    asyncio ingest service for many frequency groups (requires Python 3.7 or newer).
+    Every frequency group is received on one or more UDP ports by datagram protocols of a
+    single event loop. The packets of a group are collected in batches (uint8 arrays of shape
+    (packets, CODIF_PACKET_SIZE)) and put into a bounded queue. A consumer per group assembles
+    the frames (FrameAssembler) and sends the frames of every cycle to a process pool, which
+    computes partial ACMs. The partial sums are merged per group and cycle; a cycle is
+    published (ACM snapshot and loss statistics) once a newer cycle was received and all of its
+    partial sums are merged.
+
+    Backpressure: if the queue of a group is full, reading of its sockets is paused until the
+    queue is drained to the half (the kernel buffers or drops packets in the meantime). The
+    number of pool tasks in flight is limited as well, thus a slow pool blocks the consumers
+    instead of collecting an unbounded number of frames.
+
+    replay() is the local replay driver: it sends the '.dada' files of several numa nodes
+    concurrently to the ports of the service, thus the service can be tested end to end on
+    one machine.
+
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+"""
+
+import asyncio
+import json
+import os
+import socket
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from inc.constants import *
+from inc.batch import FrameAssembler
+from inc.correlator import CORRELATORS
+from inc.fileio import PrefetchReader
+from inc.live import frame_cycle
+
+
+def correlate_frames(frames, nelements, correlator, nchannel, pol):
+    """
+    Description:
+    ------------
+        Computes the partial ACM of a block of frames (executed by the workers of the pool)
+    Returns:
+    --------
+        State of the correlator as dictionary of arrays (see Correlator.state())
+    """
+    corr = CORRELATORS[correlator](nelements, nchannel, pol)
+    corr.integrate(frames)
+    return corr.state()
+
+
+class GroupProtocol(asyncio.DatagramProtocol):
+    """
+    Description:
+    ------------
+        Datagram protocol of one socket, passes every datagram to its IngestGroup
+    """
+    def __init__(self, group):
+        self.group = group
+
+    def connection_made(self, transport):
+        self.group.transports.append(transport)
+
+    def datagram_received(self, data, addr):
+        self.group.receive(data)
+
+    def error_received(self, exc):
+        self.group.error_cnt += 1
+
+
+class IngestGroup:
+    """
+    Description:
+    ------------
+        Receive and integration state of one frequency group
+
+    Attributes
+    ----------
+        name : string
+            Name of the group (used for the published snapshots)
+        ports : list of int
+            UDP ports of the group
+        queue : asyncio.Queue
+            Bounded queue of received batches
+        assembler : FrameAssembler
+            Assembles the frames of the group
+        sums : dict
+            Merged partial sums (Correlator) of every unpublished cycle
+        inflight : dict
+            Number of pool tasks of every unpublished cycle
+        packet_cnt : int
+            Number of received packets
+        truncated_cnt : int
+            Number of datagrams with less than CODIF_PACKET_SIZE bytes (dropped)
+        dropped_cnt : int
+            Number of packets dropped since the queue was full
+        late_cnt : int
+            Number of frames which arrived after their cycle was published (dropped)
+        pause_cnt : int
+            Number of times reading was paused by backpressure
+        failed : dict
+            Number of frames of every unpublished cycle whose correlation failed
+        failed_cnt : int
+            Number of frames whose correlation failed (lost)
+    Methods
+    -------
+        receive(data)
+            Adds a datagram to the current batch
+        flush()
+            Puts the current batch into the queue
+    """
+    def __init__(self, name, ports, nelements, batch=1024, queue_size=16, window=4):
+        self.name = name
+        self.ports = ports
+        self.queue = asyncio.Queue(queue_size)
+        self.buffer = np.empty((batch, CODIF_PACKET_SIZE), dtype=np.uint8)
+        self.n = 0
+        self.transports = []
+        self.paused = False
+        self.assembler = FrameAssembler(nelements, window)
+        self.freq_group = None
+        self.sums = {}
+        self.inflight = {}
+        self.newest = None
+        self.published = None
+        self.last_packet = None
+        self.packet_cnt = 0
+        self.truncated_cnt = 0
+        self.dropped_cnt = 0
+        self.late_cnt = 0
+        self.pause_cnt = 0
+        self.failed = {}
+        self.failed_cnt = 0
+        self.error_cnt = 0
+        # Counters of the last published snapshot
+        self.reported = {"packets" : 0, "uncomplete" : 0, "late" : 0, "dropped" : 0}
+
+    def receive(self, data):
+        if len(data) != CODIF_PACKET_SIZE:
+            self.truncated_cnt += 1
+            return
+        self.buffer[self.n] = np.frombuffer(data, dtype=np.uint8)
+        self.n += 1
+        self.packet_cnt += 1
+        if self.n == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        """
+        Description:
+        ------------
+            Puts the current batch into the queue and pauses reading if the queue is full
+        """
+        if not self.n:
+            return
+        packets = self.buffer[:self.n]
+        # The queued batch keeps its buffer, the next datagrams go to a new one
+        self.buffer = np.empty_like(self.buffer)
+        self.n = 0
+        self.last_packet = time.time()
+        try:
+            self.queue.put_nowait(packets)
+        except asyncio.QueueFull:
+            self.dropped_cnt += len(packets)
+        if self.queue.full():
+            self.pause()
+
+    def pause(self):
+        if self.paused:
+            return
+        for transport in self.transports:
+            transport.pause_reading()
+        self.paused = True
+        self.pause_cnt += 1
+
+    def resume(self):
+        if not self.paused or self.queue.qsize() > self.queue.maxsize // 2:
+            return
+        for transport in self.transports:
+            if not transport.is_closing():
+                transport.resume_reading()
+        self.paused = False
+
+    def close(self):
+        for transport in self.transports:
+            transport.close()
+        self.transports = []
+
+
+class IngestService:
+    """
+    Description:
+    ------------
+        Receives many frequency groups and integrates their ACMs in a process pool
+
+    Attributes
+    ----------
+        groups : list of IngestGroup
+            Received frequency groups
+        nelements : int
+            Number of beams per frame
+        cycle : float
+            Integration time of one ACM in seconds of recorded time
+        correlator : string
+            Name of the correlator (see inc/correlator.py)
+        workers : int
+            Number of processes of the pool
+        max_tasks : int
+            Maximum number of pool tasks in flight (backpressure)
+        publishers : list of functions
+            Called with every published snapshot (see publish())
+    Methods
+    -------
+        run(duration, idle)
+            Runs the service until duration seconds passed or no packet arrived for idle seconds
+        publish(group, value)
+            Passes the snapshot of a cycle to all publishers
+    """
+    def __init__(self, groups, nelements=36, cycle=1.0, correlator="integer", host="0.0.0.0", workers=4, max_tasks=None,
+                 batch=1024, queue_size=16, window=4, rcvbuf=64*1024**2, flush_interval=0.1,
+                 nchannel=CODIF_CHANNELS_IN_BLOCK, pol=CODIF_POLARIZATION):
+        if correlator not in CORRELATORS:
+            raise ValueError("Unknown correlator '" + str(correlator) + "', use one of " + ", ".join(sorted(CORRELATORS)))
+        self.group_ports = groups
+        self.nelements = nelements
+        self.cycle = cycle
+        self.correlator = correlator
+        self.host = host
+        self.workers = workers
+        self.max_tasks = max_tasks or 2 * workers
+        self.batch = batch
+        self.queue_size = queue_size
+        self.window = window
+        self.rcvbuf = rcvbuf
+        self.flush_interval = flush_interval
+        self.nchannel = nchannel
+        self.pol = pol
+        self.groups = []
+        self.publishers = []
+        self.tasks = set()
+        self.stopped = None
+
+    def bind(self, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        except OSError:
+            pass
+        sock.bind((self.host, int(port)))
+        return sock
+
+    def stop(self):
+        # May be called by a publisher or a signal handler
+        if self.stopped is not None:
+            self.stopped.set()
+
+    async def consume(self, group):
+        """
+        Description:
+        ------------
+            Assembles the frames of the queued batches of a group and dispatches them to the pool
+        """
+        while True:
+            packets = await group.queue.get()
+            group.resume()
+            if packets is None:
+                break
+            frames, keys = group.assembler.add(packets)
+            if group.freq_group is None and group.assembler.first is not None:
+                group.freq_group = group.assembler.first[2]
+            if len(keys):
+                await self.dispatch(group, frames, keys)
+        group.assembler.flush()
+
+    async def dispatch(self, group, frames, keys):
+        cycles = frame_cycle(keys, self.cycle)
+        if group.published is not None:
+            late = cycles <= group.published
+            if late.any():
+                group.late_cnt += int(np.count_nonzero(late))
+                frames, cycles = frames[~late], cycles[~late]
+        for value in np.unique(cycles):
+            value = int(value)
+            # Waits for a free slot of the pool (backpressure)
+            await self.slots.acquire()
+            group.inflight[value] = group.inflight.get(value, 0) + 1
+            task = asyncio.ensure_future(self.correlate(group, value, frames[cycles == value]))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        if len(cycles):
+            group.newest = max(group.newest, int(cycles[-1])) if group.newest is not None else int(cycles[-1])
+        self.publish_ready(group)
+
+    async def correlate(self, group, value, frames):
+        loop = asyncio.get_running_loop()
+        try:
+            state = await loop.run_in_executor(self.pool, correlate_frames, frames, self.nelements, self.correlator, self.nchannel, self.pol)
+            if value not in group.sums:
+                group.sums[value] = CORRELATORS[self.correlator](self.nelements, self.nchannel, self.pol)
+            group.sums[value].merge(state)
+        except Exception as e:
+            # The frames of a failed task are lost, the cycle is still published with the other tasks
+            group.failed[value] = group.failed.get(value, 0) + len(frames)
+            group.failed_cnt += len(frames)
+            print("Group " + group.name + ": correlation of " + str(len(frames)) + " frames of cycle " + str(value) + " failed: " + repr(e))
+        finally:
+            self.slots.release()
+            # Always completed, otherwise this and all later cycles would never be published
+            group.inflight[value] -= 1
+            self.publish_ready(group)
+
+    def publish_ready(self, group, final=False):
+        """
+        Description:
+        ------------
+            Publishes all cycles in order which are older than the newest cycle and completely merged
+        """
+        for value in sorted(group.inflight):
+            if group.inflight[value] or (not final and (group.newest is None or value >= group.newest)):
+                break
+            self.publish(group, value)
+
+    def publish(self, group, value):
+        """
+        Description:
+        ------------
+            Passes the snapshot of a cycle to all publishers. A snapshot is a dictionary of group,
+            acm, freq, frame_cnt, expected_frames, start (seconds of the reference epoch) and the loss
+            statistics since the last snapshot of the group: packets, uncomplete, late and dropped
+            as well as the totals truncated, paused and queued (current queue size) and failed
+            (frames of this cycle whose correlation failed)
+        """
+        corr = group.sums.pop(value, None)
+        failed = group.failed.pop(value, 0)
+        del group.inflight[value]
+        group.published = value
+        if corr is None:
+            if failed:
+                print("Group " + group.name + ": cycle " + str(value) + " not published, all " + str(failed) + " frames failed")
+            return
+        freq = np.arange(group.freq_group, group.freq_group + self.nchannel) if group.freq_group is not None else np.array([])
+        counters = {"packets" : group.packet_cnt, "uncomplete" : group.assembler.uncomplete_cnt, "late" : group.late_cnt, "dropped" : group.dropped_cnt}
+        snapshot = {
+            "group" : group.name,
+            "acm" : corr.result(),
+            "freq" : freq,
+            "frame_cnt" : corr.frame_cnt,
+            "expected_frames" : int(round(self.cycle / (CODIF_BLOCKS_IN_PACKET / PAF_SAMPLE_PERIOD))),
+            "start" : value * self.cycle,
+            "truncated" : group.truncated_cnt,
+            "paused" : group.pause_cnt,
+            "queued" : group.queue.qsize(),
+            "failed" : failed}
+        for name, cnt in counters.items():
+            snapshot[name] = cnt - group.reported[name]
+        group.reported = counters
+        for publisher in self.publishers:
+            publisher(snapshot)
+
+    async def serve(self, duration=None, idle=None):
+        """
+        Description:
+        ------------
+            Coroutine of run()
+        """
+        loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        self.slots = asyncio.Semaphore(self.max_tasks)
+        self.groups = [IngestGroup(str(idx) if len(ports) > 1 else str(ports[0]), ports, self.nelements, self.batch, self.queue_size, self.window)
+            for idx, ports in enumerate(self.group_ports)]
+        for group in self.groups:
+            for port in group.ports:
+                await loop.create_datagram_endpoint(lambda group=group: GroupProtocol(group), sock=self.bind(port))
+        consumers = [asyncio.ensure_future(self.consume(group)) for group in self.groups]
+        start = time.time()
+        try:
+            while not self.stopped.is_set():
+                try:
+                    await asyncio.wait_for(self.stopped.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                # Batches which are not full are passed on after flush_interval
+                for group in self.groups:
+                    group.flush()
+                now = time.time()
+                if duration is not None and now - start >= duration:
+                    break
+                last = [group.last_packet for group in self.groups if group.last_packet is not None]
+                if idle is not None and now - (max(last) if last else start) >= idle:
+                    break
+        finally:
+            for group in self.groups:
+                group.close()
+                group.flush()
+                await group.queue.put(None)
+            await asyncio.gather(*consumers)
+            await asyncio.gather(*list(self.tasks))
+        # The last cycles are published even if they are not complete
+        for group in self.groups:
+            self.publish_ready(group, final=True)
+
+    def run(self, duration=None, idle=None):
+        """
+        Description:
+        ------------
+            Runs the service
+        Parameters
+        ----------
+            duration : float
+                Maximum run time in seconds (optional, default endless)
+            idle : float
+                Stop if no packet arrived for idle seconds (optional)
+        Returns:
+        --------
+            List of IngestGroup with the final statistics
+        """
+        self.pool = ProcessPoolExecutor(self.workers)
+        try:
+            asyncio.run(self.serve(duration, idle))
+        finally:
+            self.pool.shutdown()
+        return self.groups
+
+
+class SnapshotWriter:
+    """
+    Description:
+    ------------
+        Publisher which stores every snapshot as '.npz' file (<dir>/<group>/acm_<start>.npz) and appends
+        its statistics as JSON line to <dir>/stats.jsonl
+    """
+    def __init__(self, dir):
+        self.dir = dir
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+
+    def __call__(self, snapshot):
+        gdir = os.path.join(self.dir, snapshot["group"])
+        if not os.path.isdir(gdir):
+            os.makedirs(gdir)
+        np.savez(os.path.join(gdir, "acm_{:.3f}.npz".format(snapshot["start"])), acm=snapshot["acm"], freq=snapshot["freq"],
+            frame_cnt=snapshot["frame_cnt"], start=snapshot["start"])
+        stats = dict((key, value) for key, value in snapshot.items() if key not in ("acm", "freq"))
+        with open(os.path.join(self.dir, "stats.jsonl"), "a") as f:
+            f.write(json.dumps(stats) + "\n")
+
+
+async def replay_stream(files, host, port, rate=0.0, loops=1, buffer_size=16*1024**2, max_buffered=4*1024**2):
+    """
+    Description:
+    ------------
+        Sends all packets of '.dada' files to one port (one packet per datagram)
+    Parameters
+    ----------
+        files : list of strings
+            '.dada' files in stream order
+        rate : float
+            Data rate in MB/s (0 sends as fast as possible)
+        max_buffered : int
+            Maximum number of bytes in the write buffer of the transport, sending waits until it drained
+    Returns:
+    --------
+        Number of sent packets
+    """
+    loop = asyncio.get_running_loop()
+    transport, __ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=(host, int(port)))
+    cnt = 0
+    start = time.time()
+    try:
+        for __ in range(loops):
+            for fname in files:
+                reader = iter(PrefetchReader(fname, buffer_size=buffer_size))
+                while True:
+                    # The files are read by a thread, the event loop keeps serving the other streams
+                    packets = await loop.run_in_executor(None, next, reader, None)
+                    if packets is None:
+                        break
+                    data = memoryview(np.ascontiguousarray(packets).reshape(-1))
+                    for idx in range(len(packets)):
+                        transport.sendto(data[idx*CODIF_PACKET_SIZE:(idx+1)*CODIF_PACKET_SIZE])
+                        cnt += 1
+                        if cnt % 64:
+                            continue
+                        while transport.get_write_buffer_size() > max_buffered:
+                            await asyncio.sleep(0.001)
+                        ahead = cnt * CODIF_PACKET_SIZE / (rate * 1e6) - (time.time() - start) if rate > 0 else 0
+                        await asyncio.sleep(max(ahead, 0))
+        while transport.get_write_buffer_size():
+            await asyncio.sleep(0.001)
+    finally:
+        transport.close()
+    return cnt
+
+
+def replay(streams, host="127.0.0.1", rate=0.0, loops=1):
+    """
+    Description:
+    ------------
+        Local replay driver, sends several streams concurrently
+    Parameters
+    ----------
+        streams : list of tuples
+            (files, port) of every stream, e.g. the files of one numa node
+        rate : float
+            Data rate per stream in MB/s (0 sends as fast as possible)
+    Returns:
+    --------
+        List of the number of sent packets per stream
+    """
+    async def send_all():
+        return await asyncio.gather(*[replay_stream(files, host, port, rate, loops) for files, port in streams])
+    return asyncio.run(send_all())
@@ -0,0 +1,289 @@
+"""
+ Description:
+ ------------
+    Generator for synthetic CODIF data.
+    Writes '.dada' files (DADA header + CODIF packets) or '.pcap' files (ETHII/IPV4/UDP/CODIF)
+    in the folder structure recorded by the PAF backend (root_dir/numaID/...). The generated data
+    are used to benchmark and validate the processing chain without access to real snapshots.
+
+    The payload consists of gaussian noise of every element plus a common signal, so that
+    computed ACMs are not diagonal. Packet loss, zeroed packets and reordered packets can be
+    injected with configurable rates.
+
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+"""
+
+from __future__ import division
+import os
+import struct
+import time
+import numpy as np
+
+from inc.constants import *
+from inc.utils import check_slash
+
+FRAME_PERIOD = CODIF_BLOCKS_IN_PACKET / PAF_SAMPLE_PERIOD   # Duration of one frame in seconds
+EPOCH_PERIOD = 27                                           # Seconds of one CODIF reference period
+UDP_BASE_PORT = 17100
+
+
+def codif_header(epoch, frame_id, beam_id, freq_group, period=EPOCH_PERIOD):
+    """
+    Description:
+    ------------
+        Packs the 64 bytes CODIF header of one packet (counterpart of CodifHeader.parse())
+    Parameters
+    ----------
+        epoch : int
+            Seconds since reference epoch
+        frame_id : int
+            Frame index within the reference period
+        beam_id : int
+            Beam (element) index
+        freq_group : int
+            Frequency group of the packet
+        period : int
+            Length of a reference period in seconds (optional)
+    Returns:
+    --------
+        Header as bytes
+    """
+    word0 = ((epoch & 0x3FFFFFFF) << 32) | (frame_id & 0xFFFFFFFF)
+    word1 = (16 << 56) | ((CODIF_PAYLOAD // 8) << 32)
+    word2 = (CODIF_BLOCKS_IN_PACKET << 48) | (CODIF_CHANNELS_IN_BLOCK << 32) | (freq_group << 16) | beam_id
+    word3 = period << 32
+    word4 = PAF_EPOCH_PERIOD
+    return struct.pack("!8Q", word0, word1, word2, word3, word4, 0xABADDEED << 32, 0, 0)
+
+def dada_header(utc_start, obs_offset, file_size, freq, nbeam, freq_group, bytes_per_second):
+    """
+    Description:
+    ------------
+        Creates an ASCII DADA header padded to DADA_HEADER_SIZE bytes
+    Parameters
+    ----------
+        utc_start : string
+            Start time of the observation (YYYY-MM-DD-hh:mm:ss)
+        obs_offset : int
+            Offset in bytes of the first packet of this file relative to the start of the observation
+        file_size : int
+            Number of data bytes in this file (without DADA header)
+        freq : float
+            Center frequency of the frequency group in MHz
+        nbeam : int
+            Number of recorded beams / elements
+        freq_group : int
+            Frequency group id
+        bytes_per_second : float
+            Data rate of the stream
+    Returns:
+    --------
+        Header as bytes
+    """
+    keys = [("HEADER", "DADA"),
+        ("HDR_VERSION", "1.0"),
+        ("HDR_SIZE", DADA_HEADER_SIZE),
+        ("DADA_VERSION", "1.0"),
+        ("INSTRUMENT", "PAF"),
+        ("TELESCOPE", "Effelsberg"),
+        ("UTC_START", utc_start),
+        ("OBS_OFFSET", obs_offset),
+        ("FILE_SIZE", file_size),
+        ("BYTES_PER_SECOND", repr(float(bytes_per_second))),
+        ("FREQ", repr(float(freq))),
+        ("BW", repr(float(CODIF_CHANNELS_IN_BLOCK))),
+        ("NCHAN", CODIF_CHANNELS_IN_BLOCK),
+        ("NBEAM", nbeam),
+        ("FREQ_GROUP", freq_group),
+        ("NPOL", CODIF_POLARIZATION),
+        ("NDIM", 2),
+        ("NBIT", 16),
+        ("TSAMP", repr(1.0 / PAF_SAMPLE_PERIOD * 1e6)),
+        ("PKT_SIZE", CODIF_PACKET_SIZE)]
+    text = "".join("{:<20}{}\n".format(key, value) for key, value in keys)
+    return text.encode("ascii").ljust(DADA_HEADER_SIZE, b"\0")
+
+def network_header(src_port, dest_port):
+    """
+    Description:
+    ------------
+        Packs the ETHII, IPV4 and UDP header of a CODIF packet (counterpart of parse_eth_hdr(),
+        parse_ipv4_hdr() and parse_udp_hdr())
+    """
+    eth = b"\x00\x11\x22\x33\x44\x55" + b"\x66\x77\x88\x99\xaa\xbb" + struct.pack("!H", 0x0800)
+    ipv4 = struct.pack("!BBHHHBBH4s4s", 0x45, 0, CODIF_TOTAL_SIZE - ETHII_HEADER, 0, 0x4000, 64, 17, 0,
+        b"\x0a\x11\x00\x01", b"\x0a\x11\x00\x02")
+    udp = struct.pack("!HHHH", src_port, dest_port, CODIF_TOTAL_SIZE - ETHII_HEADER - IPV4_HEADER, 0)
+    return eth + ipv4 + udp
+
+
+class SyntheticSnapshot:
+    """
+    Description:
+    ------------
+        Generates a synthetic snapshot of CODIF data.
+
+    Attributes
+    ----------
+        root : string
+            Root directory of the snapshot. Files are written to root/numaID/
+        nbeams : int
+            Number of beams (elements) per frame
+        freq_groups : list of int
+            Frequency group (lowest sky frequency in MHz) of each numa node (one node per entry)
+        duration : float
+            Duration of the snapshot in seconds
+        file_size : int
+            Maximum number of packets per file
+        loss : float
+            Fraction of packets that are dropped
+        zeroed : float
+            Fraction of packets that are replaced by zeroed packets
+        reorder : float
+            Fraction of packets that are swapped with their successor
+        seed : int
+            Seed of the random generator
+        frame_id : int
+            frame_id of the first frame, e.g. PAF_EPOCH_PERIOD - 10 to cross an epoch boundary after 10 frames
+    Methods
+    -------
+        frames()
+            Number of frames per node
+        packets(freq_group)
+            Generator of (header, payload) tuples of one node
+        write(type)
+            Writes all nodes as 'dada' or 'pcap' files and returns the list of files
+    """
+    def __init__(self, root, nbeams=36, freq_groups=[1340], duration=0.1, file_size=10000, loss=0.0,
+        zeroed=0.0, reorder=0.0, seed=0, utc_start="2020-12-09-15:57:51", epoch=1000, frame_id=0):
+        self.root = check_slash(root)
+        self.nbeams = nbeams
+        self.freq_groups = list(freq_groups)
+        self.duration = duration
+        self.file_size = file_size
+        self.loss = loss
+        self.zeroed = zeroed
+        self.reorder = reorder
+        self.seed = seed
+        self.utc_start = utc_start
+        self.epoch = epoch
+        self.frame_id = frame_id
+        self.bytes_per_second = nbeams * CODIF_PACKET_SIZE / FRAME_PERIOD
+
+    def frames(self):
+        return max(int(round(self.duration / FRAME_PERIOD)), 1)
+
+    def payloads(self, rng, nframes):
+        """
+        Description:
+        ------------
+            Generator of payloads for all beams of one frame. The payloads are
+            big-endian int16 arrays of shape (beams, blocks, channels, pol, re/im).
+        """
+        shape = (self.nbeams, CODIF_BLOCKS_IN_PACKET, CODIF_CHANNELS_IN_BLOCK, CODIF_POLARIZATION, 2)
+        gain = rng.uniform(0.5, 1.5, (self.nbeams, 1, 1, CODIF_POLARIZATION, 1))
+        for __ in range(nframes):
+            common = rng.normal(0, 200, shape[1:])
+            noise = rng.normal(0, 100, shape)
+            yield np.clip(noise + gain * common, -32768, 32767).astype('>i2')
+
+    def packets(self, freq_group):
+        """
+        Description:
+        ------------
+            Generator of (header, payload) tuples of one node, including injected errors
+        Parameters
+        ----------
+            freq_group : int
+                Frequency group of the node
+        """
+        rng = np.random.RandomState(self.seed + freq_group)
+        zero_packet = (b"\0" * CODIF_HEADER, b"\0" * CODIF_PAYLOAD)
+        delayed = None
+        epoch = self.epoch
+        frame_id = self.frame_id
+        for data in self.payloads(rng, self.frames()):
+            for beam in range(self.nbeams):
+                if self.loss and rng.uniform() < self.loss:
+                    continue
+                if self.zeroed and rng.uniform() < self.zeroed:
+                    packet = zero_packet
+                else:
+                    packet = (codif_header(epoch, frame_id, beam, freq_group), data[beam].tobytes())
+                # Swap the packet with its successor
+                if delayed is not None:
+                    yield packet
+                    yield delayed
+                    delayed = None
+                elif self.reorder and rng.uniform() < self.reorder:
+                    delayed = packet
+                else:
+                    yield packet
+            frame_id += 1
+            if frame_id == PAF_EPOCH_PERIOD:
+                frame_id = 0
+                epoch += EPOCH_PERIOD
+        if delayed is not None:
+            yield delayed
+
+    def write(self, type="dada"):
+        """
+        Description:
+        ------------
+            Writes all nodes of the snapshot to disk
+        Parameters
+        ----------
+            type : string
+                Either 'dada' or 'pcap'
+        Returns:
+        --------
+            List of written files
+        """
+        files = []
+        for node, freq_group in enumerate(self.freq_groups):
+            dir = self.root + "numa" + str(node) + "/"
+            if not os.path.isdir(dir):
+                os.makedirs(dir)
+            if type == "dada":
+                files += self.write_dada(dir, freq_group)
+            elif type == "pcap":
+                files += self.write_pcap(dir, freq_group)
+            else:
+                raise ValueError("Unknown file type " + type)
+        return files
+
+    def write_dada(self, dir, freq_group):
+        files = []
+        freq = freq_group + (CODIF_CHANNELS_IN_BLOCK - 1) / 2
+        packets = self.packets(freq_group)
+        offset = 0
+        while True:
+            chunk = [p for __, p in zip(range(self.file_size), packets)]
+            if not chunk:
+                break
+            size = len(chunk) * CODIF_PACKET_SIZE
+            fname = dir + "{}_{:016d}.000000.dada".format(self.utc_start, offset)
+            with open(fname, "wb") as f:
+                f.write(dada_header(self.utc_start, offset, size, freq, self.nbeams, freq_group, self.bytes_per_second))
+                for header, payload in chunk:
+                    f.write(header)
+                    f.write(payload)
+            files.append(fname)
+            offset += size
+        return files
+
+    def write_pcap(self, dir, freq_group):
+        fname = dir + "{}_{:016d}.000000.pcap".format(self.utc_start, 0)
+        start = time.mktime(time.strptime(self.utc_start, "%Y-%m-%d-%H:%M:%S"))
+        with open(fname, "wb") as f:
+            # Global header: magic, version 2.4, timezone, accuracy, snaplen, ethernet
+            f.write(struct.pack("<IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+            for idx, (header, payload) in enumerate(self.packets(freq_group)):
+                stamp = start + idx // self.nbeams * FRAME_PERIOD
+                beam = struct.unpack("!Q", header[16:24])[0] & 0xFFFF
+                f.write(struct.pack("<IIII", int(stamp), int((stamp % 1) * 1e6), CODIF_TOTAL_SIZE, CODIF_TOTAL_SIZE))
+                f.write(network_header(UDP_BASE_PORT + beam, UDP_BASE_PORT + freq_group))
+                f.write(header)
+                f.write(payload)
+        return [fname]
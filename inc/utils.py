@@ -6,6 +6,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 # Custom modules
 from inc.constants import *
+from inc.packed import PackedACM, SparseACM
 
 def format_mac_address(mac_string):
     return ':'.join('%02x' % b for b in bytearray(mac_string))
@@ -69,28 +70,122 @@ def plot_acm(acm, freq, timestamp=0, yaxis=2, dir="", element_list=[]):
         print("Saved results: " + dir)
     plt.show()
 
-def select_from_list(data, element_list):
-    dim1 = data.shape[0]
-    selected_data = np.zeros((dim1, len(element_list), len(element_list)),dtype=type(data))
-    for idx in range(dim1):
-        for eidx, e in enumerate(element_list):
-            selected_data[idx, eidx] = data[idx, e, element_list]
-    return selected_data
+def select_from_list(data, element_list, index=Ellipsis):
+    """
+    Description:
+    ------------
+        Selects the rows and columns of element_list of every ACM
+    Parameters
+    ----------
+        data : numpy array, PackedACM or SparseACM
+            ACMs of shape (..., N_ELEMENTS, N_ELEMENTS)
+        element_list : list
+            Ports to select
+        index : int, tuple or slice
+            Selection of the leading dimensions of a PackedACM or SparseACM (optional)
+    Returns:
+    --------
+        numpy array of shape (..., len(element_list), len(element_list))
+    """
+    if isinstance(data, (PackedACM, SparseACM)):
+        return data.select(index, element_list)
+    return data[..., element_list, :][..., element_list]
 
 
-def fillup_acm(acm, element_list, freq_list, start=1148):
-    filled = np.zeros((1+CODIF_CHANNELS_IN_BLOCK,PAF_N_FREQ_GROUP, N_ELEMENTS, N_ELEMENTS), dtype='complex')
+def fillup_acm(acm, element_list, freq_list, start=1148, out=None):
+    """
+    Description:
+    ------------
+        Places the ACMs of the channels of one frequency group into the full band ACM
+        of shape (1+CODIF_CHANNELS_IN_BLOCK, PAF_N_FREQ_GROUP, N_ELEMENTS, N_ELEMENTS)
+    Parameters
+    ----------
+        acm : numpy array
+            ACMs of shape (channels, len(element_list), len(element_list))
+        element_list : list
+            Port of every row of acm
+        freq_list : list
+            Sky frequency of every channel of acm
+        start : int
+            Lowest sky frequency of the band (optional)
+        out : numpy array, PackedACM or SparseACM
+            Full band ACM to add to (optional, default a new complex64 array). A SparseACM
+            must contain all ports of element_list
+    Returns:
+    --------
+        out
+    """
+    if out is None:
+        out = np.zeros((1+CODIF_CHANNELS_IN_BLOCK, PAF_N_FREQ_GROUP, N_ELEMENTS, N_ELEMENTS), dtype=np.complex64)
     sky_freq = np.zeros((1+CODIF_CHANNELS_IN_BLOCK,PAF_N_FREQ_GROUP))
     for idx in range(1+CODIF_CHANNELS_IN_BLOCK):
         sky_freq[idx] = np.arange(start + idx, start + PAF_BANDWIDTH, 8)
-    for freq in freq_list:
-        for row in range(N_ELEMENTS):
-            if row in element_list:
-                for col in range(N_ELEMENTS):
-                    if col in element_list:
-                        x = np.nonzero(np.asarray(element_list) == row)
-                        y = np.nonzero(np.asarray(element_list) == col)
-                        z = np.nonzero(freq_list == freq)
-                        pos = np.argwhere(sky_freq == float(freq))
-                        filled[pos[0,0], pos[0,1], row, col] += acm[z,x,y].reshape(1)[0]
-    return filled
+    for z, freq in enumerate(freq_list):
+        pos = np.argwhere(sky_freq == float(freq))
+        index = (pos[0,0], pos[0,1])
+        if isinstance(out, SparseACM):
+            out.add(index, element_list, acm[z])
+        elif isinstance(out, PackedACM):
+            out.add_block(index, element_list, element_list, acm[z])
+        else:
+            out[index + np.ix_(element_list, element_list)] += acm[z]
+    return out
+
+
+def frequency_table(freq_dict, start=1148):
+    """
+    Description:
+    ------------
+        Sky frequencies of the full band and the number of frames and flags of every frequency
+        as expected by data_to_dict() (see inc/acm_hdf5.py)
+    Parameters
+    ----------
+        freq_dict : dict
+            Number of integrated frames of every computed frequency (keys are strings)
+        start : int
+            Lowest sky frequency of the band (optional)
+    Returns:
+    --------
+        Tuple of (sky_frequency, frames, flagged) of shape (1+CODIF_CHANNELS_IN_BLOCK, PAF_N_FREQ_GROUP).
+        Frequencies which were not computed are flagged
+    """
+    flagged = np.ones((1+CODIF_CHANNELS_IN_BLOCK, PAF_N_FREQ_GROUP))
+    frames = np.zeros((1+CODIF_CHANNELS_IN_BLOCK, PAF_N_FREQ_GROUP), dtype="float")
+    sky_frequency = np.zeros((1+CODIF_CHANNELS_IN_BLOCK, PAF_N_FREQ_GROUP), dtype="float")
+    for idx in range(1+CODIF_CHANNELS_IN_BLOCK):
+        sky_frequency[idx, :] = np.arange(start + idx, start + PAF_BANDWIDTH, 8)
+    for key, value in freq_dict.items():
+        pos = np.argwhere(sky_frequency==float(key))
+        frames[pos[0,0], pos[0,1]] = value
+        flagged[pos[0,0], pos[0,1]] = 0
+    return sky_frequency, frames, flagged
+
+
+def flag_table(flag_dict, sky_frequency, flagged, max_flagged=0.5):
+    """
+    Description:
+    ------------
+        Fraction of RFI flagged frames of every frequency (see inc/rfi.py). The status of frequencies
+        with a fraction above max_flagged is set to 2 (RFI), thus readers skip them like frequencies
+        which were not computed (status 1)
+    Parameters
+    ----------
+        flag_dict : dict
+            Flagged fraction of every computed frequency (keys are strings)
+        sky_frequency : numpy array
+            Sky frequencies returned by frequency_table()
+        flagged : numpy array
+            Status returned by frequency_table(), modified in place
+        max_flagged : float
+            Maximum flagged fraction of a usable frequency
+    Returns:
+    --------
+        Flagged fraction of shape (1+CODIF_CHANNELS_IN_BLOCK, PAF_N_FREQ_GROUP)
+    """
+    fraction = np.zeros(sky_frequency.shape, dtype=np.float32)
+    for key, value in flag_dict.items():
+        pos = np.argwhere(sky_frequency==float(key))
+        fraction[pos[0,0], pos[0,1]] = value
+        if value > max_flagged:
+            flagged[pos[0,0], pos[0,1]] = 2
+    return fraction
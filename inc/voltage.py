@@ -0,0 +1,274 @@
+"""
+ Description:
+ ------------
+    Lazy array view of the raw voltages of one node (numa directory).
+    VoltageArray maps the '.dada' files of a stream into memory and builds a map of every
+    (time frame, element) to the position of its packet once from the packet headers. The
+    voltages are only read and decoded when the array is sliced, thus snapshots of several
+    terabytes can be analysed with numpy idioms, e.g.
+
+        data = handler.to_array()
+        data[1000:2000, 5, :, 3, 0]         # element 5, channel 3, x-pol of 1000 frames
+        data[::100].mean(axis=(0, 2))       # would read all packets, prefer small slices
+
+    The array has the shape (frames, elements, CODIF_BLOCKS_IN_PACKET, CODIF_CHANNELS_IN_BLOCK,
+    CODIF_POLARIZATION) and the type complex64. The time axis is continuous: frame i starts
+    i*CODIF_BLOCKS_IN_PACKET/PAF_SAMPLE_PERIOD seconds after the first frame of the stream,
+    frames or elements without packet are zero (or masked with masked=True).
+
+    Unlike numpy, index arrays of the frame and the element axis select the outer product
+    (like h5py), e.g. data[[0, 5], [1, 2]] has the shape (2, 2, ...).
+
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+"""
+
+from __future__ import division
+import os
+import numbers
+import numpy as np
+
+from inc.constants import *
+from inc.batch import Headers, records, frame_time
+
+# Duration of a frame in seconds
+FRAME_PERIOD = CODIF_BLOCKS_IN_PACKET / PAF_SAMPLE_PERIOD
+VOLTAGE_SHAPE = (CODIF_BLOCKS_IN_PACKET, CODIF_CHANNELS_IN_BLOCK, CODIF_POLARIZATION)
+
+
+def expand_index(index, ndim):
+    # Expands an index to one item per axis (Ellipsis and missing axes become full slices)
+    if not isinstance(index, tuple):
+        index = (index,)
+    if any([item is None for item in index]):
+        raise IndexError("VoltageArray does not support new axes")
+    ellipsis = [idx for idx, item in enumerate(index) if item is Ellipsis]
+    if len(ellipsis) > 1:
+        raise IndexError("An index can only have a single ellipsis")
+    if ellipsis:
+        pos = ellipsis[0]
+        index = index[:pos] + (slice(None),)*(ndim - len(index) + 1) + index[pos+1:]
+    if len(index) > ndim:
+        raise IndexError("Too many indices for an array of " + str(ndim) + " dimensions")
+    return index + (slice(None),)*(ndim - len(index))
+
+
+def is_basic(item):
+    return isinstance(item, (slice, numbers.Integral))
+
+
+class VoltageArray:
+    """
+    Description:
+    ------------
+        Array of the voltages of one stream, packets are decoded on access
+
+    Attributes
+    ----------
+        files : list of CodifFile
+            Consecutive 'dada' files of the stream
+        nelements : int
+            Number of elements, packets with a larger beam_id are skipped
+        masked : bool
+            If True, slices are returned as numpy masked arrays with missing packets masked
+        table : numpy array
+            Position of the packet of every (frame, element) within the stream (packets after the
+            DADA headers of all files), -1 if the packet is missing
+        offsets : numpy array
+            Position of the first packet of every file within the stream
+        reference : tuple
+            (epoch, frame_id) of the first frame
+        freq : numpy array
+            Channel frequencies of the DADA header (None if not recorded)
+        duplicate_cnt : int
+            Number of packets which were received twice (the last one is used)
+        outlier_cnt : int
+            Number of skipped packets of small isolated groups (corrupt headers, see max_gap)
+        packet_cnt : int
+            Number of mapped packets
+    Methods
+    -------
+        save_index(fname)
+            Stores the frame map, it is loaded instead of reading the headers again
+        available
+            Bool array (frames, elements), True if the packet was recorded
+        times
+            Start of every frame in seconds since the reference epoch (see frame_time())
+    """
+    def __init__(self, files, nelements=None, masked=False, index=None, batch=65536, block=4096, max_gap=60.0, min_packets=64):
+        """
+        Description:
+        ------------
+            Maps the files and builds the frame map from the packet headers (or loads it from index)
+
+        Parameters
+        ----------
+            files : list of CodifFile
+                Consecutive 'dada' files of one node
+            nelements : int
+                Number of elements (optional, default NBEAM of the DADA header or the largest beam_id + 1)
+            masked : bool
+                Return masked arrays
+            index : string
+                Name of a '.npz' file storing the frame map. It is created if it does not exist (optional)
+            batch : int
+                Number of headers decoded at once while building the frame map
+            block : int
+                Number of packets decoded at once while slicing
+            max_gap : float
+                Groups of packets separated from all others by gaps longer than max_gap seconds are
+                skipped if they contain less than min_packets packets. They are caused by corrupt
+                headers and would add all frames in between. Larger groups are kept, the frames of
+                the gap are missing
+            min_packets : int
+                Minimum number of packets of an isolated group
+        """
+        self.files = list(files)
+        self.masked = masked
+        self.block = block
+        self.views = [file.packet_view() for file in self.files]
+        self.offsets = np.cumsum([0] + [len(view) for view in self.views]).astype(np.int64)
+        header = self.files[0].metadata() if self.files else None
+        self.freq = header.channel_frequencies() if header is not None else None
+        if nelements is None and header is not None and header.nbeam:
+            nelements = header.nbeam
+        if index is not None and os.path.isfile(index):
+            self.load_index(index)
+        else:
+            self.build(nelements, batch, max_gap, min_packets)
+            if index is not None:
+                self.save_index(index)
+        self.nelements = self.table.shape[1]
+        self.shape = (self.table.shape[0], self.nelements) + VOLTAGE_SHAPE
+        self.ndim = len(self.shape)
+        self.dtype = np.dtype(np.complex64)
+        self.size = int(np.prod(self.shape))
+
+    def build(self, nelements, batch, max_gap=60.0, min_packets=64):
+        # Reads the headers of all packets, only their pages are touched
+        slots, beams, positions = [], [], []
+        self.reference = None
+        for view, offset in zip(self.views, self.offsets):
+            for start in range(0, len(view), batch):
+                headers = Headers(view[start:start+batch])
+                valid = ~headers.zeroed
+                if nelements is not None:
+                    valid &= headers.beam_id < nelements
+                valid = np.flatnonzero(valid)
+                if not len(valid):
+                    continue
+                epoch, frame_id = headers.epoch[valid], headers.frame_id[valid]
+                if self.reference is None:
+                    self.reference = (int(epoch[0]), int(frame_id[0]))
+                # Frames relative to the reference, frame_ids restart with every epoch
+                elapsed = (epoch.astype(np.float64) - self.reference[0]) + (frame_id.astype(np.float64) - self.reference[1]) * FRAME_PERIOD
+                slots.append(np.round(elapsed / FRAME_PERIOD).astype(np.int64))
+                beams.append(headers.beam_id[valid].astype(np.int64))
+                positions.append(valid + start + offset)
+        if not slots:
+            self.reference = (0, 0)
+            self.table = np.full((0, nelements or 0), -1, dtype=np.int64)
+            self.duplicate_cnt = 0
+            self.outlier_cnt = 0
+            self.packet_cnt = 0
+            return
+        slots, beams, positions = [np.concatenate(values) for values in (slots, beams, positions)]
+        # Frames separated by gaps longer than max_gap form groups, small groups are corrupt headers
+        used = np.unique(slots)
+        starts = used[1:][np.diff(used) * FRAME_PERIOD > max_gap]
+        group = np.searchsorted(starts, slots, side="right")
+        count = np.bincount(group)
+        valid = count >= min_packets
+        valid[np.argmax(count)] = True
+        keep = valid[group]
+        self.outlier_cnt = len(slots) - int(np.count_nonzero(keep))
+        slots, beams, positions = slots[keep], beams[keep], positions[keep]
+        first = int(slots.min())
+        if first != 0:
+            # Packets before the first packet of the stream (out of order) or a skipped first packet
+            self.reference = self.frame_at(int(positions[np.argmin(slots)]))
+            slots -= first
+        if nelements is None:
+            nelements = int(beams.max()) + 1
+        dtype = np.int32 if self.offsets[-1] < np.iinfo(np.int32).max else np.int64
+        self.table = np.full((int(slots.max()) + 1, nelements), -1, dtype=dtype)
+        cells = slots * nelements + beams
+        self.duplicate_cnt = len(cells) - len(np.unique(cells))
+        # Assigned in stream order, the last packet of duplicates is kept
+        self.table.reshape(-1)[cells] = positions
+        self.packet_cnt = len(positions) - self.duplicate_cnt
+
+    def frame_at(self, position):
+        # (epoch, frame_id) of the packet at a stream position
+        f = int(np.searchsorted(self.offsets, position, side="right")) - 1
+        headers = Headers(np.asarray(self.views[f][position-self.offsets[f]:position-self.offsets[f]+1]))
+        return (int(headers.epoch[0]), int(headers.frame_id[0]))
+
+    def save_index(self, fname):
+        np.savez(fname, table=self.table, reference=np.array(self.reference, dtype=np.int64),
+            duplicate_cnt=self.duplicate_cnt, outlier_cnt=self.outlier_cnt, files=np.array([file.fname for file in self.files]), offsets=self.offsets)
+
+    def load_index(self, fname):
+        index = np.load(fname)
+        if list(index["files"]) != [file.fname for file in self.files] or not np.array_equal(index["offsets"], self.offsets):
+            raise ValueError("Index " + fname + " was created for other files")
+        self.table = index["table"]
+        self.reference = tuple(int(value) for value in index["reference"])
+        self.duplicate_cnt = int(index["duplicate_cnt"])
+        self.outlier_cnt = int(index["outlier_cnt"]) if "outlier_cnt" in index.files else 0
+        self.packet_cnt = int(np.count_nonzero(self.table >= 0))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return "VoltageArray(shape=" + str(self.shape) + ", dtype=" + str(self.dtype) + ", packets=" + str(self.packet_cnt) + ")"
+
+    @property
+    def available(self):
+        return self.table >= 0
+
+    @property
+    def times(self):
+        return frame_time(*self.reference) + np.arange(len(self)) * FRAME_PERIOD
+
+    def decode(self, positions, trailing):
+        # Reads and converts the packets at the passed stream positions in stream order
+        shape = np.empty(VOLTAGE_SHAPE, dtype=bool)[trailing].shape
+        data = np.empty((len(positions),) + shape, dtype=np.complex64)
+        order = np.argsort(positions, kind="mergesort")
+        files = np.searchsorted(self.offsets, positions[order], side="right") - 1
+        for start in range(0, len(order), self.block):
+            sel = order[start:start+self.block]
+            fidx = files[start:start+self.block]
+            for f in np.unique(fidx):
+                rows = sel[fidx == f]
+                packets = np.asarray(self.views[f][positions[rows] - self.offsets[f]])
+                payload = records(packets)["payload"][(slice(None),) + trailing]
+                data[rows] = np.ascontiguousarray(payload, dtype=np.float32).view(np.complex64)[..., 0]
+        return data
+
+    def __getitem__(self, index):
+        index = expand_index(index, self.ndim)
+        frames = np.arange(self.shape[0])[index[0]]
+        elements = np.arange(self.shape[1])[index[1]]
+        outer = tuple(0 if isinstance(item, numbers.Integral) else slice(None) for item in index[:2])
+        trailing = index[2:]
+        basic = all([is_basic(item) for item in trailing])
+        positions = self.table[np.ix_(np.atleast_1d(frames), np.atleast_1d(elements))]
+        present = positions >= 0
+        # Basic trailing indices are applied before the conversion, others to the result
+        decoded = self.decode(positions[present].astype(np.int64), trailing if basic else (slice(None),)*len(trailing))
+        data = np.zeros(positions.shape + decoded.shape[1:], dtype=np.complex64)
+        data[present] = decoded
+        if not basic:
+            data = data[(slice(None), slice(None)) + trailing]
+        if self.masked:
+            mask = np.broadcast_to(~present.reshape(present.shape + (1,)*(data.ndim - 2)), data.shape)
+            data = np.ma.masked_array(data, mask=mask.copy())
+        return data[outer]
+
+    def __array__(self, dtype=None, copy=None):
+        # Reads the whole stream
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
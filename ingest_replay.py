@@ -0,0 +1,59 @@
+'''
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+
+Description
+-----------
+    This script is the local replay driver of ingest_service.py (requires Python 3.7 or newer).
+    It sends the '.dada' files of several numa nodes concurrently as UDP datagrams (one packet
+    per datagram), every node to its own port, thus the ingest service can be tested end to
+    end on a single machine.
+Program flow
+------------
+    0. Parse user arguments
+    1. Collect the files of every numa node ordered by their timestamp
+    2. Send all streams concurrently and print the achieved rate
+'''
+from __future__ import division
+import argparse
+import sys
+import time
+from argparse import RawTextHelpFormatter
+
+if sys.version_info < (3, 7):
+    sys.exit("ingest_replay.py requires Python 3.7 or newer")
+
+from inc.constants import *
+from inc.utils import check_slash, get_file_list, splitter
+from inc.service import replay
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='options', formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--dirs', '-d', action = "store", default="", dest="dirs", help="Comma separated list of directories, each containing the '.dada' files of one numa node")
+    parser.add_argument('--fname', '-f', action = "store", default="*.dada", dest="fname", help="Filename expression")
+    parser.add_argument('--host', '-H', action = "store", default="127.0.0.1", dest="host", help="Destination address")
+    parser.add_argument('--ports', '-p', action = "store", default="17100", dest="ports", help="Comma separated list of destination ports, one per directory")
+    parser.add_argument('--rate', '-r', action = "store", default=100.0, dest="rate", help="Data rate per node in MB/s. 0 sends as fast as possible")
+    parser.add_argument('--loops', '-l', action = "store", default=1, dest="loops", help="Number of repetitions of all files")
+    dirs = [check_slash(dir) for dir in parser.parse_args().dirs.split(",") if dir]
+    fname = parser.parse_args().fname
+    host = parser.parse_args().host
+    ports = [int(port) for port in parser.parse_args().ports.split(",") if port]
+    rate = float(parser.parse_args().rate)
+    loops = int(parser.parse_args().loops)
+    if len(dirs) != len(ports):
+        sys.exit("Pass one port per directory")
+
+    # 1. Files of every node
+    streams = []
+    for dir, port in zip(dirs, ports):
+        files = sorted(get_file_list(dir, fname), key=lambda f: splitter(f.split("/")[-1]))
+        print("Replaying " + str(len(files)) + " files of " + dir + " to " + host + ":" + str(port))
+        streams.append((files, port))
+
+    # 2. Send
+    start = time.time()
+    packets = replay(streams, host, rate, loops)
+    elapsed = time.time() - start
+    print("Sent {:d} packets in {:.2f} s ({:.1f} MB/s)".format(sum(packets), elapsed, sum(packets) * CODIF_PACKET_SIZE / 1e6 / max(elapsed, 1e-9)))
@@ -0,0 +1,80 @@
+'''
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+
+Description
+-----------
+    This script runs the asyncio ingest service (requires Python 3.7 or newer). It receives
+    CODIF packets of many frequency groups on UDP ports, integrates the ACMs of every group in a
+    process pool and publishes one ACM snapshot per group and cycle together with the loss
+    statistics (stdout, optionally .npz files and a stats.jsonl file).
+    Use ingest_replay.py to send recorded '.dada' files of several numa nodes to this service.
+Program flow
+------------
+    0. Parse user arguments
+    1. Bind the UDP ports of all groups and start the process pool (IngestService)
+    2. Receive, integrate and publish until --duration or --idle
+    3. Print the statistics of every group
+'''
+from __future__ import division
+import argparse
+import sys
+import time
+from argparse import RawTextHelpFormatter
+
+if sys.version_info < (3, 7):
+    sys.exit("ingest_service.py requires Python 3.7 or newer")
+
+from inc.constants import *
+from inc.service import IngestService, SnapshotWriter
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='options', formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--host', '-H', action = "store", default="0.0.0.0", dest="host", help="Address to bind")
+    parser.add_argument('--ports', '-p', action = "store", default="17100", dest="ports", help="Comma separated list of frequency groups. Ports of one group are joined by '+', e.g. 17100,17101+17102")
+    parser.add_argument('--nelements', '-n', action = "store", default=36, dest="nelements", help="Number of elements (beams) per frame")
+    parser.add_argument('--cycle', '-c', action = "store", default=1.0, dest="cycle", help="Integration time of one ACM in seconds")
+    parser.add_argument('--duration', '-t', action = "store", default=0, dest="duration", help="Run time in seconds. 0 runs endless")
+    parser.add_argument('--idle', '-i', action = "store", default=0, dest="idle", help="Stop if no packet arrived for the passed seconds. 0 waits endless")
+    parser.add_argument('--workers', '-w', action = "store", default=4, dest="workers", help="Number of correlator processes")
+    parser.add_argument('--batch', '-b', action = "store", default=1024, dest="batch", help="Number of packets per batch")
+    parser.add_argument('--queue', '-q', action = "store", default=16, dest="queue", help="Maximum number of queued batches per group, reading is paused if the queue is full")
+    parser.add_argument('--correlator', '-co', action = "store", default="integer", dest="correlator", help="'integer' accumulates exactly in int64, 'complex64' in single precision")
+    parser.add_argument('--output_dir', '-o', action = "store", default="", dest="odir", help="Directory to store the snapshots (<group>/acm_<start>.npz) and stats.jsonl. If not passed nothing is stored")
+    groups = [[int(port) for port in group.split("+") if port] for group in parser.parse_args().ports.split(",") if group]
+    host = parser.parse_args().host
+    nelements = int(parser.parse_args().nelements)
+    cycle = float(parser.parse_args().cycle)
+    duration = float(parser.parse_args().duration) or None
+    idle = float(parser.parse_args().idle) or None
+    workers = int(parser.parse_args().workers)
+    batch = int(parser.parse_args().batch)
+    queue = int(parser.parse_args().queue)
+    correlator = parser.parse_args().correlator
+    odir = parser.parse_args().odir
+
+    # 1. Service and publishers
+    service = IngestService(groups, nelements, cycle, correlator, host, workers, batch=batch, queue_size=queue)
+    def output(snapshot):
+        print("Group {} cycle {:.3f} s: frames {:d}/{:d}, packets {:d}, uncomplete {:d}, late {:d}, dropped {:d}, queued {:d}".format(
+            snapshot["group"], snapshot["start"], snapshot["frame_cnt"], snapshot["expected_frames"], snapshot["packets"],
+            snapshot["uncomplete"], snapshot["late"], snapshot["dropped"], snapshot["queued"]))
+    service.publishers.append(output)
+    if odir != "":
+        service.publishers.append(SnapshotWriter(odir))
+    print("Receiving " + str(len(groups)) + " groups on " + host + ":" + parser.parse_args().ports)
+
+    # 2. Receive and integrate
+    start = time.time()
+    try:
+        service.run(duration, idle)
+    except KeyboardInterrupt:
+        pass
+    elapsed = time.time() - start
+
+    # 3. Statistics
+    for group in service.groups:
+        print("Group {}: {:d} packets ({:.1f} MB/s), {:d} frames, uncomplete {:d}, late {:d}, dropped {:d}, truncated {:d}, paused {:d} times, failed {:d}".format(
+            group.name, group.packet_cnt, group.packet_cnt * CODIF_PACKET_SIZE / 1e6 / max(elapsed, 1e-9), group.assembler.frame_cnt,
+            group.assembler.uncomplete_cnt, group.late_cnt, group.dropped_cnt, group.truncated_cnt, group.pause_cnt, group.failed_cnt))
@@ -0,0 +1,82 @@
+'''
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+
+Description
+-----------
+    This script receives CODIF packets of one frequency group from UDP sockets and computes
+    Array Covariance Matrices (ACMs) online. The ACM of every cycle (e.g. 1 s of recorded data)
+    is stored as .npz file and summarized on stdout.
+    Every UDP datagram must contain one CODIF packet (64 byte header + 7168 byte payload).
+    Use replay_udp.py to send recorded '.dada' files to this script without telescope hardware.
+Program flow
+------------
+    0. Parse user arguments
+    1. Bind the UDP sockets (UdpReceiver)
+    2. Receive packets in batches, assemble frames and integrate ACMs (LiveCorrelator)
+    3. Store the ACM of every cycle and print the packet statistics
+'''
+from __future__ import division
+import argparse
+import os
+import time
+import numpy as np
+from argparse import RawTextHelpFormatter
+
+from inc.constants import *
+from inc.utils import check_slash
+from inc.live import UdpReceiver, LiveCorrelator
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='options', formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--host', '-H', action = "store", default="0.0.0.0", dest="host", help="Address to bind")
+    parser.add_argument('--ports', '-p', action = "store", default="17100", dest="ports", help="Comma separated list of UDP ports of one stream")
+    parser.add_argument('--nelements', '-n', action = "store", default=36, dest="nelements", help="Number of elements (beams) per frame")
+    parser.add_argument('--cycle', '-c', action = "store", default=1.0, dest="cycle", help="Integration time of one ACM in seconds")
+    parser.add_argument('--cycles', '-nc', action = "store", default=0, dest="cycles", help="Number of cycles to compute. 0 runs until --duration or --idle")
+    parser.add_argument('--duration', '-t', action = "store", default=0, dest="duration", help="Run time in seconds. 0 runs endless")
+    parser.add_argument('--idle', '-i', action = "store", default=0, dest="idle", help="Stop if no packet arrived for the passed seconds. 0 waits endless")
+    parser.add_argument('--batch', '-b', action = "store", default=1024, dest="batch", help="Maximum number of packets per batch")
+    parser.add_argument('--correlator', '-co', action = "store", default="integer", dest="correlator", help="'integer' accumulates exactly in int64, 'complex64' in single precision")
+    parser.add_argument('--output_dir', '-o', action = "store", default="", dest="odir", help="Directory to store one .npz file (acm, freq, frame_cnt, start) per cycle. If not passed nothing is stored")
+    ports = [int(port) for port in parser.parse_args().ports.split(",") if port]
+    host = parser.parse_args().host
+    nelements = int(parser.parse_args().nelements)
+    cycle = float(parser.parse_args().cycle)
+    cycles = int(parser.parse_args().cycles) or None
+    duration = float(parser.parse_args().duration) or None
+    idle = float(parser.parse_args().idle) or None
+    batch = int(parser.parse_args().batch)
+    correlator = parser.parse_args().correlator
+    odir = parser.parse_args().odir
+    if odir != "":
+        odir = check_slash(odir)
+        if not os.path.isdir(odir):
+            os.makedirs(odir)
+
+    # 1. Bind sockets
+    receiver = UdpReceiver(ports, host, batch)
+    live = LiveCorrelator(receiver, nelements, cycle, correlator)
+    print("Receiving on " + host + ":" + ",".join(str(port) for port in ports))
+    start = time.time()
+
+    # 3. Store and summarize every cycle
+    def output(result):
+        print("Cycle {:.3f} s: frames {:d}/{:d}, packets {:d}, uncomplete {:d}, late {:d}, truncated {:d}".format(
+            result["start"], result["frame_cnt"], result["expected_frames"], result["packets"],
+            result["uncomplete"], result["late"], result["truncated"]))
+        if odir != "":
+            np.savez(odir + "acm_{:.3f}.npz".format(result["start"]), acm=result["acm"], freq=result["freq"],
+                frame_cnt=result["frame_cnt"], start=result["start"])
+
+    # 2. Receive and integrate
+    try:
+        live.run(duration, cycles, output, idle)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        receiver.close()
+    elapsed = time.time() - start
+    print("Received {:d} packets in {:.2f} s ({:.1f} MB/s), late frames {:d}, truncated packets {:d}".format(receiver.packet_cnt, elapsed,
+        receiver.packet_cnt * CODIF_PACKET_SIZE / 1e6 / max(elapsed, 1e-9), live.late_cnt, receiver.truncated_cnt))
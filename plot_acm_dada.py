@@ -26,7 +26,7 @@ Program flow
 ------------
     0. Parse user arguments
     1. Create a CodifHandle object with all desired .dada files
-    2. Compute/process ACM data from raw voltage data
+    2. Compute/process ACM data from raw voltage data. Partial ACMs of files can be cached (--cache)
     3. Plot and store results
 '''
 # Included modules
@@ -37,6 +37,7 @@ from argparse import RawTextHelpFormatter
 # Custom modules
 from inc.codif import *
 from inc.utils import *
+from inc.cache import ACMCache
 
 
 if __name__ == '__main__':
@@ -49,12 +50,17 @@ if __name__ == '__main__':
     parser.add_argument('--nelements', '-n', action = "store", default=36, dest="nelements", help="Number of elements to read and plot. Default is 36")
     parser.add_argument('--output_dir', '-o', action = "store", default="", dest="odir", help="Output directory where to store plots and .txt file containing ACM data")
     parser.add_argument('--numa_id', '-i', action = "store", dest="node_id", help="Numa node ID of a subfrequency group")
+    parser.add_argument('--prefetch', '-pf', action = "store", default=128, dest="prefetch", help="Size of the prefetch buffers in MB. 0 reads packet by packet")
+    parser.add_argument('--cache', '-ca', action = "store", default="", dest="cache", help="Directory of a cache of per-file partial ACMs (requires prefetch > 0)")
+    parser.add_argument('--cache_size', '-cs', action = "store", default=10.0, dest="cache_size", help="Maximum size of the cache in GB")
     # Assign arguments to variables for readability
     fname = parser.parse_args().fname
     dir = check_slash(parser.parse_args().dir)
     odir = check_slash(parser.parse_args().odir)
     id = parser.parse_args().node_id
     nelements = int(parser.parse_args().nelements)
+    prefetch = int(parser.parse_args().prefetch)
+    cache = ACMCache(parser.parse_args().cache, int(float(parser.parse_args().cache_size)*1024**3)) if parser.parse_args().cache else None
     # Parse complete directory name
     if "numa" not in dir:
         dir += "numa" + str(id) + "/"
@@ -70,7 +76,7 @@ if __name__ == '__main__':
     # 1. Create a CodifHandle object with all desired .dada files
     handler = CodifHandler(files)
     # 2. Compute/process ACM data from raw voltage data
-    acm, freq = handler.compute_acm(nelements)
+    acm, freq, frame_cnt = handler.compute_acm(nelements, prefetch=prefetch, cache=cache)
     # 3. Plot and store results
     if odir != "":
         odir = check_slash(odir)
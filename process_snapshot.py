@@ -0,0 +1,155 @@
+'''
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+
+Description
+-----------
+    This script processes a whole snapshot in a single read of the raw data. Every batch of
+    packets is passed to several products at once (see inc/pipeline.py):
+        validate    faulty and zeroed packets per file (like validate_snapshot.py)
+        index       position of every frame within the files
+        acm         HDF5 based ACM file (like convert.py)
+        bandpass    mean power per element, channel and polarization of every numa node
+        fine        fine channels of every numa node (power or ACM, see inc/channelizer.py)
+    On network filesystems the read dominates the processing time, thus one pass replaces
+    separate runs of validate_snapshot.py and convert.py.
+
+Preliminaries
+-------------
+    The script expects the folder structure of convert.py, sub-folders have the name 'numa' + ID
+Program flow
+------------
+    0. Parse user arguments
+    1. Collect the files of all numa nodes, one CodifHandler handles all nodes (one stream per node)
+    2. Read every node once and pass the batches to all products
+    3. Write all outputs to the output directory:
+        validation.csv, index.npz, SB0<sbid>.pk01.acm.hdf5, bandpass.npz and fine.npz
+'''
+import argparse
+import os
+from argparse import RawTextHelpFormatter
+
+from inc.codif import *
+from inc.utils import *
+from inc.acm_hdf5 import *
+from inc.packed import PackedACM, SparseACM
+from inc.pipeline import PacketValidator, PacketIndex, ACMIntegrator, Bandpass, FineChannels
+from inc.profiling import StageProfiler, clock, report
+
+PRODUCTS = ["validate", "index", "acm", "bandpass", "fine"]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='options', formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--fname', '-f', action = "store", default = "*", dest = "fname", help = "Input filename expression. If not passed all files within a subfolder are read")
+    parser.add_argument('--dir', '-d', action = "store", default = "/beegfsEDD/NESSER/PAF-12-2020/2020-12-09/2020-12-09-15:57:51/", dest = "dir", help = "Path to root folder")
+    parser.add_argument('--output_dir', '-o', action = "store", default="results/", dest="odir", help = "Directory of all outputs")
+    parser.add_argument('--products', '-p', action = "store", default="validate,index,acm", dest="products", help="Comma separated list of products: " + ", ".join(PRODUCTS))
+    parser.add_argument('--nnodes', '-nn', action = "store", default=16, dest="nnodes", help="Number of nodes. All folders between numa0 and numaN are read")
+    parser.add_argument('--nelements', '-n', action = "store", default="", dest="nelements", help="Number of dual-polarized antenna elements. By default it is read from the DADA header (NBEAM), or set to 36")
+    parser.add_argument('--sbid', '-i', action = "store", default=9999, dest="sbid", help="Observation ID ")
+    parser.add_argument('--center', '-fc', action = "store", default=1340, dest="fc", help="Center frequency")
+    parser.add_argument('--comment', '-c', action = "store", default="no comment", dest="comment", help="Add a comment to the HDF5 file")
+    parser.add_argument('--correlator', '-co', action = "store", default="integer", dest="correlator", help="'integer' accumulates exactly in int64, 'complex64' in single precision")
+    parser.add_argument('--sparse', '-sp', action = "store_true", dest="sparse", help="Store only the ACMs of the recorded ports (ELEMENT_LIST) in the HDF5 file")
+    parser.add_argument('--nfft', '-nf', action = "store", default=32, dest="nfft", help="Product 'fine': number of fine channels per coarse channel")
+    parser.add_argument('--taps', '-tp', action = "store", default=1, dest="taps", help="Product 'fine': taps of the polyphase filterbank, 1 applies a windowed FFT")
+    parser.add_argument('--window', '-w', action = "store", default="hann", dest="window", help="Product 'fine': window of the FFT / filterbank ('hann' or 'none')")
+    parser.add_argument('--fine_mode', '-fm', action = "store", default="spectrum", dest="fine_mode", help="Product 'fine': 'spectrum' accumulates the power, 'acm' the ACM of the fine channels")
+    parser.add_argument('--crop', '-cr', action = "store_true", dest="crop", help="Product 'fine': keep only the fine channels within +-0.5 MHz of the coarse channel center (drops the oversampled edges)")
+    parser.add_argument('--prefetch', '-pf', action = "store", default=128, dest="prefetch", help="Size of the prefetch buffers in MB")
+    parser.add_argument('--max_open', '-mo', action = "store", default=64, dest="max_open", help="Maximum number of files which are open at the same time")
+    parser.add_argument('--direct', '-di', action = "store_true", dest="direct", help="Read files with O_DIRECT, bypassing the page cache. Falls back to buffered reads if the filesystem does not support it")
+    parser.add_argument('--profile', '-pr', action = "store", default="", dest="profile", help="Record time per processing stage and product. Pass 'summary' to print a table or a '.json' file to also store a Chrome trace")
+    parser.add_argument('--progress_rate', '-pg', action = "store", default=2.0, dest="progress_rate", help="Maximum number of progress updates per second (0 disables the progress output)")
+    fname = parser.parse_args().fname
+    idir = parser.parse_args().dir
+    odir = check_slash(parser.parse_args().odir)
+    products = [p for p in parser.parse_args().products.split(",") if p]
+    nnodes = int(parser.parse_args().nnodes)
+    nelements = int(parser.parse_args().nelements) if parser.parse_args().nelements else None
+    sbid = parser.parse_args().sbid
+    fc = int(parser.parse_args().fc)
+    comment = parser.parse_args().comment
+    correlator = parser.parse_args().correlator
+    sparse = parser.parse_args().sparse
+    nfft = int(parser.parse_args().nfft)
+    taps = int(parser.parse_args().taps)
+    window = parser.parse_args().window
+    fine_mode = parser.parse_args().fine_mode
+    crop = parser.parse_args().crop
+    prefetch = int(parser.parse_args().prefetch)
+    max_open = int(parser.parse_args().max_open)
+    direct = parser.parse_args().direct
+    profile = parser.parse_args().profile
+    progress_rate = float(parser.parse_args().progress_rate)
+    profiler = StageProfiler() if profile else None
+    for product in products:
+        if product not in PRODUCTS:
+            raise ValueError("Unknown product '" + product + "', use one of " + ", ".join(PRODUCTS))
+    if not os.path.isdir(odir):
+        os.makedirs(odir)
+    freq_low = fc - PAF_BANDWIDTH/2
+
+    # 1. Files of all nodes
+    file_list = []
+    for id in range(nnodes):
+        file_list += get_file_list(check_slash(idir) + "numa" + str(id) + "/", fname + "*")
+    handler = CodifHandler(file_list, direct=direct, max_open=max_open)
+    nelements, freq = handler.configure(nelements)
+
+    # 2. One pass over all nodes
+    consumers = {}
+    if "validate" in products:
+        consumers["validate"] = PacketValidator(nelements)
+    if "index" in products:
+        consumers["index"] = PacketIndex()
+    if "acm" in products:
+        consumers["acm"] = ACMIntegrator(nelements, correlator)
+    if "bandpass" in products:
+        consumers["bandpass"] = Bandpass(nelements)
+    if "fine" in products:
+        consumers["fine"] = FineChannels(nelements, fine_mode, nfft, taps, window, crop)
+    handler.process([consumers[p] for p in products if p in consumers], nelements, profiler=profiler,
+        progress_rate=progress_rate, prefetch=prefetch)
+
+    # 3. Outputs
+    if profiler is not None:
+        tstamp = clock()
+    if "validate" in consumers:
+        print("Faulty packets: " + str(consumers["validate"].faulty_cnt) + ", zeroed packets: " + str(consumers["validate"].zeroed_cnt))
+        handler.to_csv(odir, "validation.csv")
+    if "index" in consumers:
+        consumers["index"].save(odir + "index.npz")
+        print("Saved packet index to " + odir + "index.npz")
+    if "bandpass" in consumers:
+        consumers["bandpass"].save(odir + "bandpass.npz", handler.streams)
+        print("Saved bandpass to " + odir + "bandpass.npz")
+    if "fine" in consumers:
+        headers = [stream.files[0].metadata() for stream in handler.streams]
+        freqs = [header.channel_frequencies() if header is not None else None for header in headers]
+        consumers["fine"].save(odir + "fine.npz", handler.streams, freqs)
+        print("Saved fine channels to " + odir + "fine.npz")
+    if "acm" in consumers:
+        freq_dict = {}
+        acm = SparseACM(ELEMENT_LIST, N_ELEMENTS, PackedACM(len(ELEMENT_LIST), (1+CODIF_CHANNELS_IN_BLOCK, PAF_N_FREQ_GROUP)))
+        for node, stream in zip(handler.numa_list, handler.streams):
+            # Every node records another frequency group, its frequencies are taken from its own DADA header
+            header = stream.files[0].metadata()
+            node_freq = header.channel_frequencies() if header is not None else None
+            acm_data, node_freq, frame_cnt = consumers["acm"].result(stream, node_freq)
+            print("Node " + str(node) + ": " + str(frame_cnt) + " frames, duration of record: " + str(consumers["acm"].duration(stream)) + " s")
+            if frame_cnt > 10:
+                for f in node_freq:
+                    freq_dict[str(f)] = frame_cnt
+                fillup_acm(acm_data, ELEMENT_LIST, node_freq, out=acm)
+        sky_frequency, frames, flagged = frequency_table(freq_dict, freq_low)
+        fout = odir + "SB0" + str(sbid) + ".pk01.acm.hdf5"
+        dictionary = data_to_dict(acm, sky_frequency, frames, flagged=flagged, odir=fout, sbid=sbid, fc=fc, comment=comment, sparse=sparse)
+        acm_file = ACMFile(fout, 'w')
+        acm_file.create_from_dict(dictionary)
+        acm_file.close()
+        print("Saved ACM to " + fout)
+    if profiler is not None:
+        profiler.add("output", tstamp)
+        report(profiler, profile)
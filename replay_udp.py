@@ -0,0 +1,53 @@
+'''
+Institution: Max-Planck Institution for Radioastronomy (MPIfR-Bonn)
+    Auf dem Huegel 69, Bonn, Germany
+
+Description
+-----------
+    This script replays the CODIF packets of '.dada' files as UDP datagrams (one packet per
+    datagram) at a configurable rate. Together with live_acm.py the live mode can be tested
+    and benchmarked on a single machine over loopback.
+Program flow
+------------
+    0. Parse user arguments
+    1. Collect the files of one numa node ordered by their timestamp
+    2. Send all packets (optionally several times) and print the achieved rate
+'''
+from __future__ import division
+import argparse
+import time
+from argparse import RawTextHelpFormatter
+
+from inc.constants import *
+from inc.utils import check_slash, get_file_list, splitter
+from inc.live import UdpSender
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='options', formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--dir', '-d', action = "store", default="", dest="dir", help="Directory containing the '.dada' files of one numa node")
+    parser.add_argument('--fname', '-f', action = "store", default="*.dada", dest="fname", help="Filename expression")
+    parser.add_argument('--host', '-H', action = "store", default="127.0.0.1", dest="host", help="Destination address")
+    parser.add_argument('--ports', '-p', action = "store", default="17100", dest="ports", help="Comma separated list of destination ports, packets are distributed round robin")
+    parser.add_argument('--rate', '-r', action = "store", default=100.0, dest="rate", help="Data rate in MB/s. 0 sends as fast as possible")
+    parser.add_argument('--loops', '-l', action = "store", default=1, dest="loops", help="Number of repetitions of all files")
+    idir = check_slash(parser.parse_args().dir)
+    fname = parser.parse_args().fname
+    host = parser.parse_args().host
+    ports = [int(port) for port in parser.parse_args().ports.split(",") if port]
+    rate = float(parser.parse_args().rate)
+    loops = int(parser.parse_args().loops)
+
+    # 1. Files of one node
+    files = sorted(get_file_list(idir, fname), key=lambda f: splitter(f.split("/")[-1]))
+    print("Replaying " + str(len(files)) + " files to " + host + ":" + ",".join(str(port) for port in ports))
+
+    # 2. Send
+    sender = UdpSender(host, ports, rate)
+    start = time.time()
+    try:
+        packets = sender.replay(files, loops)
+    finally:
+        sender.close()
+    elapsed = time.time() - start
+    print("Sent {:d} packets in {:.2f} s ({:.1f} MB/s)".format(packets, elapsed, packets * CODIF_PACKET_SIZE / 1e6 / max(elapsed, 1e-9)))
@@ -39,6 +39,8 @@ Program flow
     0. Parse user arguments
     1. Create a CodifHandle object with all detected files
     2. Validates all deteced files and monitors the progress. (Validating recorded data of snapshots with 1TB size takes a while)
+       The progress is published to the sinks passed by '--monitor' (curses, log, json, prometheus).
+       Without a TTY (e.g. batch scheduler) plain log lines are written.
     3. Save result to a csv file
 '''
 import argparse
@@ -47,6 +49,8 @@ import re
 from argparse import RawTextHelpFormatter
 
 from inc.codif import *
+from inc.metrics import create_sinks
+from inc.profiling import StageProfiler, report
 
 
 if __name__ == '__main__':
@@ -56,12 +60,29 @@ if __name__ == '__main__':
     parser.add_argument('--packets', '-p', action = "store", default=-1, dest = "packets", help = "Packets to read from .dada file")
     parser.add_argument('--threads', '-t', action = "store", default=2, dest = "threads", help = "Packets to read from .dada file")
     parser.add_argument('--output', '-o', action = "store", default= "2020-12-03-22:48:30.csv", dest = "output", help = "Packets to read from .dada file")
+    parser.add_argument('--monitor', '-m', action = "store", default="", dest = "monitor", help = "Comma separated list of metrics sinks (curses, log, json, prometheus). Default: curses on a TTY, otherwise log")
+    parser.add_argument('--display', '-ds', action = "store", default="node", dest = "display", help = "Monitor progress per 'node' or per 'file'")
+    parser.add_argument('--interval', '-in', action = "store", default=1.0, dest = "interval", help = "Update interval of the monitor in seconds")
+    parser.add_argument('--status_file', '-sf', action = "store", default="status.json", dest = "status_file", help = "Output file of the json sink")
+    parser.add_argument('--port', '-pt', action = "store", default=9110, dest = "port", help = "Local port of the prometheus sink")
+    parser.add_argument('--max_open', '-mo', action = "store", default=64, dest="max_open", help="Maximum number of files which are open at the same time")
+    parser.add_argument('--direct', '-di', action = "store_true", dest="direct", help="Read files with O_DIRECT, bypassing the page cache. Falls back to buffered reads if the filesystem does not support it")
+    parser.add_argument('--profile', '-pr', action = "store", default="", dest="profile", help="Record time per processing stage. Pass 'summary' to print a table or a '.json' file to also store a Chrome trace")
 
     fname = parser.parse_args().fname
     dir = parser.parse_args().dir
     packets = int(parser.parse_args().packets)
     threads = int(parser.parse_args().threads)
     output = parser.parse_args().output
+    monitor = [m for m in parser.parse_args().monitor.split(',') if m]
+    display = parser.parse_args().display
+    interval = float(parser.parse_args().interval)
+    status_file = parser.parse_args().status_file
+    port = int(parser.parse_args().port)
+    profile = parser.parse_args().profile
+    direct = parser.parse_args().direct
+    max_open = int(parser.parse_args().max_open)
+    profiler = StageProfiler() if profile else None
 
     file_list = []
     fname_list = []
@@ -72,6 +93,9 @@ if __name__ == '__main__':
                 file_list.append(os.path.join(root, file))
 
     file_list.sort(key=splitter)
-    handler = CodifHandler(file_list)
-    handler.validate(packets, threads=threads, display="node")
+    handler = CodifHandler(file_list, direct=direct, max_open=max_open)
+    sinks = create_sinks(monitor, display, json_file=status_file, port=port)
+    handler.validate(packets, threads=threads, display=display, sinks=sinks, interval=interval, profiler=profiler)
+    if profiler is not None:
+        report(profiler, profile)
     handler.to_csv("results/", output)